@@ -0,0 +1,186 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Measures size reduction and query speed of the store of tracks """
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_FOLDER)
+
+from pygce.analysis.gpx import Track  # noqa: E402
+from pygce.analysis.tracks import DEFAULT_TOLERANCE, DOUGLAS_PEUCKER, \
+    METHODS, TrackStore  # noqa: E402
+
+GPX_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+             '<gpx version="1.1" creator="pygce" ' \
+             'xmlns="http://www.topografix.com/GPX/1/1">\n' \
+             '<trk><name>{}</name><trkseg>\n'
+GPX_POINT = '<trkpt lat="{:.7f}" lon="{:.7f}"><ele>{:.1f}</ele>' \
+            '<time>{}</time></trkpt>\n'
+GPX_FOOTER = '</trkseg></trk>\n</gpx>\n'
+DEFAULT_MIN_REDUCTION = 10.0  # min ratio of .gpx bytes to bytes stored
+
+
+def create_args():
+    """
+    :return: ArgumentParser
+        Parser that handles cmd arguments.
+    """
+
+    parser = argparse.ArgumentParser(
+        usage="-tracks <number of tracks> -points <points per track> "
+              "-tolerance <meters> -method <douglas-peucker or visvalingam>")
+    parser.add_argument("-tracks", dest="tracks", type=int,
+                        help="number of tracks to generate",
+                        default=100,
+                        required=False)
+    parser.add_argument("-points", dest="points", type=int,
+                        help="points (seconds) of each track",
+                        default=3600,
+                        required=False)
+    parser.add_argument("-tolerance", dest="tolerance", type=float,
+                        help="tolerance (meters) of simplification",
+                        default=DEFAULT_TOLERANCE,
+                        required=False)
+    parser.add_argument("-method", dest="method",
+                        help="simplification: " + ", ".join(METHODS),
+                        default=DOUGLAS_PEUCKER,
+                        required=False)
+    parser.add_argument("-queries", dest="queries", type=int,
+                        help="number of places to query",
+                        default=50,
+                        required=False)
+    parser.add_argument("-min-reduction", dest="min_reduction", type=float,
+                        help="min ratio of .gpx bytes to bytes stored",
+                        default=DEFAULT_MIN_REDUCTION,
+                        required=False)
+    return parser
+
+
+def generate_track(rng, points):
+    """
+    :param rng: numpy.random.Generator
+        Random numbers
+    :param points: int
+        Points of track (one per second)
+    :return: Track
+        Run of about 3 m/s around a random place of a 1 x 1 degrees area,
+        turning smoothly
+    """
+
+    heading = np.cumsum(rng.normal(0.0, 0.05, points))
+    speed = np.clip(3.0 + rng.normal(0.0, 0.3, points), 0.0, None)  # m/s
+    north = np.cumsum(speed * np.cos(heading)) / 111195.0
+    east = np.cumsum(speed * np.sin(heading)) / 111195.0
+    lat = 45.0 + rng.uniform(0.0, 1.0) + north
+    lon = 11.0 + rng.uniform(0.0, 1.0) + east / np.cos(np.radians(lat))
+    ele = 200.0 + np.cumsum(rng.normal(0.0, 0.2, points))
+    start = 1546300800 + int(rng.integers(0, 365 * 86400))
+    return Track(lat, lon, ele, start + np.arange(points, dtype=float))
+
+
+def save_gpx(track, output_file):
+    """
+    :param track: Track
+        Track to save
+    :param output_file: str
+        Path of .gpx file
+    :return: void
+        Saves track like Garmin Connect exports it
+    """
+
+    times = (track.time.astype(np.int64)).astype("datetime64[s]")
+    with open(output_file, "w") as o:
+        o.write(GPX_HEADER.format(os.path.basename(output_file)))
+        for lat, lon, ele, t in zip(track.lat, track.lon, track.ele, times):
+            o.write(GPX_POINT.format(lat, lon, ele, str(t) + "Z"))
+        o.write(GPX_FOOTER)
+
+
+def get_folder_size(folder, extension=""):
+    """
+    :param folder: str
+        Folder
+    :param extension: str
+        Extension of files to count
+    :return: int
+        Bytes of files of folder
+    """
+
+    return sum(
+        os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder)
+        if f.endswith(extension)
+    )
+
+
+def main():
+    args = create_args().parse_args()
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as folder:
+        gpx_folder = os.path.join(folder, "gpx")
+        os.makedirs(gpx_folder)
+        full_bytes = 0
+        for i in range(args.tracks):
+            track = generate_track(rng, args.points)
+            gpx_file = os.path.join(gpx_folder, "{:04d}.gpx".format(i))
+            save_gpx(track, gpx_file)
+            track.save(os.path.join(folder, "full.npz"))
+            full_bytes += os.path.getsize(os.path.join(folder, "full.npz"))
+
+        store = TrackStore(os.path.join(folder, "store"))
+        start = time.perf_counter()
+        store.add_folder(gpx_folder, args.tolerance, args.method)
+        store_seconds = time.perf_counter() - start
+
+        gpx_bytes = get_folder_size(gpx_folder, ".gpx")
+        store_bytes = store.get_size()
+        points = sum(t["points"] for t in store.tracks.values())
+        stored_points = sum(t["stored_points"] for t in store.tracks.values())
+
+        places = []
+        for name in rng.choice(store.names, args.queries):
+            track = store.get_track(name)
+            p = int(rng.integers(0, len(track)))
+            places.append((track.lat[p], track.lon[p]))  # on random tracks
+        places += list(zip(rng.uniform(45.0, 46.0, args.queries),
+                           rng.uniform(11.0, 12.0, args.queries)))
+
+        start = time.perf_counter()
+        indexed = [store.find_passing(lat, lon, 50.0) for lat, lon in places]
+        indexed_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        scanned = [
+            [n for n in store.names if store.get_distance(n, lat, lon) <= 50]
+            for lat, lon in places
+        ]  # read every track
+        scanned_seconds = time.perf_counter() - start
+
+    print("tracks: {} x {} points, {} {}m".format(
+        args.tracks, args.points, args.method, args.tolerance))
+    print("points stored: {} of {} ({:.1%})".format(
+        stored_points, points, stored_points / points))
+    print(".gpx: {:.1f} MB, full .npz: {:.1f} MB, store: {:.2f} MB "
+          "({:.0f}x smaller than .gpx, {:.0f}x than .npz), stored in "
+          "{:.2f}s".format(gpx_bytes / 1e6, full_bytes / 1e6,
+                           store_bytes / 1e6, gpx_bytes / store_bytes,
+                           full_bytes / store_bytes, store_seconds))
+    print("{} queries: {:.3f}s with index, {:.3f}s scanning ({:.0f}x)".format(
+        len(places), indexed_seconds, scanned_seconds,
+        scanned_seconds / max(indexed_seconds, 1e-9)))
+
+    if indexed != scanned or gpx_bytes / store_bytes < args.min_reduction:
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Checks that the pygce cli starts fast (heavy modules are not imported) """
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = [
+    "bs4",
+    "hal",
+    "lxml",
+    "matplotlib",
+    "numpy",
+    "selenium",
+    "sklearn"
+]  # must not be imported just to start the cli
+MODULES_TO_IMPORT = [
+    "pygce.cli",
+    "pygce.models.bot",
+    "pygce.analysis.cli"
+]
+DEFAULT_BUDGET_SECONDS = 0.15  # max startup time on top of the interpreter
+ROOT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def create_args():
+    """
+    :return: ArgumentParser
+        Parser that handles cmd arguments.
+    """
+
+    parser = argparse.ArgumentParser(
+        usage="-budget <max seconds to start the cli> -runs <times to run>")
+    parser.add_argument("-budget", dest="budget", type=float,
+                        help="max seconds to start the cli (on top of the "
+                             "python interpreter)",
+                        default=DEFAULT_BUDGET_SECONDS,
+                        required=False)
+    parser.add_argument("-runs", dest="runs", type=int,
+                        help="times to start the cli",
+                        default=10,
+                        required=False)
+    return parser
+
+
+def time_command(command, runs):
+    """
+    :param command: [] of str
+        Command to run
+    :param runs: int
+        Times to run command
+    :return: float
+        Median wall time (seconds) of command
+    """
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT_FOLDER + os.pathsep + env.get("PYTHONPATH", "")
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, cwd=ROOT_FOLDER, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
+
+
+def get_heavy_modules_imported():
+    """
+    :return: [] of str
+        Heavy modules imported just by importing pygce cli modules
+    """
+
+    code = "import sys\n"
+    code += "".join("import " + m + "\n" for m in MODULES_TO_IMPORT)
+    code += "print(' '.join(m for m in {} if m in sys.modules))".format(
+        HEAVY_MODULES)
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT_FOLDER, check=True,
+        stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout
+    return output.split()
+
+
+def main():
+    args = create_args().parse_args()
+
+    heavy_modules = get_heavy_modules_imported()
+    baseline = time_command([sys.executable, "-c", "pass"], args.runs)
+    startup = time_command([sys.executable, "-m", "pygce.cli", "-h"],
+                           args.runs)
+    overhead = startup - baseline
+
+    print("python startup: {:.3f}s".format(baseline))
+    print("pygce -h: {:.3f}s (+{:.3f}s, budget {:.3f}s)".format(
+        startup, overhead, args.budget))
+    print("heavy modules imported: {}".format(", ".join(heavy_modules) or
+                                              "none"))
+
+    if heavy_modules or overhead > args.budget:
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Measures peak memory of days kept after parsing (like .json exports) """
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+ROOT_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_FOLDER)
+
+from pygce.models.garmin.timeline import GCDayTimeline  # noqa: E402
+from pygce.models.metrics import get_resource_usage  # noqa: E402
+
+NONE = "none"  # nothing parsed: memory of interpreter and imports
+KEEP = "keep"
+RELEASE = "release"
+MODES = [KEEP, RELEASE]
+DEFAULT_MAX_RATIO = 0.5  # max growth of memory releasing html over keeping it
+
+
+def create_args():
+    """
+    :return: ArgumentParser
+        Parser that handles cmd arguments.
+    """
+
+    parser = argparse.ArgumentParser(
+        usage="-days <number of days> -kb <kilobytes of html per day> "
+              "-max-mb <max peak memory (MB) when releasing html>")
+    parser.add_argument("-days", dest="days", type=int,
+                        help="number of days to parse and keep",
+                        default=60,
+                        required=False)
+    parser.add_argument("-kb", dest="kb", type=int,
+                        help="kilobytes of html of each day",
+                        default=200,
+                        required=False)
+    parser.add_argument("-max-ratio", dest="max_ratio", type=float,
+                        help="max growth (over the interpreter) of peak "
+                             "memory "
+                             "when releasing html, as a fraction of the "
+                             "growth when keeping it",
+                        default=DEFAULT_MAX_RATIO,
+                        required=False)
+    parser.add_argument("-max-mb", dest="max_mb", type=float,
+                        help="max peak memory (MB) when releasing html",
+                        default=None,
+                        required=False)
+    parser.add_argument("-mode", dest="mode",
+                        help="run one mode (" + ", ".join(MODES) + ") and "
+                             "print its peak memory",
+                        default=None,
+                        required=False)
+    return parser
+
+
+def generate_day(date_time, kb):
+    """
+    :param date_time: datetime
+        Day
+    :param kb: int
+        Kilobytes of html of day
+    :return: GCDayTimeline
+        Day with html shaped like Garmin Connect sections (about kb
+        kilobytes in all)
+    """
+
+    rows = max(1, kb // 4)  # about 1 kB per row of each html section
+    div = '<div class="data-bit"><span class="value">{}</span>' \
+          '<span class="label">steps</span></div>'
+    summary = "<div class='summary'>" + "".join(
+        '<div class="comment-container"><span class="like js-like-count">{}'
+        '</span><div class="comment">{}</div>{}</div>'.format(
+            i, "x" * 600, div.format(i)) for i in range(rows)
+    ) + "</div>"
+    steps = "<div class='steps'>" + "".join(
+        div.format(i) * 6 for i in range(rows)) + "</div>"
+    activities = "<table><tr><th>activity</th></tr>" + "".join(
+        '<tr><td><a href="/modern/activity/{0}">run {0}</a></td>'
+        '<td>{1}</td><td>{1}</td><td>{1}</td><td>{1}</td></tr>'.format(
+            i, "1:00:00 " * 20) for i in range(rows)
+    ) + "</table>"
+    breakdown = "<svg>" + "".join(
+        '<text><tspan>{}%</tspan></text>'.format(i % 100) * 15
+        for i in range(rows)) + "</svg>"
+    start = datetime(date_time.year, date_time.month, date_time.day)
+    bins = json.dumps([
+        {"startGMT": (start + timedelta(minutes=15 * i)).strftime(
+            "%Y-%m-%dT%H:%M:%S") + ".0", "steps": i * 7}
+        for i in range(96)
+    ])
+    return GCDayTimeline(date_time, summary, steps, bins, summary[:len(
+        summary) // 4], activities, breakdown)
+
+
+def run_mode(mode, days, kb):
+    """
+    :param mode: str
+        Keep or release html of parsed days
+    :param days: int
+        Days to parse
+    :param kb: int
+        Kilobytes of html of each day
+    :return: int
+        Parses days one at a time, keeping them all (like .json exports do),
+        returns peak memory (bytes) of process
+    """
+
+    first = datetime(2019, 1, 1)
+    kept = []
+    for i in range(days):
+        day = generate_day(first + timedelta(days=i), kb)
+        day.parse()
+        if mode == RELEASE:
+            day.release_inputs()
+        kept.append(day)
+
+    return get_resource_usage()["max_rss_bytes"]
+
+
+def measure(mode, days, kb):
+    """
+    :param mode: str
+        Keep or release html of parsed days (or none: nothing parsed)
+    :param days: int
+        Days to parse
+    :param kb: int
+        Kilobytes of html of each day
+    :return: int
+        Peak memory (bytes) of a new process running mode
+    """
+
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), "-mode", str(mode),
+        "-days", str(days), "-kb", str(kb)
+    ])
+    return int(output.decode("utf-8").strip().split()[-1])
+
+
+def main():
+    args = create_args().parse_args()
+    if args.mode is not None:
+        days = 0 if args.mode == NONE else args.days
+        print(run_mode(args.mode, days, args.kb))
+        return
+
+    base = measure(NONE, args.days, args.kb)
+    peaks = {mode: measure(mode, args.days, args.kb) for mode in MODES}
+    print("days: {} x {} kB of html".format(args.days, args.kb))
+    print("peak memory: {:.1f} MB at start".format(base / 1e6))
+    for mode in MODES:
+        print("{}: {:.1f} MB peak (+{:.1f} MB)".format(
+            mode, peaks[mode] / 1e6, (peaks[mode] - base) / 1e6))
+
+    ratio = (peaks[RELEASE] - base) / max(peaks[KEEP] - base, 1)
+    print("release / keep growth: {:.2f}".format(ratio))
+    if ratio > args.max_ratio or \
+            (args.max_mb is not None and peaks[RELEASE] > args.max_mb * 1e6):
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,155 @@
 
 
 import argparse
+import json
 import os
+import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 
-from models import TimelineDataAnalysis
+from pygce.analysis.models import TimelineDataAnalysis
+
+DEFAULT_ANALYSES = [
+    "cluster3d=SLEEP:deep_sleep_time,ACTIVITIES:distance,SUMMARY:kcal_count"
+]
+INDEX_FILE = "index.json"
+IMAGE_EXTENSION = ".png"
+TABLE_EXTENSION = ".csv"
+
+
+def run_correlation(analysis, arg, output_file):
+    analysis.show_correlation_matrix_of_data(output_file=output_file)
+
+
+def run_predict(analysis, arg, output_file):
+    analysis.predict_feature(arg, output_file=output_file)
+
+
+def run_cluster(analysis, arg, output_file):
+    n_clusters = int(arg) if arg else 6
+    analysis.cluster_analyze(n_clusters=n_clusters, output_file=output_file)
+
+
+def run_cluster_3d(analysis, arg, output_file):
+    analysis.cluster_3d_plot(arg.split(","), output_file=output_file)
+
+
+def run_cluster_sweep(analysis, arg, output_file):
+    low, _, high = (arg or "2-10").partition("-")
+    analysis.cluster_sweep(range(int(low), int(high or low) + 1), workers=1,
+                           output_file=output_file)
+
+
+def run_k_best(analysis, arg, output_file):
+    analysis.select_k_best(arg, output_file=output_file)
+
+
+def run_scores(analysis, arg, output_file):
+    table_file = os.path.splitext(output_file)[0] + TABLE_EXTENSION
+    analysis.get_feature_scores().export(table_file, by=arg or "f_score")
+    return table_file
+
+
+ANALYSES = {
+    "correlation": run_correlation,
+    "predict": run_predict,  # predict=<feature>
+    "cluster": run_cluster,  # cluster=<number of clusters>
+    "cluster3d": run_cluster_3d,  # cluster3d=<feature>,<feature>,<feature>
+    "ksweep": run_cluster_sweep,  # ksweep=<min clusters>-<max clusters>
+    "kbest": run_k_best,  # kbest=<feature>
+    "scores": run_scores  # scores=<f_score or mutual_info>: ranked table
+}  # analysis name -> function(analysis, arg, output file) -> file saved
+
+
+def parse_analysis(raw):
+    """
+    :param raw: str
+        Analysis to run in the form name or name=arg
+    :return: tuple str, str
+        Name of analysis and its arg (None if no arg)
+    """
+
+    name, _, arg = str(raw).strip().partition("=")
+    if name not in ANALYSES:
+        raise ValueError("Unknown analysis " + name + ". Choose among " +
+                         ", ".join(sorted(ANALYSES.keys())))
+
+    return name, arg or None
+
+
+def get_image_file(output_folder, file_path, name, arg):
+    """
+    :param output_folder: str
+        Folder where to save images
+    :param file_path: str
+        Path to data file analysed
+    :param name: str
+        Name of analysis
+    :param arg: str
+        Arg of analysis
+    :return: str
+        Path of image of analysis of data file
+    """
+
+    file_name = os.path.splitext(os.path.basename(file_path))[0]
+    image_name = file_name + "_" + name
+    if arg:
+        image_name += "_" + re.sub(r"[^A-Za-z0-9_.-]+", "-", arg)
+
+    return os.path.join(output_folder, image_name + IMAGE_EXTENSION)
+
+
+def init_worker():
+    import matplotlib
+
+    matplotlib.use("Agg")  # render to files, never open windows
+
+
+def analyze_file(file_path, analyses, output_folder, windows=None):
+    """
+    :param file_path: str
+        Path to data file to analyse
+    :param analyses: [] of (str, str)
+        Name and arg of analyses to run
+    :param output_folder: str
+        Folder where to save images
+    :param windows: [] of int
+        Days of rolling windows of features to add to data, None to analyse
+        single days only
+    :return: [] of {}
+        Outcome of each analysis (image, seconds, error if any)
+    """
+
+    init_worker()  # in case it runs in this process
+
+    analysis = TimelineDataAnalysis(file_path)  # parses file only once
+    if windows:
+        analysis.add_features(windows)
+    results = []
+    for name, arg in analyses:
+        image_file = get_image_file(output_folder, file_path, name, arg)
+        result = {
+            "file": file_path,
+            "analysis": name,
+            "arg": arg,
+            "image": image_file,
+            "error": None
+        }
+
+        start = time.perf_counter()
+        try:
+            result["image"] = ANALYSES[name](analysis, arg, image_file) or \
+                image_file  # some analyses save tables instead
+        except Exception as e:
+            traceback.print_exc()
+            result["image"] = None
+            result["error"] = e.__class__.__name__ + ": " + str(e)
+
+        result["seconds"] = time.perf_counter() - start
+        results.append(result)
+
+    return results
 
 
 def create_args():
@@ -15,10 +161,35 @@ def create_args():
     """
 
     parser = argparse.ArgumentParser(
-        usage="-f <path to folder with data files to analyse>")
+        usage="-f <path to folder with data files to analyse> -a <analyses "
+              "to run> -out <folder where to save charts> -windows <days of "
+              "rolling windows> -j <processes>")
     parser.add_argument("-f", dest="folder_path",
                         help="path to folder with data files to analyse",
                         required=True)
+    parser.add_argument("-a", nargs="*", dest="analyses",
+                        help="analyses to run on each file, among " +
+                             ", ".join(sorted(ANALYSES.keys())) +
+                             ". e.g -a correlation cluster=4 "
+                             "predict=SLEEP:deep_sleep_time "
+                             "kbest=SLEEP:deep_sleep_time",
+                        default=DEFAULT_ANALYSES,
+                        required=False)
+    parser.add_argument("-out", dest="output_folder",
+                        help="folder where to save charts and index (default "
+                             "<folder with data files>/analysis)",
+                        default=None,
+                        required=False)
+    parser.add_argument("-windows", nargs="*", dest="windows", type=int,
+                        help="add rolling stats (over these days), lags and "
+                             "deltas of columns to data before analyses. "
+                             "e.g -windows 7 30",
+                        default=None,
+                        required=False)
+    parser.add_argument("-j", dest="workers", type=int,
+                        help="number of processes (default: all cores)",
+                        default=None,
+                        required=False)
     return parser
 
 
@@ -32,35 +203,64 @@ def parse_args(parser):
 
     args = parser.parse_args()
 
-    return str(args.folder_path)
+    folder_path = str(args.folder_path)
+    analyses = [parse_analysis(a) for a in args.analyses]
+    output_folder = args.output_folder or os.path.join(folder_path,
+                                                       "analysis")
 
+    return folder_path, analyses, str(output_folder), args.windows, \
+        args.workers
 
-def check_args(folder_path):
+
+def check_args(folder_path, output_folder):
     """
     :param folder_path: str
         Path to folder with data files to analyse
+    :param output_folder: str
+        Folder where to save charts
     """
 
     assert os.path.exists(folder_path)
 
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
     return True
 
 
 def main():
-    folder_path = parse_args(create_args())
-    if check_args(folder_path):
-        for f in os.listdir(folder_path):
-            file_path = os.path.join(folder_path, f)
-
-            if os.path.isfile(file_path) and str(file_path).endswith(".csv"):
-                gc = TimelineDataAnalysis(file_path)
-                # gc.show_correlation_matrix_of_data()
-                # gc.predict_feature("SLEEP:deep_sleep_time")
-                # gc.cluster_analyze(n_clusters=4)
-                gc.cluster_3d_plot(
-                    ["SLEEP:deep_sleep_time", "ACTIVITIES:distance",
-                     "SUMMARY:kcal_count"])
-                # gc.select_k_best("SLEEP:deep_sleep_time")
+    folder_path, analyses, output_folder, windows, workers = parse_args(
+        create_args())
+    if check_args(folder_path, output_folder):
+        files = sorted(
+            os.path.join(folder_path, f) for f in os.listdir(folder_path)
+            if os.path.isfile(os.path.join(folder_path, f)) and
+            str(f).endswith(".csv")
+        )
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_worker) as executor:
+            futures = [
+                executor.submit(analyze_file, f, analyses, output_folder,
+                                windows)
+                for f in files
+            ]
+            results = [r for future in futures for r in future.result()]
+
+        index = {
+            "folder": folder_path,
+            "files": len(files),
+            "seconds": time.perf_counter() - start,
+            "failed": sum(1 for r in results if r["error"]),
+            "results": results
+        }
+        with open(os.path.join(output_folder, INDEX_FILE), "w") as o:
+            json.dump(index, o, sort_keys=True, indent=4,
+                      separators=(',', ': '))
+
+        print("Analysed", len(files), "files, index in",
+              os.path.join(output_folder, INDEX_FILE))
     else:
         print("Error while parsing args.")
 
@@ -0,0 +1,248 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" K-means clustering of standardised data, with cached models """
+
+import hashlib
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+MINI_BATCH_MIN_ROWS = 10000  # fit MiniBatchKMeans from this many rows
+SILHOUETTE_SAMPLE_SIZE = 5000  # max rows to compute silhouette score on
+CACHE_FILE_EXTENSION = ".pickle"
+
+
+def standardize(x_data):
+    """
+    :param x_data: numpy.ndarray
+        Float matrix (rows x features), NaN for missing values
+    :return: tuple numpy.ndarray, numpy.ndarray, numpy.ndarray
+        Matrix with each feature scaled to mean 0 and std 1 (missing values
+        are set to the mean, i.e 0), means and stds of features
+    """
+
+    x_data = np.asarray(x_data, dtype=float)
+    present = ~np.isnan(x_data)
+    counts = np.maximum(present.sum(axis=0), 1)
+    means = np.where(present, x_data, 0.0).sum(axis=0) / counts
+    deviations = np.where(present, x_data - means, 0.0)
+    stds = np.sqrt((deviations ** 2).sum(axis=0) / counts)
+    stds = np.where(stds > 0, stds, 1.0)  # constant features stay 0
+    return deviations / stds, means, stds
+
+
+class ClusteringResult(object):
+    """ Fitted clusters of data """
+
+    def __init__(self, n_clusters, labels, centers, inertia, silhouette,
+                 means, stds):
+        """
+        :param n_clusters: int
+            Number of clusters
+        :param labels: numpy.ndarray
+            Cluster of each row
+        :param centers: numpy.ndarray
+            Centers of clusters (standardised features)
+        :param inertia: float
+            Sum of squared distances of rows to their centers
+        :param silhouette: float
+            Silhouette score (None if undefined)
+        :param means: numpy.ndarray
+            Means of features (to convert centers back to original units)
+        :param stds: numpy.ndarray
+            Stds of features (to convert centers back to original units)
+        """
+
+        object.__init__(self)
+
+        self.n_clusters = n_clusters
+        self.labels = labels
+        self.centers = centers
+        self.inertia = inertia
+        self.silhouette = silhouette
+        self.means = means
+        self.stds = stds
+
+    def get_original_centers(self):
+        """
+        :return: numpy.ndarray
+            Centers of clusters in original units of features
+        """
+
+        return self.centers * self.stds + self.means
+
+    def to_dict(self):
+        """
+        :return: dict
+            Scores of clusters
+        """
+
+        return {
+            "n_clusters": self.n_clusters,
+            "inertia": self.inertia,
+            "silhouette": self.silhouette
+        }
+
+
+def fit_clusters(z_data, n_clusters, mini_batch, random_state=0):
+    """
+    :param z_data: numpy.ndarray
+        Standardised matrix (rows x features)
+    :param n_clusters: int
+        Number of clusters
+    :param mini_batch: bool
+        Fit MiniBatchKMeans (faster on large data) instead of KMeans
+    :param random_state: int
+        Seed of fit
+    :return: tuple numpy.ndarray, numpy.ndarray, float, float
+        Labels, centers, inertia and silhouette score of clusters
+    """
+
+    from sklearn import cluster, metrics
+
+    model_class = cluster.MiniBatchKMeans if mini_batch else cluster.KMeans
+    model = model_class(n_clusters=n_clusters, random_state=random_state)
+    model.fit(z_data)
+
+    silhouette = None
+    if 1 < n_clusters < z_data.shape[0] and \
+            len(np.unique(model.labels_)) > 1:
+        silhouette = float(metrics.silhouette_score(
+            z_data, model.labels_,
+            sample_size=min(SILHOUETTE_SAMPLE_SIZE, z_data.shape[0]),
+            random_state=random_state
+        ))
+
+    return model.labels_, model.cluster_centers_, float(model.inertia_), \
+        silhouette
+
+
+def _fit_clusters(args):
+    return fit_clusters(*args)
+
+
+class ClusteringService(object):
+    """
+    Clusters standardised data with KMeans (MiniBatchKMeans on large data).
+    Fitted clusters are cached by hash of data and parameters, in memory and
+    optionally on disk.
+    """
+
+    def __init__(self, cache_folder=None,
+                 mini_batch_min_rows=MINI_BATCH_MIN_ROWS, random_state=0):
+        """
+        :param cache_folder: str
+            Folder where to save fitted clusters, None to keep them in memory
+        :param mini_batch_min_rows: int
+            Fit MiniBatchKMeans on data with at least these rows
+        :param random_state: int
+            Seed of fits
+        """
+
+        object.__init__(self)
+
+        self.cache_folder = cache_folder
+        self.mini_batch_min_rows = mini_batch_min_rows
+        self.random_state = random_state
+        self._results = {}  # key -> ClusteringResult
+
+        if self.cache_folder and not os.path.exists(self.cache_folder):
+            os.makedirs(self.cache_folder)
+
+    def _is_mini_batch(self, x_data):
+        return x_data.shape[0] >= self.mini_batch_min_rows
+
+    def get_key(self, x_data, n_clusters):
+        """
+        :param x_data: numpy.ndarray
+            Float matrix (rows x features)
+        :param n_clusters: int
+            Number of clusters
+        :return: str
+            Unique key of data and parameters of fit
+        """
+
+        x_data = np.ascontiguousarray(x_data, dtype=float)
+        h = hashlib.sha1()
+        h.update(str(x_data.shape).encode("utf-8"))
+        h.update(x_data.tobytes())
+        h.update(str((n_clusters, self._is_mini_batch(x_data),
+                      self.random_state)).encode("utf-8"))
+        return h.hexdigest()
+
+    def _get_cache_file(self, key):
+        return os.path.join(self.cache_folder, key + CACHE_FILE_EXTENSION)
+
+    def _get_cached(self, key):
+        if key in self._results:
+            return self._results[key]
+
+        if self.cache_folder:
+            try:
+                with open(self._get_cache_file(key), "rb") as i:
+                    self._results[key] = pickle.load(i)
+                    return self._results[key]
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass  # not fitted yet
+
+        return None
+
+    def _cache(self, key, result):
+        self._results[key] = result
+        if self.cache_folder:
+            tmp_file = self._get_cache_file(key) + "." + str(os.getpid())
+            with open(tmp_file, "wb") as o:
+                pickle.dump(result, o)
+            os.replace(tmp_file, self._get_cache_file(key))
+
+    def fit(self, x_data, n_clusters):
+        """
+        :param x_data: numpy.ndarray
+            Float matrix (rows x features), NaN for missing values
+        :param n_clusters: int
+            Number of clusters
+        :return: ClusteringResult
+            Clusters of standardised data (fitted only once for the same
+            data and parameters)
+        """
+
+        return self.sweep(x_data, [n_clusters], workers=1)[0]
+
+    def sweep(self, x_data, ks, workers=None):
+        """
+        :param x_data: numpy.ndarray
+            Float matrix (rows x features), NaN for missing values
+        :param ks: [] of int
+            Numbers of clusters to try
+        :param workers: int
+            Number of processes (None: all cores)
+        :return: [] of ClusteringResult
+            Clusters of standardised data for each number of clusters (see
+            inertia and silhouette scores to choose one). Fits not in cache
+            run in parallel
+        """
+
+        x_data = np.asarray(x_data, dtype=float)
+        z_data, means, stds = standardize(x_data)
+        mini_batch = self._is_mini_batch(x_data)
+
+        keys = [self.get_key(x_data, k) for k in ks]
+        results = {k: self._get_cached(key) for k, key in zip(ks, keys)}
+        to_fit = [k for k in ks if results[k] is None]
+
+        tasks = [(z_data, k, mini_batch, self.random_state) for k in to_fit]
+        if len(tasks) > 1 and workers != 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                fits = list(executor.map(_fit_clusters, tasks))
+        else:
+            fits = [_fit_clusters(t) for t in tasks]
+
+        for k, (labels, centers, inertia, silhouette) in zip(to_fit, fits):
+            results[k] = ClusteringResult(k, labels, centers, inertia,
+                                          silhouette, means, stds)
+            self._cache(keys[ks.index(k)], results[k])
+
+        return [results[k] for k in ks]
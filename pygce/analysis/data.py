@@ -0,0 +1,478 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Loads pygce csv files into typed numpy arrays """
+
+import csv
+import json
+import os
+
+import numpy as np
+
+from pygce.models.garmin import utils
+
+MISSING_VALUES = ["", "None", "none", "nan", "NaN", "--"]  # parsed as NaN
+TIME_WIDTH = 8  # chars in hh:mm:ss
+DATE_HEADER = "date"
+DEFAULT_CHUNK_ROWS = 10000  # rows parsed at once when streaming files
+SIDECAR_VERSION = 2  # bump when parsing changes: old sidecars are ignored
+SIDECAR_DATA_EXTENSION = ".npy"  # float matrix (memory-mapped when loaded)
+SIDECAR_META_EXTENSION = ".npz"  # headers, dates and signature of csv file
+
+
+class Dataset(object):
+    """ Numeric columns of a data file, with dates of rows (if any) """
+
+    def __init__(self, headers, data, dates=None):
+        """
+        :param headers: [] of str
+            Column names of data
+        :param data: numpy.ndarray
+            Float matrix (rows x columns), missing values are NaN
+        :param dates: numpy.ndarray
+            Date (datetime64[D]) of each row, None if data has no dates
+        """
+
+        object.__init__(self)
+
+        self.headers = list(headers)
+        self.data = data
+        self.dates = dates
+        self._indices = {h: i for i, h in enumerate(self.headers)}
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def get_index(self, header):
+        """
+        :param header: str
+            Column name
+        :return: int
+            Index of column in data
+        """
+
+        try:
+            return self._indices[header]
+        except KeyError:
+            raise ValueError("No column " + str(header) + " in data")
+
+    def get_column(self, header):
+        """
+        :param header: str
+            Column name
+        :return: numpy.ndarray
+            Values of column
+        """
+
+        return self.data[:, self.get_index(header)]
+
+    def get_matrix(self, headers, rows=None):
+        """
+        :param headers: [] of str
+            Column names
+        :param rows: numpy.ndarray
+            Bool mask (or indices) of rows to get, None to get all rows
+        :return: numpy.ndarray
+            Matrix (rows x columns) with values of columns
+        """
+
+        columns = [self.get_index(h) for h in headers]
+        matrix = self.data[:, columns]
+        if rows is not None:
+            matrix = matrix[rows]
+
+        return matrix
+
+    def get_complete_rows(self, headers):
+        """
+        :param headers: [] of str
+            Column names
+        :return: numpy.ndarray
+            Bool mask of rows with a value in each of the columns
+        """
+
+        return ~np.isnan(self.get_matrix(headers)).any(axis=1)
+
+
+def parse_floats(values):
+    """
+    :param values: numpy.ndarray
+        Raw str values
+    :return: numpy.ndarray
+        Float values, NaN if missing or malformed
+    """
+
+    values = np.char.strip(np.asarray(values, dtype=str))
+    parsed = np.full(values.shape, np.nan)
+    present = ~np.isin(values, MISSING_VALUES)
+
+    try:
+        parsed[present] = values[present].astype(np.float64)
+    except ValueError:  # some values are not numbers: find them one by one
+        for i in np.flatnonzero(present):
+            try:
+                parsed[i] = float(values[i])
+            except ValueError:
+                pass  # NaN
+
+    return parsed
+
+
+def parse_malformed_floats(values):
+    """
+    :param values: numpy.ndarray
+        Raw str values of numbers written like 123.949,99
+    :return: numpy.ndarray
+        Float values, NaN if missing or malformed
+    """
+
+    values = np.char.strip(np.asarray(values, dtype=str))
+    values = np.char.replace(np.char.replace(values, ".", ""), ",", ".")
+    return parse_floats(values)
+
+
+def _parse_times_by_position(values):
+    """
+    :param values: numpy.ndarray
+        Raw str values (at most TIME_WIDTH chars long)
+    :return: tuple numpy.ndarray, numpy.ndarray
+        Bool mask of values in the form hh:mm:ss, mm:ss or ss, and their
+        seconds (found by looking at digits by position, all values at once)
+    """
+
+    chars = np.char.rjust(values, TIME_WIDTH).astype(
+        "U" + str(TIME_WIDTH)
+    ).view(np.uint32).reshape(-1, TIME_WIDTH)  # right-aligned hh:mm:ss
+    is_digit = (chars >= ord("0")) & (chars <= ord("9"))
+    is_space = chars == ord(" ")
+    is_colon = chars == ord(":")
+
+    separators = np.zeros(TIME_WIDTH, dtype=bool)
+    separators[[2, 5]] = True
+    valid = (is_digit | is_space | is_colon).all(axis=1)
+    valid &= ~(is_colon[:, ~separators]).any(axis=1)  # colons where expected
+    valid &= ~(is_digit[:, separators]).any(axis=1)
+    valid &= ~(is_colon[:, 2] & ~is_colon[:, 5])  # hh: only with :ss
+    valid &= ~(is_space & np.maximum.accumulate(~is_space, axis=1)).any(
+        axis=1)  # spaces only before the value
+
+    digits = np.where(is_digit, chars.astype(np.int64) - ord("0"), 0)
+    seconds = (digits[:, 0] * 10 + digits[:, 1]) * 3600.0 + \
+              (digits[:, 3] * 10 + digits[:, 4]) * 60.0 + \
+              (digits[:, 6] * 10 + digits[:, 7])
+    return valid, seconds
+
+
+def _split_fractions(values):
+    """
+    :param values: numpy.ndarray
+        Raw str values of times, maybe with fractions of seconds (e.g
+        01:02:03.5)
+    :return: tuple numpy.ndarray, numpy.ndarray
+        Values without fractions, and fractions (0 if none, NaN if malformed)
+    """
+
+    if values.size == 0:
+        return values, np.zeros(values.shape)
+
+    parts = np.char.partition(values, ".")
+    has_fraction = parts[..., 1] == "."
+    fractions = np.zeros(values.shape)
+    if has_fraction.any():
+        digits = parts[..., 2][has_fraction]
+        fractions[has_fraction] = np.where(
+            np.char.isdigit(digits) | (digits == ""),
+            parse_floats(np.char.add("0.", digits)), np.nan
+        )
+
+    return np.where(has_fraction, parts[..., 0], values), fractions
+
+
+def parse_seconds(values):
+    """
+    :param values: numpy.ndarray
+        Raw str values of times in the form hh:mm:ss, mm:ss or ss (maybe with
+        fractions of seconds, as durations and paces of activities)
+    :return: numpy.ndarray
+        Seconds in times, NaN if missing or malformed. Values are converted
+        all at once; only values in other forms are parsed one by one (with
+        utils.get_seconds)
+    """
+
+    values = np.char.strip(np.asarray(values, dtype=str))
+    parsed = np.full(values.shape, np.nan)
+    present = ~np.isin(values, MISSING_VALUES)
+    values, fractions = _split_fractions(values)
+
+    fast = np.flatnonzero(present & (np.char.str_len(values) <= TIME_WIDTH))
+    if fast.size:
+        valid, seconds = _parse_times_by_position(values[fast])
+        parsed[fast[valid]] = seconds[valid]
+        fast = fast[valid]
+
+    for i in np.setdiff1d(np.flatnonzero(present), fast):  # other forms
+        try:
+            parsed[i] = utils.get_seconds(values[i])
+        except ValueError:
+            pass  # NaN
+
+    return parsed + fractions
+
+
+def parse_dates(values):
+    """
+    :param values: numpy.ndarray
+        Raw str values of dates in the form yyyy-mm-dd
+    :return: numpy.ndarray
+        Dates (datetime64[D]), NaT if missing or malformed
+    """
+
+    values = np.char.strip(np.asarray(values, dtype=str))
+    try:
+        return values.astype("datetime64[D]")
+    except ValueError:
+        dates = np.full(values.shape, np.datetime64("NaT"), "datetime64[D]")
+        for i, value in enumerate(values):
+            try:
+                dates[i] = np.datetime64(value, "D")
+            except ValueError:
+                pass  # NaT
+
+        return dates
+
+
+def read_csv_columns(dataset_file):
+    """
+    :param dataset_file: str
+        Path to csv file
+    :return: tuple [], [] of numpy.ndarray
+        Headers of csv file and raw str values of each column
+    """
+
+    with open(dataset_file, "r", newline="") as i:
+        reader = csv.reader(i)
+        headers = next(reader, [])
+        rows = [row for row in reader if row]
+
+    width = len(headers)
+    rows = [
+        row[:width] + [""] * (width - len(row)) for row in rows
+    ]  # same number of values in each row
+    columns = [np.array(c, dtype=str) for c in zip(*rows)] if rows else \
+        [np.array([], dtype=str) for _ in headers]
+    return headers, columns
+
+
+def parse_column(header, values, time_headers=(),
+                 malformed_float_headers=()):
+    """
+    :param header: str
+        Column name
+    :param values: numpy.ndarray
+        Raw str values of column
+    :param time_headers: [] of str
+        Columns with times (hh:mm:ss) to convert to seconds
+    :param malformed_float_headers: [] of str
+        Columns with numbers written like 123.949,99
+    :return: numpy.ndarray
+        Float values of column
+    """
+
+    if header in time_headers:
+        return parse_seconds(values)
+
+    if header in malformed_float_headers:
+        return parse_malformed_floats(values)
+
+    return parse_floats(values)
+
+
+def iter_csv_chunks(dataset_file, headers, chunk_rows=DEFAULT_CHUNK_ROWS,
+                    time_headers=(), malformed_float_headers=()):
+    """
+    :param dataset_file: str
+        Path to csv file
+    :param headers: [] of str
+        Columns to read
+    :param chunk_rows: int
+        Max rows in each chunk
+    :param time_headers: [] of str
+        Columns with times (hh:mm:ss) to convert to seconds
+    :param malformed_float_headers: [] of str
+        Columns with numbers written like 123.949,99
+    :return: generator of numpy.ndarray
+        Float matrices (rows x headers) of consecutive rows of file: only one
+        chunk at a time is in memory, whatever the size of the file
+    """
+
+    with open(dataset_file, "r", newline="") as i:
+        reader = csv.reader(i)
+        file_headers = next(reader, [])
+        columns = []
+        for h in headers:
+            if h not in file_headers:
+                raise ValueError("No column " + str(h) + " in data")
+            columns.append(file_headers.index(h))
+
+        def parse_chunk(rows):
+            return np.column_stack([
+                parse_column(
+                    h,
+                    [row[c] if c < len(row) else "" for row in rows],
+                    time_headers,
+                    malformed_float_headers
+                ) for h, c in zip(headers, columns)
+            ]) if headers else np.empty((len(rows), 0))
+
+        rows = []
+        for row in reader:
+            if row:
+                rows.append(row)
+
+            if len(rows) == chunk_rows:
+                yield parse_chunk(rows)
+                rows = []
+
+        if rows:
+            yield parse_chunk(rows)
+
+
+def load_csv(dataset_file, time_headers=(), malformed_float_headers=(),
+             date_header=DATE_HEADER):
+    """
+    :param dataset_file: str
+        Path to csv file
+    :param time_headers: [] of str
+        Columns with times (hh:mm:ss) to convert to seconds
+    :param malformed_float_headers: [] of str
+        Columns with numbers written like 123.949,99
+    :param date_header: str
+        Column with date of rows
+    :return: Dataset
+        Every column (but dates) converted to float, missing values are NaN
+    """
+
+    raw_headers, columns = read_csv_columns(dataset_file)
+
+    headers, data, dates = [], [], None
+    for header, values in zip(raw_headers, columns):
+        if header == date_header:
+            dates = parse_dates(values)
+            continue
+
+        data.append(parse_column(header, values, time_headers,
+                                 malformed_float_headers))
+        headers.append(header)
+
+    n_rows = len(columns[0]) if columns else 0
+    matrix = np.column_stack(data) if data else np.empty((n_rows, 0))
+    return Dataset(headers, matrix, dates)
+
+
+def get_sidecar_files(dataset_file):
+    """
+    :param dataset_file: str
+        Path to csv file
+    :return: tuple str, str
+        Paths of files (next to csv file) with parsed matrix and its metadata
+    """
+
+    return dataset_file + SIDECAR_DATA_EXTENSION, \
+        dataset_file + SIDECAR_META_EXTENSION
+
+
+def get_signature(dataset_file, options):
+    """
+    :param dataset_file: str
+        Path to csv file
+    :param options: {}
+        Options used to parse file
+    :return: str
+        Changes when file (size or last modification) or options change
+    """
+
+    stats = os.stat(dataset_file)
+    return json.dumps({
+        "version": SIDECAR_VERSION,
+        "size": stats.st_size,
+        "mtime": stats.st_mtime_ns,
+        "options": options
+    }, sort_keys=True)
+
+
+def _load_sidecar(dataset_file, signature):
+    data_file, meta_file = get_sidecar_files(dataset_file)
+    try:
+        with np.load(meta_file, allow_pickle=False) as meta:
+            if str(meta["signature"]) != signature:
+                return None  # csv file changed
+
+            headers = [str(h) for h in meta["headers"]]
+            dates = meta["dates"] if bool(meta["has_dates"]) else None
+
+        data = np.load(data_file, mmap_mode="r", allow_pickle=False)
+    except (OSError, ValueError, KeyError):
+        return None  # no (valid) sidecar
+
+    if data.ndim != 2 or data.shape[1] != len(headers) or \
+            (dates is not None and len(dates) != data.shape[0]):
+        return None  # malformed sidecar
+
+    return Dataset(headers, data, dates)
+
+
+def _save_sidecar(dataset_file, signature, dataset):
+    data_file, meta_file = get_sidecar_files(dataset_file)
+    suffix = "." + str(os.getpid()) + ".tmp"
+    try:
+        with open(data_file + suffix, "wb") as o:
+            np.save(o, np.ascontiguousarray(dataset.data))
+
+        with open(meta_file + suffix, "wb") as o:
+            np.savez(
+                o,
+                signature=np.array(signature),
+                headers=np.array(dataset.headers, dtype=str),
+                has_dates=np.array(dataset.dates is not None),
+                dates=dataset.dates if dataset.dates is not None else
+                np.array([], dtype="datetime64[D]")
+            )
+
+        os.replace(data_file + suffix, data_file)
+        os.replace(meta_file + suffix, meta_file)  # valid only if data is
+    except OSError:
+        for f in (data_file + suffix, meta_file + suffix):
+            if os.path.exists(f):
+                os.remove(f)  # e.g read-only folder: just do not cache
+
+
+def load_cached_csv(dataset_file, time_headers=(), malformed_float_headers=(),
+                    date_header=DATE_HEADER):
+    """
+    :param dataset_file: str
+        Path to csv file
+    :param time_headers: [] of str
+        Columns with times (hh:mm:ss) to convert to seconds
+    :param malformed_float_headers: [] of str
+        Columns with numbers written like 123.949,99
+    :param date_header: str
+        Column with date of rows
+    :return: Dataset
+        Like load_csv, but parsed data is saved next to csv file: until csv
+        file changes (size or last modification), later calls memory-map it
+        instead of parsing csv file again
+    """
+
+    options = {
+        "time_headers": sorted(time_headers),
+        "malformed_float_headers": sorted(malformed_float_headers),
+        "date_header": date_header
+    }
+    signature = get_signature(dataset_file, options)
+    dataset = _load_sidecar(dataset_file, signature)
+    if dataset is None:
+        dataset = load_csv(dataset_file, time_headers,
+                           malformed_float_headers, date_header)
+        _save_sidecar(dataset_file, signature, dataset)
+
+    return dataset
@@ -0,0 +1,243 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Rolling-window, lag and delta features of daily data """
+
+import numpy as np
+
+from pygce.analysis.data import Dataset
+
+ROLLING_STATS = ["mean", "sum", "std", "min", "max"]
+DEFAULT_WINDOWS = [7, 30]  # days
+FEATURE_SEPARATOR = "@"  # e.g STEPS:total@mean7, STEPS:total@lag1
+
+
+def get_feature_name(header, kind, days):
+    """
+    :param header: str
+        Column name
+    :param kind: str
+        Rolling stat, lag or delta
+    :param days: int
+        Window, lag or delta days
+    :return: str
+        Name of feature column
+    """
+
+    return header + FEATURE_SEPARATOR + kind + str(days)
+
+
+def fill_calendar(dataset):
+    """
+    :param dataset: Dataset
+        Data with dates of rows
+    :return: Dataset
+        Data with one row per calendar day, from first to last date: days
+        missing in data (gaps) are rows of NaN, rows without date are
+        dropped, duplicated dates keep the last row
+    """
+
+    if dataset.dates is None:
+        raise ValueError("Cannot compute daily features of data without dates")
+
+    known = ~np.isnat(dataset.dates)
+    dates = dataset.dates[known]
+    if dates.size == 0:
+        return Dataset(dataset.headers, dataset.data[:0],
+                       dataset.dates[:0])
+
+    start = dates.min()
+    days = (dates - start).astype(int)
+    data = np.full((int(days.max()) + 1, dataset.data.shape[1]), np.nan)
+    data[days] = dataset.data[known]
+    calendar = start + np.arange(data.shape[0])
+    return Dataset(dataset.headers, data, calendar)
+
+
+def _rolling_moments(values, window):
+    """
+    :return: tuple numpy.ndarray x 4
+        Counts, sums, sums of squares and sums of values of each window
+        (squares and last sums of values shifted by their mean, for
+        precision), from cumulative sums: O(n) whatever the window
+    """
+
+    values = np.asarray(values, dtype=float)
+    present = ~np.isnan(values)
+    shift = values[present].mean() if present.any() else 0.0  # precision
+    shifted = np.where(present, values - shift, 0.0)
+
+    def window_sums(x):
+        cum = np.concatenate((np.zeros(window), np.cumsum(x)))
+        return cum[window:] - cum[:-window]  # i: sum of x[i - w + 1: i + 1]
+
+    counts = window_sums(present.astype(float))
+    sums = window_sums(shifted)
+    squares = window_sums(shifted ** 2)
+    return counts, sums + counts * shift, squares, sums
+
+
+def _rolling_extreme(values, window, extreme):
+    """
+    :return: numpy.ndarray
+        Max (or min) of each window, via prefix and suffix extremes of blocks
+        of window size (van Herk / Gil-Werman): O(n) whatever the window
+    """
+
+    n = values.shape[0]
+    padded = np.concatenate((np.full(window - 1, np.nan), values))
+    blocks = -(-padded.shape[0] // window)
+    padded = np.concatenate(
+        (padded, np.full(blocks * window - padded.shape[0], np.nan))
+    ).reshape(blocks, window)
+
+    prefix = extreme.accumulate(padded, axis=1).ravel()
+    suffix = extreme.accumulate(padded[:, ::-1], axis=1)[:, ::-1].ravel()
+    starts = np.arange(n)  # window of row i starts at i in padded values
+    return extreme(suffix[starts], prefix[starts + window - 1])
+
+
+def rolling(values, window, stat, min_periods=1):
+    """
+    :param values: numpy.ndarray
+        Values of consecutive days, NaN for missing values
+    :param window: int
+        Days in window (each day and the previous window - 1 days)
+    :param stat: str
+        Stat of window, one of ROLLING_STATS
+    :param min_periods: int
+        Min values in window to compute stat (NaN otherwise)
+    :return: numpy.ndarray
+        Stat of window ending at each day (missing values are skipped)
+    """
+
+    if window < 1:
+        raise ValueError("Window must be at least 1 day")
+
+    values = np.asarray(values, dtype=float)
+    counts, sums, squares, shifted_sums = _rolling_moments(values, window)
+    if stat == "sum":
+        result = sums
+    elif stat == "mean":
+        result = sums / np.maximum(counts, 1)
+    elif stat == "std":  # sample std (ddof = 1)
+        variances = (squares - shifted_sums ** 2 / np.maximum(counts, 1)) / \
+            np.maximum(counts - 1, 1)
+        result = np.sqrt(np.maximum(variances, 0.0))
+        result[counts < 2] = np.nan
+    elif stat == "max":
+        result = _rolling_extreme(values, window, np.fmax)
+    elif stat == "min":
+        result = _rolling_extreme(values, window, np.fmin)
+    else:
+        raise ValueError("Unknown rolling stat " + str(stat) +
+                         ". Choose among " + ", ".join(ROLLING_STATS))
+
+    return np.where(counts >= max(min_periods, 1), result, np.nan)
+
+
+def lag(values, days):
+    """
+    :param values: numpy.ndarray
+        Values of consecutive days
+    :param days: int
+        Days to look back
+    :return: numpy.ndarray
+        Value of days before each day (NaN if unknown)
+    """
+
+    values = np.asarray(values, dtype=float)
+    lagged = np.full(values.shape, np.nan)
+    if days < values.shape[0]:
+        lagged[days:] = values[:values.shape[0] - days]
+
+    return lagged
+
+
+def delta(values, days):
+    """
+    :param values: numpy.ndarray
+        Values of consecutive days
+    :param days: int
+        Days to look back
+    :return: numpy.ndarray
+        Change of value since days before each day (NaN if unknown)
+    """
+
+    return np.asarray(values, dtype=float) - lag(values, days)
+
+
+class FeatureEngine(object):
+    """
+    Computes features of each day from the days before it. Data is first
+    spread on the calendar, so that windows and lags are calendar days, and
+    missing days (gaps) count as missing values instead of being skipped.
+    """
+
+    def __init__(self, dataset):
+        """
+        :param dataset: Dataset
+            Daily data (with dates)
+        """
+
+        object.__init__(self)
+
+        self.dataset = fill_calendar(dataset)
+
+    def get_features(self, headers, windows=DEFAULT_WINDOWS,
+                     stats=ROLLING_STATS, lags=(1,), deltas=(1,),
+                     min_periods=1):
+        """
+        :param headers: [] of str
+            Columns to compute features of
+        :param windows: [] of int
+            Days of rolling windows
+        :param stats: [] of str
+            Stats of rolling windows, among ROLLING_STATS
+        :param lags: [] of int
+            Days of lags
+        :param deltas: [] of int
+            Days of deltas
+        :param min_periods: int
+            Min values in window to compute rolling stats
+        :return: Dataset
+            Feature columns (named like STEPS:total@mean7) of each calendar
+            day
+        """
+
+        names, columns = [], []
+        for header in headers:
+            values = self.dataset.get_column(header)
+            for window in windows:
+                for stat in stats:
+                    names.append(get_feature_name(header, stat, window))
+                    columns.append(rolling(values, window, stat, min_periods))
+
+            for days in lags:
+                names.append(get_feature_name(header, "lag", days))
+                columns.append(lag(values, days))
+
+            for days in deltas:
+                names.append(get_feature_name(header, "delta", days))
+                columns.append(delta(values, days))
+
+        data = np.column_stack(columns) if columns else \
+            np.empty((len(self.dataset), 0))
+        return Dataset(names, data, self.dataset.dates)
+
+    def build(self, headers, **kwargs):
+        """
+        :param headers: [] of str
+            Columns to compute features of
+        :param kwargs: {}
+            Options of get_features
+        :return: Dataset
+            Columns of data followed by their features, for each calendar day
+        """
+
+        features = self.get_features(headers, **kwargs)
+        return Dataset(
+            self.dataset.headers + features.headers,
+            np.hstack((self.dataset.data, features.data)),
+            self.dataset.dates
+        )
@@ -0,0 +1,389 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Reads .gpx tracks into numpy arrays and summarises them in bulk """
+
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from xml.etree import ElementTree
+
+import numpy as np
+
+EARTH_RADIUS_METERS = 6371008.8  # mean radius
+TRACK_VERSION = 2  # bump when parsing changes: old track files are ignored
+TRACK_EXTENSION = ".npz"  # track saved next to .gpx file
+GPX_EXTENSION = ".gpx"
+DEFAULT_MIN_SPEED = 0.5  # m/s: slower segments are pauses
+DEFAULT_MAX_GAP_SECONDS = 60  # longer segments without points are pauses
+DEFAULT_SPLIT_METERS = 1000
+SUMMARY_FIELDS = [
+    "file", "start", "points", "distance", "duration", "moving_time",
+    "elevation_gain", "elevation_loss", "min_elevation", "max_elevation",
+    "avg_speed", "moving_speed"
+]
+
+
+def _get_tag(element):
+    return element.tag.rsplit("}", 1)[-1]  # without namespace
+
+
+def parse_times(values):
+    """
+    :param values: [] of str
+        ISO 8601 times (e.g 2019-07-01T08:00:00Z), empty if missing
+    :return: numpy.ndarray
+        Seconds since epoch (UTC) of times, NaN if missing or malformed
+    """
+
+    values = np.char.strip(np.asarray(values, dtype=str))
+    if values.size == 0:
+        return np.zeros(0)
+
+    seconds = np.full(values.shape, np.nan)
+    utc = np.char.rstrip(values, "Z")
+    slow = (np.char.find(utc, "+") >= 0) | \
+        (np.char.rfind(utc, "-") > 10)  # offsets (e.g +02:00)
+    fast = np.flatnonzero(~slow & (utc != ""))
+    try:
+        times = utc[fast].astype("datetime64[ms]")
+        seconds[fast] = np.where(np.isnat(times), np.nan,
+                                 times.astype(np.int64) / 1000.0)
+    except ValueError:  # malformed: one by one
+        slow[fast] = True
+
+    for i in np.flatnonzero(slow):
+        try:
+            time = datetime.fromisoformat(values[i].replace("Z", "+00:00"))
+            if time.tzinfo is None:
+                time = time.replace(tzinfo=timezone.utc)
+
+            seconds[i] = time.timestamp()
+        except ValueError:
+            pass  # NaN
+
+    return seconds
+
+
+class Track(object):
+    """ Points of a track: latitude, longitude, elevation and time """
+
+    def __init__(self, lat, lon, ele, time, segments=None):
+        """
+        :param lat: numpy.ndarray
+            Latitude (degrees) of points
+        :param lon: numpy.ndarray
+            Longitude (degrees) of points
+        :param ele: numpy.ndarray
+            Elevation (meters) of points, NaN if unknown
+        :param time: numpy.ndarray
+            Seconds since epoch of points, NaN if unknown
+        :param segments: numpy.ndarray
+            Index of first point of each track segment, None if all points
+            are one segment
+        """
+
+        object.__init__(self)
+
+        self.lat = lat
+        self.lon = lon
+        self.ele = ele
+        self.time = time
+        if segments is None:
+            segments = np.zeros(1 if len(lat) else 0, dtype=np.int64)
+        self.segments = np.asarray(segments, dtype=np.int64)
+
+    def __len__(self):
+        return self.lat.shape[0]
+
+    @staticmethod
+    def from_gpx(gpx_file):
+        """
+        :param gpx_file: str
+            Path to .gpx file
+        :return: Track
+            Points of all track segments of file, streamed (elements are
+            freed as soon as they are read)
+        """
+
+        lat, lon, ele, time, segments = [], [], [], [], []
+        point_ele, point_time = "", ""
+        segment = None  # element holding points read so far
+        new_segment = True  # next point starts a track segment
+        for event, element in ElementTree.iterparse(
+                gpx_file, events=("start", "end")):
+            tag = _get_tag(element)
+            if event == "start":
+                if tag == "trkseg":
+                    segment, new_segment = element, True
+                elif tag == "trkpt":
+                    point_ele, point_time = "", ""  # not of a wpt or rtept
+                    if new_segment:
+                        segments.append(len(lat))
+                        new_segment = False
+            elif tag == "ele":
+                point_ele = element.text or ""
+            elif tag == "time":
+                point_time = element.text or ""
+            elif tag == "trkpt":
+                lat.append(element.get("lat", ""))
+                lon.append(element.get("lon", ""))
+                ele.append(point_ele)
+                time.append(point_time)
+                point_ele, point_time = "", ""
+                if segment is not None:
+                    segment.clear()  # free points already read
+            elif tag in ("metadata", "trkseg"):
+                point_ele, point_time = "", ""  # not of a point
+                element.clear()
+
+        return Track(
+            np.array(lat, dtype=float), np.array(lon, dtype=float),
+            np.array([e or "nan" for e in ele], dtype=float),
+            parse_times(time), segments
+        )
+
+    def save(self, output_file, signature=""):
+        """
+        :param output_file: str
+            Path where to save track (.npz)
+        :param signature: str
+            Signature of source file (to know when it changes)
+        :return: void
+            Saves points in a compact binary file
+        """
+
+        tmp_file = output_file + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_file, "wb") as o:
+            np.savez_compressed(
+                o, version=np.array(TRACK_VERSION),
+                signature=np.array(signature), lat=self.lat, lon=self.lon,
+                ele=self.ele.astype(np.float32), time=self.time,
+                segments=self.segments
+            )
+        os.replace(tmp_file, output_file)
+
+    @staticmethod
+    def load(input_file, signature=None):
+        """
+        :param input_file: str
+            Path to track saved with save()
+        :param signature: str
+            Signature of source file, None to not check it
+        :return: Track
+            Saved track, None if it is not valid (or source changed)
+        """
+
+        try:
+            with np.load(input_file, allow_pickle=False) as saved:
+                if int(saved["version"]) != TRACK_VERSION or \
+                        (signature is not None and
+                         str(saved["signature"]) != signature):
+                    return None
+
+                return Track(saved["lat"], saved["lon"],
+                             saved["ele"].astype(float), saved["time"],
+                             saved["segments"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def get_breaks(self):
+        """
+        :return: numpy.ndarray
+            True for each pair of consecutive points in different track
+            segments (e.g device paused or lost signal in between)
+        """
+
+        breaks = np.zeros(max(len(self) - 1, 0), dtype=bool)
+        starts = self.segments[(self.segments > 0) &
+                               (self.segments < len(self))]
+        breaks[starts - 1] = True
+        return breaks
+
+    def get_distances(self):
+        """
+        :return: numpy.ndarray
+            Length (meters) of each segment between consecutive points
+            (haversine, all at once), 0 between track segments
+        """
+
+        lat, lon = np.radians(self.lat), np.radians(self.lon)
+        a = np.sin(np.diff(lat) / 2.0) ** 2 + \
+            np.cos(lat[:-1]) * np.cos(lat[1:]) * \
+            np.sin(np.diff(lon) / 2.0) ** 2
+        distances = 2.0 * EARTH_RADIUS_METERS * np.arcsin(
+            np.sqrt(np.clip(a, 0.0, 1.0)))
+        distances[self.get_breaks()] = 0.0
+        return distances
+
+    def get_elevation_changes(self):
+        """
+        :return: tuple float, float
+            Elevation gain and loss (meters), skipping unknown elevations
+        """
+
+        ele = self.ele[~np.isnan(self.ele)]
+        changes = np.diff(ele)
+        return float(changes[changes > 0].sum()), \
+            float(-changes[changes < 0].sum())
+
+    def get_moving_time(self, min_speed=DEFAULT_MIN_SPEED,
+                        max_gap_seconds=DEFAULT_MAX_GAP_SECONDS):
+        """
+        :param min_speed: float
+            Min speed (m/s) of moving segments
+        :param max_gap_seconds: float
+            Max seconds between points of moving segments
+        :return: float
+            Seconds spent moving
+        """
+
+        seconds = np.diff(self.time)
+        distances = self.get_distances()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            moving = (seconds > 0) & (seconds <= max_gap_seconds) & \
+                (distances / seconds >= min_speed) & ~self.get_breaks()
+
+        return float(seconds[moving].sum())
+
+    def get_splits(self, split_meters=DEFAULT_SPLIT_METERS):
+        """
+        :param split_meters: float
+            Length of splits (e.g 1000 for km splits)
+        :return: numpy.ndarray
+            Seconds taken by each full split (times interpolated at split
+            boundaries), not counting time between track segments
+        """
+
+        known = ~np.isnan(self.time)
+        if known.sum() < 2:
+            return np.zeros(0)
+
+        distances = np.concatenate(([0.0], np.cumsum(self.get_distances())))
+        segment = np.cumsum(np.concatenate(([0], self.get_breaks())))
+        distances, segment = distances[known], segment[known]
+        seconds = np.diff(self.time[known])
+        seconds[segment[1:] != segment[:-1]] = 0.0  # between segments
+        times = np.concatenate(([0.0], np.cumsum(seconds)))
+        boundaries = np.arange(0.0, distances[-1] + 1e-9, split_meters)
+        return np.diff(np.interp(boundaries, distances, times))
+
+    def summarize(self, min_speed=DEFAULT_MIN_SPEED,
+                  max_gap_seconds=DEFAULT_MAX_GAP_SECONDS):
+        """
+        :param min_speed: float
+            Min speed (m/s) of moving segments
+        :param max_gap_seconds: float
+            Max seconds between points of moving segments
+        :return: {}
+            Distance (meters), duration and moving time (seconds), elevation
+            gain and loss (meters), speeds (m/s) of track
+        """
+
+        distance = float(self.get_distances().sum())
+        known_times = self.time[~np.isnan(self.time)]
+        duration = float(known_times.max() - known_times.min()) \
+            if known_times.size else 0.0
+        moving_time = self.get_moving_time(min_speed, max_gap_seconds)
+        gain, loss = self.get_elevation_changes()
+        known_ele = self.ele[~np.isnan(self.ele)]
+        return {
+            "start": str(np.datetime64(int(known_times.min()), "s"))
+            if known_times.size else "",
+            "points": len(self),
+            "distance": distance,
+            "duration": duration,
+            "moving_time": moving_time,
+            "elevation_gain": gain,
+            "elevation_loss": loss,
+            "min_elevation": float(known_ele.min()) if known_ele.size else
+            float("nan"),
+            "max_elevation": float(known_ele.max()) if known_ele.size else
+            float("nan"),
+            "avg_speed": distance / duration if duration > 0 else 0.0,
+            "moving_speed": distance / moving_time if moving_time > 0 else
+            0.0
+        }
+
+
+def get_signature(gpx_file):
+    """
+    :param gpx_file: str
+        Path to .gpx file
+    :return: str
+        Changes when file (size or last modification) changes
+    """
+
+    stats = os.stat(gpx_file)
+    return str(stats.st_size) + ":" + str(stats.st_mtime_ns)
+
+
+def load_track(gpx_file, use_cache=True):
+    """
+    :param gpx_file: str
+        Path to .gpx file
+    :param use_cache: bool
+        Save track (.npz) next to .gpx file, and load it until .gpx file
+        changes
+    :return: Track
+        Points of track
+    """
+
+    if not use_cache:
+        return Track.from_gpx(gpx_file)
+
+    track_file = gpx_file + TRACK_EXTENSION
+    signature = get_signature(gpx_file)
+    track = Track.load(track_file, signature)
+    if track is None:
+        track = Track.from_gpx(gpx_file)
+        try:
+            track.save(track_file, signature)
+        except OSError:
+            pass  # e.g read-only folder: just do not cache
+
+    return track
+
+
+def _summarize_file(gpx_file):
+    summary = load_track(gpx_file).summarize()
+    summary["file"] = gpx_file
+    return summary
+
+
+def summarize_folder(folder, workers=None):
+    """
+    :param folder: str
+        Folder with .gpx files
+    :param workers: int
+        Number of processes (None: all cores)
+    :return: [] of {}
+        Summary of each track (sorted by file), read on a process pool
+    """
+
+    files = sorted(
+        os.path.join(folder, f) for f in os.listdir(folder)
+        if f.lower().endswith(GPX_EXTENSION)
+    )
+    if len(files) < 2 or workers == 1:
+        return [_summarize_file(f) for f in files]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_summarize_file, files, chunksize=16))
+
+
+def save_summaries(summaries, output_file):
+    """
+    :param summaries: [] of {}
+        Summaries of tracks
+    :param output_file: str
+        Path where to save summaries (.csv)
+    :return: void
+        Saves one row per track
+    """
+
+    with open(output_file, "w", newline="") as o:
+        writer = csv.DictWriter(o, SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(summaries)
@@ -2,30 +2,51 @@
 # -*- coding: utf-8 -*-
 
 
-import matplotlib.pyplot as plt
-import numpy as np
-from hal.charts.bar import create_symlog_bar_chart, create_multiple_bar_chart
-from hal.files.models import Document
-from hal.ml.analysis import correlation
-from hal.ml.data.parser import parse_csv_file
-from hal.ml.utils import matrix as m_utils
-from sklearn import linear_model, cluster, feature_selection
+import os
 
 from pygce.models.garmin import utils
 
+# matplotlib, numpy, sklearn and hal are slow to import: they are imported
+# by each method, only when needed
+
+
+def show_chart(output_file=None):
+    """
+    :param output_file: str
+        Path where to save chart image, None to show it
+    :return: void
+        Shows current chart, or saves it (and frees it) to output file
+    """
+
+    import matplotlib.pyplot as plt
+
+    if output_file is None:
+        plt.show()
+    else:
+        plt.savefig(output_file, bbox_inches="tight")
+        plt.close("all")
+
 
 class GarminDataFilter(object):
     """ Parses and fixes raw data """
 
-    def __init__(self, dataset_file):
+    TIME_HEADERS_TO_CONVERT = []  # columns to convert from time to seconds
+    HEADERS_WITH_MALFORMED_FLOATS = []  # columns with malformed floats
+
+    def __init__(self, dataset_file, use_sidecar=True):
         """
         :param dataset_file: str
             Path to folder with data to analyse
+        :param use_sidecar: bool
+            Save parsed data next to data file, and use it (memory-mapped)
+            until data file changes
         """
 
         object.__init__(self)
 
         self.dataset_file = dataset_file
+        self.use_sidecar = use_sidecar
+        self._dataset = None  # parsed data, loaded once
 
     def parse_csv(self):
         """
@@ -33,8 +54,30 @@ class GarminDataFilter(object):
             Headers of csv file and data
         """
 
+        from hal.ml.data.parser import parse_csv_file
+
         return parse_csv_file(self.dataset_file)
 
+    def load_data(self):
+        """
+        :return: Dataset
+            Data file as a float matrix (times converted to seconds, floats
+            fixed, missing values as NaN) with column names and dates. Data
+            file is parsed only once
+        """
+
+        from pygce.analysis.data import load_cached_csv, load_csv
+
+        if self._dataset is None:
+            load = load_cached_csv if self.use_sidecar else load_csv
+            self._dataset = load(
+                self.dataset_file,
+                time_headers=self.TIME_HEADERS_TO_CONVERT,
+                malformed_float_headers=self.HEADERS_WITH_MALFORMED_FLOATS
+            )
+
+        return self._dataset
+
     @staticmethod
     def convert_time_columns(headers, headers_to_convert, data):
         """
@@ -80,44 +123,100 @@ class GarminDataFilter(object):
 class StatsAnalysis(GarminDataFilter):
     """ Computes correlation of data"""
 
-    def __init__(self, dataset_file):
+    def __init__(self, dataset_file, use_sidecar=True):
         """
         :param dataset_file: str
             Path to folder with data to analyse
+        :param use_sidecar: bool
+            Save parsed data next to data file, and use it (memory-mapped)
+            until data file changes
         """
 
-        GarminDataFilter.__init__(self, dataset_file)
+        GarminDataFilter.__init__(self, dataset_file, use_sidecar)
 
-    def show_correlation_matrix(self, title_image, headers_to_analyze):
+    def show_correlation_matrix(self, title_image, headers_to_analyze,
+                                output_file=None):
         """
         :param title_image: str
             Title of output image
         :param headers_to_analyze: [] of str
             Compute correlation matrix of only these headers
+        :param output_file: str
+            Path where to save chart image, None to show it
         :return: void
             Shows correlation matrix of data of files in folder
         """
 
+        import matplotlib.pyplot as plt
+        import numpy as np
+
         print("Computing correlation matrix of file ", str(self.dataset_file))
-        headers, data = self.parse_csv()  # parse raw data
-        correlation.show_correlation_matrix_of_columns(
-            title_image,
-            headers_to_analyze,  # headers to test
-            headers,
-            data
+        matrix = self.get_correlation(
+            headers_to_analyze).get_correlation_matrix()
+
+        fig, ax = plt.subplots()
+        image = ax.imshow(matrix, interpolation="nearest",
+                          cmap=plt.get_cmap("jet", 30), vmin=-1, vmax=1)
+        ax.set_xticks(list(range(len(headers_to_analyze))))
+        ax.set_xticklabels(headers_to_analyze, rotation=90)
+        ax.set_yticks(list(range(len(headers_to_analyze))))
+        ax.set_yticklabels(headers_to_analyze)
+        fig.colorbar(image, ticks=np.linspace(-1, 1, 21))
+        plt.title(title_image)
+        show_chart(output_file)
+
+    def get_correlation(self, headers_to_analyze):
+        """
+        :param headers_to_analyze: [] of str
+            Compute correlation matrix of only these headers
+        :return: OnlineCorrelation
+            Correlation stats of columns of typed data (parsed column by
+            column, and cached next to data file)
+        """
+
+        from pygce.analysis.online import OnlineCorrelation
+
+        dataset = self.load_data()
+        return OnlineCorrelation(headers_to_analyze).update(
+            dataset.get_matrix(headers_to_analyze)
+        )
+
+    def compute_correlation(self, headers_to_analyze, chunk_rows=None):
+        """
+        :param headers_to_analyze: [] of str
+            Compute correlation matrix of only these headers
+        :param chunk_rows: int
+            Rows to read at once (None for default)
+        :return: OnlineCorrelation
+            Correlation stats of columns, computed reading the file chunk by
+            chunk (so in constant memory). Stats can be merged with the ones
+            of other files
+        """
+
+        from pygce.analysis.data import DEFAULT_CHUNK_ROWS
+        from pygce.analysis.online import OnlineCorrelation
+
+        return OnlineCorrelation(headers_to_analyze).update_from_csv(
+            self.dataset_file,
+            chunk_rows or DEFAULT_CHUNK_ROWS,
+            time_headers=self.TIME_HEADERS_TO_CONVERT,
+            malformed_float_headers=self.HEADERS_WITH_MALFORMED_FLOATS
         )
 
 
 class MLAnalysis(GarminDataFilter):
     """ Carries out popular machine-learning tasks on Garmin data """
 
-    def __init__(self, dataset_file):
+    def __init__(self, dataset_file, use_sidecar=True):
         """
         :param dataset_file: str
             Path to folder with data to analyse
+        :param use_sidecar: bool
+            Save parsed data next to data file, and use it (memory-mapped)
+            until data file changes
         """
 
-        GarminDataFilter.__init__(self, dataset_file)
+        GarminDataFilter.__init__(self, dataset_file, use_sidecar)
 
 
 class TimelineDataAnalysis(StatsAnalysis):
@@ -151,13 +250,20 @@ class TimelineDataAnalysis(StatsAnalysis):
         "ACTIVITIES:duration"
     ]  # columns of data file to convert from time format to float
 
-    def __init__(self, dataset_file):
+    def __init__(self, dataset_file, use_sidecar=True):
         """
         :param dataset_file: str
             Path to folder with data to analyse
+        :param use_sidecar: bool
+            Save parsed data next to data file, and use it (memory-mapped)
+            until data file changes
         """
 
-        StatsAnalysis.__init__(self, dataset_file)
+        StatsAnalysis.__init__(self, dataset_file, use_sidecar)
+
+        self._clustering = None  # fits clusters, once per data and params
+        self._regression = None  # fits regressions of all columns at once
+        self._scores = None  # scores of all pairs of columns
 
     def parse_csv(self):
         """
@@ -170,39 +276,65 @@ class TimelineDataAnalysis(StatsAnalysis):
                                          data)
         return headers, data
 
-    def show_correlation_matrix_of_data(self):
+    def show_correlation_matrix_of_data(self, output_file=None):
         """
+        :param output_file: str
+            Path where to save chart image, None to show it
         :return: void
             Shows correlation matrix of data of files in folder
         """
 
+        from hal.files.models import Document
+
         self.show_correlation_matrix(
             "Garmin timeline data " + Document(self.dataset_file).name.strip(),
-            self.HEADERS_TO_ANALYZE)
+            self.HEADERS_TO_ANALYZE, output_file)
+
+    def get_regression(self, state_file=None):
+        """
+        :param state_file: str
+            Path to regression stats (.npz) of previous runs: only days after
+            the last one there are added, then stats are saved back. None to
+            fit on the whole data file
+        :return: IncrementalRegression
+            Linear regressions of each column to analyse on the others
+        """
+
+        from pygce.analysis.regression import IncrementalRegression
+
+        if self._regression is None or \
+                self._regression.headers != self.HEADERS_TO_ANALYZE:
+            regression = None
+            if state_file is not None and os.path.exists(state_file):
+                regression = IncrementalRegression.load(state_file)
+                if regression.headers != self.HEADERS_TO_ANALYZE:
+                    regression = None  # other columns: start over
+
+            if regression is None:
+                regression = IncrementalRegression(self.HEADERS_TO_ANALYZE)
+
+            regression.update_from_dataset(self.load_data())
+            if state_file is not None:
+                regression.save(state_file)
 
-    def predict_feature(self, feature):
+            self._regression = regression
+
+        return self._regression
+
+    def predict_feature(self, feature, output_file=None):
         """
         :param feature: str
             Name of feature (column name) to predict
+        :param output_file: str
+            Path where to save chart image, None to show it
         :return: void
-            Predicts feature with linear regression
+            Predicts feature with linear regression (on all other columns)
         """
 
+        from hal.charts.bar import create_symlog_bar_chart
+
         print("Predicting ", feature, "with data from file", self.dataset_file)
-        headers, raw_data = self.parse_csv()  # get columns names and raw data
-        clf = linear_model.LinearRegression()  # model to fit data
-        x_matrix_features = self.HEADERS_TO_ANALYZE.copy()
-        x_matrix_features.remove(
-            feature)  # do NOT include feature to predict in input matrix
-        x_data = m_utils.get_subset_of_matrix(x_matrix_features, headers,
-                                              raw_data)  # input matrix
-        y_data = m_utils.get_subset_of_matrix([feature], headers,
-                                              raw_data)  # output matrix
-        clf.fit(x_data, y_data)
-
-        coefficients = {}  # dict feature -> coefficient
-        for i in range(len(x_matrix_features)):
-            coefficients[x_matrix_features[i]] = clf.coef_[0][i]
+        _, coefficients, _ = self.get_regression().solve(feature)
 
         chart = create_symlog_bar_chart(
             "Linear fit of " + feature,
@@ -210,12 +342,103 @@ class TimelineDataAnalysis(StatsAnalysis):
             coefficients.values(),
             "Coefficient"
         )
-        plt.show()
+        show_chart(output_file)
+
+    def add_features(self, windows=None, lags=(1,), deltas=(1,)):
+        """
+        :param windows: [] of int
+            Days of rolling windows (None: 7 and 30 days)
+        :param lags: [] of int
+            Days of lags
+        :param deltas: [] of int
+            Days of deltas
+        :return: [] of str
+            Adds rolling stats, lags and deltas of columns to analyse to data
+            (one row per calendar day) and to columns to analyse, so that
+            the following regressions and clusters use trends too. Returns
+            names of new columns
+        """
+
+        from pygce.analysis.features import DEFAULT_WINDOWS, FeatureEngine
+
+        engine = FeatureEngine(self.load_data())
+        self._dataset = engine.build(
+            self.HEADERS_TO_ANALYZE, windows=windows or DEFAULT_WINDOWS,
+            lags=lags, deltas=deltas
+        )
+        features = self._dataset.headers[len(engine.dataset.headers):]
+        self.HEADERS_TO_ANALYZE = self.HEADERS_TO_ANALYZE + features
+        return features
 
-    def cluster_analyze(self, n_clusters=6):
+    def get_clustering(self):
+        """
+        :return: ClusteringService
+            Service that fits (and caches) clusters of data
+        """
+
+        from pygce.analysis.clustering import ClusteringService
+
+        if self._clustering is None:
+            self._clustering = ClusteringService()
+
+        return self._clustering
+
+    def get_clusters(self, n_clusters=6):
         """
         :param n_clusters: int
             Number of clusters
+        :return: tuple numpy.ndarray, numpy.ndarray, ClusteringResult
+            Rows clustered (days with all values), their data and clusters
+            of standardised data (fitted only once)
+        """
+
+        dataset = self.load_data()  # get columns names and data
+        rows = dataset.get_complete_rows(self.HEADERS_TO_ANALYZE)
+        x_data = dataset.get_matrix(self.HEADERS_TO_ANALYZE, rows)  # input
+        return rows, x_data, self.get_clustering().fit(x_data, n_clusters)
+
+    def cluster_sweep(self, ks=range(2, 11), workers=None, output_file=None):
+        """
+        :param ks: [] of int
+            Numbers of clusters to try
+        :param workers: int
+            Number of processes (None: all cores)
+        :param output_file: str
+            Path where to save chart image, None to show it
+        :return: [] of {}
+            Inertia and silhouette score of each number of clusters. Plots
+            them, to choose the number of clusters
+        """
+
+        import matplotlib.pyplot as plt
+
+        print("Sweeping clusters of file", self.dataset_file)
+        dataset = self.load_data()  # get columns names and data
+        rows = dataset.get_complete_rows(self.HEADERS_TO_ANALYZE)
+        x_data = dataset.get_matrix(self.HEADERS_TO_ANALYZE, rows)  # input
+        results = self.get_clustering().sweep(x_data, list(ks), workers)
+        scores = [r.to_dict() for r in results]
+
+        fig, inertia_ax = plt.subplots()
+        inertia_ax.plot([s["n_clusters"] for s in scores],
+                        [s["inertia"] for s in scores], "o-", color="b")
+        inertia_ax.set_xlabel("clusters")
+        inertia_ax.set_ylabel("inertia", color="b")
+        silhouette_ax = inertia_ax.twinx()
+        silhouette_ax.plot([s["n_clusters"] for s in scores],
+                           [s["silhouette"] for s in scores], "o-", color="r")
+        silhouette_ax.set_ylabel("silhouette", color="r")
+
+        plt.title("Clusters of " + str(len(x_data)) + " days")
+        show_chart(output_file)
+        return scores
+
+    def cluster_analyze(self, n_clusters=6, output_file=None):
+        """
+        :param n_clusters: int
+            Number of clusters
+        :param output_file: str
+            Path where to save chart image, None to show it
         :return: void
             Computes cluster analysis: see days based on differences.
             Each day is different from one another, there are days where you trained more, others where you ate more ...
@@ -223,13 +446,12 @@ class TimelineDataAnalysis(StatsAnalysis):
             This way, the input matrix consists of multiple vectors with each one consisting of one day's values.
         """
 
+        from hal.charts.bar import create_multiple_bar_chart
+
         print("Clustering file", self.dataset_file)
-        headers, raw_data = self.parse_csv()  # get columns names and raw data
-        x_data = m_utils.get_subset_of_matrix(self.HEADERS_TO_ANALYZE, headers,
-                                              raw_data)  # input matrix
-        kmeans = cluster.KMeans(n_clusters=n_clusters, random_state=0).fit(
-            x_data)
-        print("Clusters", kmeans.labels_)
+        dataset = self.load_data()  # get columns names and data
+        rows, _, clusters = self.get_clusters(n_clusters)
+        print("Clusters", clusters.labels)
 
         headers_to_plot = [
             "SUMMARY:kcal_count",
@@ -237,14 +459,12 @@ class TimelineDataAnalysis(StatsAnalysis):
             "SLEEP:deep_sleep_time",
             "ACTIVITIES:distance"
         ]  # get headers to add to chart
-        vals_headers = [
-            [float(row[headers.index(h)]) for row in raw_data] for h in
-            headers_to_plot
-        ]  # get values for each header
+        vals_headers = list(
+            dataset.get_matrix(headers_to_plot, rows).T
+        )  # get values for each header
         headers_to_plot.append("cluster")  # add cluster group
-        vals_headers.append(kmeans.labels_)
-        days = [str(row[headers.index("date")]) for row in
-                raw_data]  # get list of days (x values)
+        vals_headers.append(clusters.labels)
+        days = [str(d) for d in dataset.dates[rows]]  # get list of days
 
         chart = create_multiple_bar_chart(
             "Days",
@@ -252,24 +472,24 @@ class TimelineDataAnalysis(StatsAnalysis):
             vals_headers,
             headers_to_plot
         )  # create chart
-        plt.show()  # show bar chart
+        show_chart(output_file)  # show bar chart
 
-    def cluster_3d_plot(self, labels, n_clusters=6):
+    def cluster_3d_plot(self, labels, n_clusters=6, output_file=None):
         """
         :param labels: [] of str (len = 3)
             Features to cluster data. Each item must be in the csv data file. Each label is one of x, y, z axis
         :param n_clusters: int
             Number of clusters
+        :param output_file: str
+            Path where to save chart image, None to show it
         :return: void
             Plots 3D chart with clusters based on selected features
         """
 
+        import matplotlib.pyplot as plt
+
         print("Clustering file", self.dataset_file)
-        headers, raw_data = self.parse_csv()  # get columns names and raw data
-        x_data = m_utils.get_subset_of_matrix(self.HEADERS_TO_ANALYZE, headers,
-                                              raw_data)  # input matrix
-        kmeans = cluster.KMeans(n_clusters=n_clusters, random_state=0).fit(
-            x_data)
+        _, x_data, clusters = self.get_clusters(n_clusters)
 
         fig = plt.figure(figsize=(4, 3))  # create 3D plot
         ax = fig.add_subplot(111, projection="3d")
@@ -278,10 +498,10 @@ class TimelineDataAnalysis(StatsAnalysis):
             # get values of given labels
             x_data[:, self.HEADERS_TO_ANALYZE.index(labels[1])],
             x_data[:, self.HEADERS_TO_ANALYZE.index(labels[2])],
-            c=kmeans.labels_.astype(np.float)
+            c=clusters.labels.astype(float)
         )  # plot 3D data points
 
-        centroids = kmeans.cluster_centers_
+        centroids = clusters.get_original_centers()  # in units of data
         cluster_centers = []  # list of centers of each cluster
         for i in range(n_clusters):
             cl_center = {
@@ -312,43 +532,65 @@ class TimelineDataAnalysis(StatsAnalysis):
         ax.set_zlabel(labels[2])
 
         plt.title(str(n_clusters) + "-clustering data")
-        plt.show()
+        show_chart(output_file)
 
-    def select_k_best(self, feature, k=5):
+    def get_feature_scores(self, scores_file=None):
+        """
+        :param scores_file: str
+            Path where to cache scores (.npz): they are computed only if it
+            does not exist yet (or has other columns). None to not cache
+        :return: FeatureScores
+            F-score and mutual information of each pair of columns to
+            analyse, computed at once
+        """
+
+        from pygce.analysis.scoring import FeatureScores
+
+        if self._scores is None or \
+                self._scores.headers != self.HEADERS_TO_ANALYZE:
+            scores = None
+            if scores_file is not None and os.path.exists(scores_file):
+                scores = FeatureScores.load(scores_file)
+                if scores.headers != self.HEADERS_TO_ANALYZE:
+                    scores = None
+
+            if scores is None:
+                dataset = self.load_data()  # get columns names and data
+                scores = FeatureScores.from_data(
+                    self.HEADERS_TO_ANALYZE,
+                    dataset.get_matrix(self.HEADERS_TO_ANALYZE)
+                )
+                if scores_file is not None:
+                    scores.save(scores_file)
+
+            self._scores = scores
+
+        return self._scores
+
+    def select_k_best(self, feature, k=5, output_file=None):
         """
         :param feature: str
             Name of feature (column name) to predict
         :param k: int
             Number of features to select
-        :return: void
-            Selects the best features to predict feature
+        :param output_file: str
+            Path where to save chart image, None to show it
+        :return: [] of {}
+            Selects the best features to predict feature (by F-score, as
+            f_regression) and returns them with their scores
         """
 
+        from hal.charts.bar import create_symlog_bar_chart
+
         print("Selecting k best features of data file", self.dataset_file)
-        headers, raw_data = self.parse_csv()  # get columns names and raw data
-        sel = feature_selection.SelectKBest(feature_selection.f_regression,
-                                            k=k)  # model to select data
-        x_matrix_features = self.HEADERS_TO_ANALYZE.copy()  # not edit main list of headers
-        x_matrix_features.remove(
-            feature)  # do NOT include feature to predict in input matrix
-        x_data = m_utils.get_subset_of_matrix(x_matrix_features, headers,
-                                              raw_data)  # input matrix
-        y_data = m_utils.get_subset_of_matrix([feature], headers,
-                                              raw_data)  # output matrix
-        sel.fit(x_data, y_data)  # fit
-
-        top_k_features_indices = np.array(sel.scores_).argsort()[-k:][
-                                 ::-1]  # indices of top k features
-        top_k_features = [x_matrix_features[i] for i in
-                          top_k_features_indices]  # names of top k features
-        top_k_features_scores = [sel.scores_[i] for i in
-                                 top_k_features_indices]  # scores of top k features
+        top_k = self.get_feature_scores().rank(feature)[:k]
 
         chart = create_symlog_bar_chart(
             "Most " + str(k) + " correlated features with " + feature,
-            top_k_features,
-            top_k_features_scores, "score")
-        plt.show()
+            [r["feature"] for r in top_k],
+            [r["f_score"] for r in top_k], "score")
+        show_chart(output_file)
+        return top_k
 
 
 class ActivitiesDataAnalysis(StatsAnalysis):
@@ -377,13 +619,16 @@ class ActivitiesDataAnalysis(StatsAnalysis):
         "Training Effect"
     ]  # columns with malformed floats values
 
-    def __init__(self, dataset_file):
+    def __init__(self, dataset_file, use_sidecar=True):
         """
         :param dataset_file: str
             Path to folder with data to analyse
+        :param use_sidecar: bool
+            Save parsed data next to data file, and use it (memory-mapped)
+            until data file changes
         """
 
-        StatsAnalysis.__init__(self, dataset_file)
+        StatsAnalysis.__init__(self, dataset_file, use_sidecar)
 
     def parse_csv(self):
         """
@@ -398,12 +643,16 @@ class ActivitiesDataAnalysis(StatsAnalysis):
                                data)
         return headers, data
 
-    def shows_correlation_matrix_of_data(self):
+    def shows_correlation_matrix_of_data(self, output_file=None):
         """
+        :param output_file: str
+            Path where to save chart image, None to show it
         :return: void
             Shows correlation matrix of data of files in folder
         """
 
+        from hal.files.models import Document
+
         self.show_correlation_matrix("Garmin activities data " + Document(
             self.dataset_file).name.strip(),
-                                     self.HEADERS_TO_ANALYZE)
+                                     self.HEADERS_TO_ANALYZE, output_file)
@@ -0,0 +1,199 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Correlation of columns, updated chunk by chunk in constant memory """
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pygce.analysis.data import DEFAULT_CHUNK_ROWS, iter_csv_chunks
+
+
+def _divide(a, b):
+    return np.divide(a, b, out=np.zeros_like(a, dtype=float), where=b > 0)
+
+
+class OnlineCorrelation(object):
+    """
+    Running means and co-moments (Welford style) of each pair of columns.
+    Missing values (NaN) are skipped pair by pair: stats of columns i, j are
+    computed over rows with a value in both. Partial states of different
+    chunks, files or processes can be merged.
+    """
+
+    def __init__(self, headers):
+        """
+        :param headers: [] of str
+            Column names
+        """
+
+        object.__init__(self)
+
+        self.headers = list(headers)
+        p = len(self.headers)
+        self.counts = np.zeros((p, p))  # rows with values in both i, j
+        self.means = np.zeros((p, p))  # [i, j]: mean of i on rows of i, j
+        self.squares = np.zeros((p, p))  # [i, j]: sum of squared deviations
+        self.comoments = np.zeros((p, p))  # sum of products of deviations
+
+    def _merge_stats(self, counts, means, squares, comoments):
+        total = self.counts + counts
+        delta = means - self.means
+        weight = _divide(self.counts * counts, total)
+
+        self.means = self.means + delta * _divide(counts, total)
+        self.squares = self.squares + squares + delta ** 2 * weight
+        self.comoments = self.comoments + comoments + \
+            delta * delta.T * weight
+        self.counts = total
+
+    def update(self, chunk):
+        """
+        :param chunk: numpy.ndarray
+            Float matrix (rows x columns), NaN for missing values
+        :return: OnlineCorrelation
+            Adds rows of chunk to stats (all pairs at once)
+        """
+
+        chunk = np.asarray(chunk, dtype=float)
+        if chunk.size == 0:
+            return self
+
+        present = ~np.isnan(chunk)
+        weights = present.astype(float)
+        shifts = _divide(np.where(present, chunk, 0.0).sum(axis=0),
+                         weights.sum(axis=0))  # column means of chunk
+        shifted = np.where(present, chunk - shifts, 0.0)  # better precision
+
+        counts = weights.T @ weights
+        sums = shifted.T @ weights  # [i, j]: sum of i on rows of i, j
+        shifted_means = _divide(sums, counts)
+        squares = (shifted ** 2).T @ weights - counts * shifted_means ** 2
+        comoments = shifted.T @ shifted - \
+            counts * shifted_means * shifted_means.T
+        means = np.where(counts > 0, shifted_means + shifts[:, None], 0.0)
+
+        self._merge_stats(counts, means, np.maximum(squares, 0.0), comoments)
+        return self
+
+    def merge(self, other):
+        """
+        :param other: OnlineCorrelation
+            Stats of other rows (same columns)
+        :return: OnlineCorrelation
+            Adds stats of other rows to these ones
+        """
+
+        if other.headers != self.headers:
+            raise ValueError("Cannot merge stats of different columns")
+
+        self._merge_stats(other.counts, other.means, other.squares,
+                          other.comoments)
+        return self
+
+    def update_from_csv(self, dataset_file, chunk_rows=DEFAULT_CHUNK_ROWS,
+                        time_headers=(), malformed_float_headers=()):
+        """
+        :param dataset_file: str
+            Path to csv file
+        :param chunk_rows: int
+            Rows to read at once
+        :param time_headers: [] of str
+            Columns with times (hh:mm:ss) to convert to seconds
+        :param malformed_float_headers: [] of str
+            Columns with numbers written like 123.949,99
+        :return: OnlineCorrelation
+            Adds rows of file to stats, reading one chunk at a time
+        """
+
+        for chunk in iter_csv_chunks(dataset_file, self.headers, chunk_rows,
+                                     time_headers, malformed_float_headers):
+            self.update(chunk)
+
+        return self
+
+    def get_correlation_matrix(self):
+        """
+        :return: numpy.ndarray
+            Pearson correlation of each pair of columns (NaN if undefined)
+        """
+
+        scale = np.sqrt(self.squares * self.squares.T)
+        matrix = np.full(scale.shape, np.nan)
+        defined = (scale > 0) & (self.counts > 1)
+        matrix[defined] = self.comoments[defined] / scale[defined]
+        np.fill_diagonal(matrix, np.where(np.diag(self.counts) > 1, 1.0,
+                                          np.nan))
+        return np.clip(matrix, -1.0, 1.0)
+
+    def save(self, output_file):
+        """
+        :param output_file: str
+            Path where to save stats (.npz)
+        :return: void
+            Saves stats, to be loaded and merged later
+        """
+
+        with open(output_file, "wb") as o:
+            np.savez(o, headers=np.array(self.headers, dtype=str),
+                     counts=self.counts, means=self.means,
+                     squares=self.squares, comoments=self.comoments)
+
+    @staticmethod
+    def load(input_file):
+        """
+        :param input_file: str
+            Path to stats saved with save()
+        :return: OnlineCorrelation
+            Saved stats
+        """
+
+        with np.load(input_file, allow_pickle=False) as saved:
+            stats = OnlineCorrelation([str(h) for h in saved["headers"]])
+            stats.counts = saved["counts"]
+            stats.means = saved["means"]
+            stats.squares = saved["squares"]
+            stats.comoments = saved["comoments"]
+
+        return stats
+
+
+def _correlate_file(args):
+    dataset_file, headers, chunk_rows, time_headers, malformed = args
+    return OnlineCorrelation(headers).update_from_csv(
+        dataset_file, chunk_rows, time_headers, malformed
+    )
+
+
+def correlate_files(dataset_files, headers, chunk_rows=DEFAULT_CHUNK_ROWS,
+                    time_headers=(), malformed_float_headers=(),
+                    workers=None):
+    """
+    :param dataset_files: [] of str
+        Paths to csv files
+    :param headers: [] of str
+        Columns to correlate
+    :param chunk_rows: int
+        Rows to read at once
+    :param time_headers: [] of str
+        Columns with times (hh:mm:ss) to convert to seconds
+    :param malformed_float_headers: [] of str
+        Columns with numbers written like 123.949,99
+    :param workers: int
+        Number of processes (None: all cores)
+    :return: OnlineCorrelation
+        Stats of all rows of all files: each file is streamed by a process,
+        then partial stats are merged
+    """
+
+    tasks = [
+        (f, list(headers), chunk_rows, list(time_headers),
+         list(malformed_float_headers)) for f in dataset_files
+    ]
+    stats = OnlineCorrelation(headers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for partial in executor.map(_correlate_file, tasks):
+            stats.merge(partial)
+
+    return stats
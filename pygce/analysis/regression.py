@@ -0,0 +1,221 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Linear regressions of every column on the others, updated day by day """
+
+import numpy as np
+
+
+class IncrementalRegression(object):
+    """
+    Keeps the Gram matrix [1, X]' [1, X] of the rows seen so far: adding a
+    row costs O(p^2), and one inversion of it solves the linear regressions
+    of each column on all the others (with intercept) at once. When columns
+    are collinear (the Gram matrix is singular), each regression is solved
+    by least squares instead. Rows with missing values are skipped.
+    """
+
+    def __init__(self, headers):
+        """
+        :param headers: [] of str
+            Column names
+        """
+
+        object.__init__(self)
+
+        self.headers = list(headers)
+        p = len(self.headers) + 1  # intercept
+        self.gram = np.zeros((p, p))
+        self.last_date = None  # date of last row added (if rows have dates)
+        self._solution = None  # cached until new rows are added
+
+    def __len__(self):
+        return int(self.gram[0, 0])
+
+    def update(self, rows, dates=None):
+        """
+        :param rows: numpy.ndarray
+            Float matrix (rows x columns), NaN for missing values
+        :param dates: numpy.ndarray
+            Dates of rows (datetime64[D]), None if unknown
+        :return: IncrementalRegression
+            Adds complete rows to the Gram matrix
+        """
+
+        rows = np.asarray(rows, dtype=float).reshape(-1, len(self.headers))
+        complete = ~np.isnan(rows).any(axis=1)
+        augmented = np.hstack((np.ones((int(complete.sum()), 1)),
+                               rows[complete]))
+        self.gram += augmented.T @ augmented
+        self._solution = None
+
+        if dates is not None and len(dates) > 0:
+            known = dates[~np.isnat(dates)]
+            if known.size:
+                last = known.max()
+                if self.last_date is None or last > self.last_date:
+                    self.last_date = last
+
+        return self
+
+    def update_from_dataset(self, dataset, only_new=True):
+        """
+        :param dataset: Dataset
+            Data with (at least) columns of regression
+        :param only_new: bool
+            Add only days after the last one added (if data has dates)
+        :return: IncrementalRegression
+            Adds rows of data
+        """
+
+        rows = None
+        if only_new and dataset.dates is not None and \
+                self.last_date is not None:
+            rows = dataset.dates > self.last_date
+
+        dates = dataset.dates
+        if dates is not None and rows is not None:
+            dates = dates[rows]
+
+        return self.update(dataset.get_matrix(self.headers, rows), dates)
+
+    def merge(self, other):
+        """
+        :param other: IncrementalRegression
+            Stats of other rows (same columns)
+        :return: IncrementalRegression
+            Adds stats of other rows to these ones
+        """
+
+        if other.headers != self.headers:
+            raise ValueError("Cannot merge stats of different columns")
+
+        self.gram += other.gram
+        self._solution = None
+        if other.last_date is not None and \
+                (self.last_date is None or other.last_date > self.last_date):
+            self.last_date = other.last_date
+
+        return self
+
+    def _solve(self):
+        """
+        :return: tuple numpy.ndarray, numpy.ndarray
+            Coefficients (column j: intercept then coefficients of the
+            regression of column j, 0 for itself) and r^2 of each column
+        """
+
+        if self._solution is None:
+            if len(self) <= len(self.headers) + 1:
+                raise ValueError("Not enough complete rows to fit: " +
+                                 str(len(self)))
+
+            scale = 1.0 / np.sqrt(np.where(np.diag(self.gram) > 0,
+                                           np.diag(self.gram), 1.0))
+            scaled = self.gram * np.outer(scale, scale)
+            n = self.gram[0, 0]
+            totals = np.diag(self.gram)[1:] - self.gram[0, 1:] ** 2 / n
+            if np.linalg.matrix_rank(scaled) == len(scaled):
+                precision = np.linalg.inv(scaled) * np.outer(scale, scale)
+
+                # regression of column j on others: -P[:, j] / P[j, j]
+                pivots = np.diag(precision)[1:]
+                coefficients = -precision[:, 1:] / pivots
+                coefficients[1:][np.diag_indices(len(self.headers))] = 0.0
+                residuals = 1.0 / pivots  # residual sum of squares
+            else:  # collinear columns (e.g percentages adding up to 100)
+                coefficients, residuals = self._solve_singular(scaled, scale)
+
+            r2 = np.where(totals > 0, 1.0 - residuals / np.where(
+                totals > 0, totals, 1.0), np.nan)
+            self._solution = coefficients, r2
+
+        return self._solution
+
+    def _solve_singular(self, scaled, scale):
+        """
+        :param scaled: numpy.ndarray
+            Gram matrix scaled to unit diagonal (singular)
+        :param scale: numpy.ndarray
+            Scale of each row and column of Gram matrix
+        :return: tuple numpy.ndarray, numpy.ndarray
+            Coefficients (like _solve) and residual sum of squares of each
+            column, solving the normal equations of each regression by least
+            squares: the inverse of the Gram matrix does not give them
+        """
+
+        p = len(scaled)
+        coefficients = np.zeros((p, p - 1))
+        residuals = np.zeros(p - 1)
+        for c in range(1, p):
+            others = np.arange(p) != c
+            solution = np.linalg.lstsq(scaled[np.ix_(others, others)],
+                                       scaled[others, c], rcond=None)[0]
+            beta = solution * scale[others] / scale[c]
+            coefficients[others, c - 1] = beta
+            residuals[c - 1] = max(
+                self.gram[c, c] - self.gram[others, c] @ beta, 0.0)
+
+        return coefficients, residuals
+
+    def solve(self, target):
+        """
+        :param target: str
+            Column to predict
+        :return: tuple float, {} of str -> float, float
+            Intercept, coefficient of each other column and r^2 of the
+            linear regression of target on all other columns
+        """
+
+        coefficients, r2 = self._solve()
+        j = self.headers.index(target)
+        column = coefficients[:, j]
+        return float(column[0]), {
+            h: float(column[i + 1]) for i, h in enumerate(self.headers)
+            if i != j
+        }, float(r2[j])
+
+    def solve_all(self):
+        """
+        :return: {} of str -> (float, {} of str -> float, float)
+            Intercept, coefficients and r^2 of the regression of each column
+            on the others (one matrix inversion for all of them)
+        """
+
+        return {h: self.solve(h) for h in self.headers}
+
+    def save(self, output_file):
+        """
+        :param output_file: str
+            Path where to save stats (.npz)
+        :return: void
+            Saves stats, to be loaded and updated with new days later
+        """
+
+        last_date = np.array(
+            [self.last_date if self.last_date is not None else "NaT"],
+            dtype="datetime64[D]"
+        )
+        with open(output_file, "wb") as o:
+            np.savez(o, headers=np.array(self.headers, dtype=str),
+                     gram=self.gram, last_date=last_date)
+
+    @staticmethod
+    def load(input_file):
+        """
+        :param input_file: str
+            Path to stats saved with save()
+        :return: IncrementalRegression
+            Saved stats
+        """
+
+        with np.load(input_file, allow_pickle=False) as saved:
+            regression = IncrementalRegression(
+                [str(h) for h in saved["headers"]]
+            )
+            regression.gram = saved["gram"]
+            last_date = saved["last_date"][0]
+            if not np.isnat(last_date):
+                regression.last_date = last_date
+
+        return regression
@@ -0,0 +1,227 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" F-scores and mutual information of every pair of columns at once """
+
+import csv
+import json
+
+import numpy as np
+
+from pygce.analysis.online import OnlineCorrelation
+
+DEFAULT_BINS = 10  # quantile bins of each column to estimate mutual info
+TABLE_FIELDS = ["target", "rank", "feature", "f_score", "mutual_info",
+                "rows"]
+
+
+def get_f_scores(correlation, counts):
+    """
+    :param correlation: numpy.ndarray
+        Correlation matrix of columns
+    :param counts: numpy.ndarray
+        Rows used to compute each correlation
+    :return: numpy.ndarray
+        F-score of univariate linear regression (as f_regression) of each
+        column (row) given each other (column): r^2 / (1 - r^2) * (n - 2)
+    """
+
+    r2 = np.nan_to_num(correlation, nan=0.0) ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = r2 / (1.0 - r2) * (counts - 2)
+
+    scores[(counts <= 2) | np.isnan(correlation)] = np.nan
+    np.fill_diagonal(scores, np.nan)
+    return scores
+
+
+def get_bins(data, bins=DEFAULT_BINS):
+    """
+    :param data: numpy.ndarray
+        Float matrix (rows x columns), NaN for missing values
+    :param bins: int
+        Number of bins of each column
+    :return: numpy.ndarray
+        Quantile bin (in [0, bins)) of each value, -1 if missing
+    """
+
+    present = ~np.isnan(data)
+    if not present.any():
+        return np.full(data.shape, -1)
+
+    quantiles = np.linspace(0, 1, bins + 1)[1:-1]
+    with np.errstate(invalid="ignore"):
+        edges = np.nanquantile(np.where(present.any(axis=0), data, 0.0),
+                               quantiles, axis=0)  # (bins - 1) x columns
+        indices = (data[:, :, None] > edges.T[None, :, :]).sum(axis=2)
+
+    return np.where(present, indices, -1)
+
+
+def get_mutual_info(data, bins=DEFAULT_BINS):
+    """
+    :param data: numpy.ndarray
+        Float matrix (rows x columns), NaN for missing values
+    :param bins: int
+        Number of quantile bins of each column
+    :return: tuple numpy.ndarray, numpy.ndarray
+        Mutual information (nats) of each pair of columns, from joint
+        histograms of all pairs computed at once (one-hot bins matrix
+        product), and rows with values in both columns
+    """
+
+    n, p = data.shape
+    indices = get_bins(data, bins)
+    one_hot = np.zeros((n, p * bins))
+    rows, columns = np.nonzero(indices >= 0)
+    one_hot[rows, columns * bins + indices[rows, columns]] = 1.0
+
+    joint = (one_hot.T @ one_hot).reshape(p, bins, p, bins)
+    joint = joint.transpose(0, 2, 1, 3)  # [i, j, bin of i, bin of j]
+    counts = joint.sum(axis=(2, 3))
+    x_marginals = joint.sum(axis=3, keepdims=True)  # over rows of both i, j
+    y_marginals = joint.sum(axis=2, keepdims=True)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = joint * counts[:, :, None, None] / (x_marginals * y_marginals)
+        terms = np.where(joint > 0, joint * np.log(ratios), 0.0)
+        info = terms.sum(axis=(2, 3)) / counts
+
+    info[counts == 0] = np.nan
+    return np.maximum(info, 0.0), counts
+
+
+class FeatureScores(object):
+    """ How much each column tells about each other one """
+
+    def __init__(self, headers, f_scores, mutual_info, counts):
+        """
+        :param headers: [] of str
+            Column names
+        :param f_scores: numpy.ndarray
+            [i, j]: F-score of regression of column i on column j
+        :param mutual_info: numpy.ndarray
+            [i, j]: mutual information of columns i and j
+        :param counts: numpy.ndarray
+            [i, j]: rows with values in both columns
+        """
+
+        object.__init__(self)
+
+        self.headers = list(headers)
+        self.f_scores = f_scores
+        self.mutual_info = mutual_info
+        self.counts = counts
+
+    @staticmethod
+    def from_data(headers, data, bins=DEFAULT_BINS):
+        """
+        :param headers: [] of str
+            Column names
+        :param data: numpy.ndarray
+            Float matrix (rows x columns), NaN for missing values
+        :param bins: int
+            Number of quantile bins of each column to estimate mutual info
+        :return: FeatureScores
+            Scores of all pairs of columns (missing values skipped pair by
+            pair)
+        """
+
+        stats = OnlineCorrelation(headers).update(data)
+        f_scores = get_f_scores(stats.get_correlation_matrix(), stats.counts)
+        mutual_info, counts = get_mutual_info(np.asarray(data, dtype=float),
+                                              bins)
+        return FeatureScores(headers, f_scores, mutual_info, counts)
+
+    def rank(self, target, by="f_score"):
+        """
+        :param target: str
+            Column to predict
+        :param by: str
+            Score to rank by: f_score or mutual_info
+        :return: [] of {}
+            Other columns, best first, with their scores
+        """
+
+        j = self.headers.index(target)
+        table = [
+            {
+                "target": target,
+                "feature": h,
+                "f_score": float(self.f_scores[j, i]),
+                "mutual_info": float(self.mutual_info[j, i]),
+                "rows": int(self.counts[j, i])
+            } for i, h in enumerate(self.headers) if i != j
+        ]
+        if by not in ("f_score", "mutual_info"):
+            raise ValueError("Cannot rank by " + str(by))
+
+        table.sort(key=lambda r: -np.inf if np.isnan(r[by]) else r[by],
+                   reverse=True)
+        for i, row in enumerate(table):
+            row["rank"] = i + 1
+
+        return table
+
+    def to_table(self, by="f_score"):
+        """
+        :param by: str
+            Score to rank by: f_score or mutual_info
+        :return: [] of {}
+            Ranked features of each target
+        """
+
+        return [row for h in self.headers for row in self.rank(h, by)]
+
+    def export(self, output_file, by="f_score"):
+        """
+        :param output_file: str
+            Path where to save ranked table (.csv or .json)
+        :param by: str
+            Score to rank by: f_score or mutual_info
+        :return: void
+            Saves ranked features of each target (scores that cannot be
+            computed, e.g of constant columns, are null in .json tables)
+        """
+
+        table = self.to_table(by)
+        with open(output_file, "w") as o:
+            if output_file.endswith(".json"):
+                table = [{
+                    k: None if isinstance(v, float) and not np.isfinite(v)
+                    else v for k, v in row.items()
+                } for row in table]  # NaN is not valid json
+                json.dump(table, o, indent=4, separators=(',', ': '),
+                          allow_nan=False)
+            else:
+                writer = csv.DictWriter(o, TABLE_FIELDS)
+                writer.writeheader()
+                writer.writerows(table)
+
+    def save(self, output_file):
+        """
+        :param output_file: str
+            Path where to save scores (.npz)
+        :return: void
+            Saves scores, to be loaded later
+        """
+
+        with open(output_file, "wb") as o:
+            np.savez(o, headers=np.array(self.headers, dtype=str),
+                     f_scores=self.f_scores, mutual_info=self.mutual_info,
+                     counts=self.counts)
+
+    @staticmethod
+    def load(input_file):
+        """
+        :param input_file: str
+            Path to scores saved with save()
+        :return: FeatureScores
+            Saved scores
+        """
+
+        with np.load(input_file, allow_pickle=False) as saved:
+            return FeatureScores(
+                [str(h) for h in saved["headers"]], saved["f_scores"],
+                saved["mutual_info"], saved["counts"]
+            )
@@ -0,0 +1,595 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Compact store of simplified tracks, indexed by bounding box """
+
+import heapq
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pygce.analysis.gpx import EARTH_RADIUS_METERS, GPX_EXTENSION, Track, \
+    get_signature
+
+STORE_VERSION = 2  # bump when encoding changes: tracks are stored again
+INDEX_FILE = "index.json"  # name, signature and bounding box of each track
+TRACK_EXTENSION = ".npz"
+COORD_SCALE = 1e5  # fixed point degrees: about 1 m
+ELEVATION_SCALE = 10.0  # fixed point meters: decimeters
+TIME_SCALE = 1.0  # fixed point seconds
+DEFAULT_TOLERANCE = 2.0  # meters
+DOUGLAS_PEUCKER = "douglas-peucker"
+VISVALINGAM = "visvalingam"
+METHODS = [DOUGLAS_PEUCKER, VISVALINGAM]
+FIELDS = [
+    ("lat", COORD_SCALE),
+    ("lon", COORD_SCALE),
+    ("ele", ELEVATION_SCALE),
+    ("time", TIME_SCALE)
+]  # field of Track, fixed point scale
+
+
+def project(lat, lon, lat0=None):
+    """
+    :param lat: numpy.ndarray
+        Latitude (degrees) of points
+    :param lon: numpy.ndarray
+        Longitude (degrees) of points
+    :param lat0: float
+        Latitude of projection (None: mean latitude of points)
+    :return: tuple numpy.ndarray, numpy.ndarray
+        Meters east and north of points (equirectangular projection, good
+        enough at the scale of a track)
+    """
+
+    if lat0 is None:
+        lat0 = float(np.mean(lat)) if len(lat) else 0.0
+
+    x = np.radians(lon) * EARTH_RADIUS_METERS * np.cos(np.radians(lat0))
+    y = np.radians(lat) * EARTH_RADIUS_METERS
+    return x, y
+
+
+def get_segment_distances(x, y, x0, y0, x1, y1):
+    """
+    :param x: numpy.ndarray
+        X of points
+    :param y: numpy.ndarray
+        Y of points
+    :param x0: float or numpy.ndarray
+        X of start of segments
+    :param y0: float or numpy.ndarray
+        Y of start of segments
+    :param x1: float or numpy.ndarray
+        X of end of segments
+    :param y1: float or numpy.ndarray
+        Y of end of segments
+    :return: numpy.ndarray
+        Distance of each point from segment
+    """
+
+    dx, dy = x1 - x0, y1 - y0
+    length = dx * dx + dy * dy
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(length > 0, ((x - x0) * dx + (y - y0) * dy) / length, 0.0)
+
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(x - (x0 + t * dx), y - (y0 + t * dy))
+
+
+def douglas_peucker(x, y, tolerance):
+    """
+    :param x: numpy.ndarray
+        X (meters) of points
+    :param y: numpy.ndarray
+        Y (meters) of points
+    :param tolerance: float
+        Max distance (meters) of dropped points from simplified track
+    :return: numpy.ndarray
+        Points to keep (bool)
+    """
+
+    n = len(x)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        distances = get_segment_distances(
+            x[start + 1:end], y[start + 1:end],
+            x[start], y[start], x[end], y[end]
+        )  # all points between ends at once
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = start + 1 + farthest
+            keep[middle] = True
+            stack.append((start, middle))
+            stack.append((middle, end))
+
+    return keep
+
+
+def get_triangle_areas(x, y):
+    """
+    :param x: numpy.ndarray
+        X of points
+    :param y: numpy.ndarray
+        Y of points
+    :return: numpy.ndarray
+        Area of triangle of each inner point with its neighbours
+    """
+
+    return 0.5 * np.abs(
+        (x[:-2] - x[2:]) * (y[1:-1] - y[:-2]) -
+        (x[:-2] - x[1:-1]) * (y[2:] - y[:-2])
+    )
+
+
+def visvalingam(x, y, tolerance):
+    """
+    :param x: numpy.ndarray
+        X (meters) of points
+    :param y: numpy.ndarray
+        Y (meters) of points
+    :param tolerance: float
+        Points whose triangle with neighbours is smaller than tolerance ** 2
+        (square meters) are dropped, smallest first
+    :return: numpy.ndarray
+        Points to keep (bool)
+    """
+
+    n = len(x)
+    keep = np.ones(n, dtype=bool)
+    if n < 3:
+        return keep
+
+    min_area = tolerance * tolerance
+    areas = np.full(n, np.inf)
+    areas[1:-1] = get_triangle_areas(x, y)
+    previous = np.arange(-1, n - 1)
+    following = np.arange(1, n + 1)
+    heap = [(a, i) for i, a in enumerate(areas[1:-1].tolist(), 1)]
+    heapq.heapify(heap)
+    while heap:
+        area, i = heapq.heappop(heap)
+        if area >= min_area:
+            break
+
+        if not keep[i] or area != areas[i]:
+            continue  # dropped, or area changed since it was pushed
+
+        keep[i] = False
+        p, f = previous[i], following[i]
+        following[p], previous[f] = f, p
+        for j in (p, f):  # neighbours get a new triangle
+            if 0 < j < n - 1:
+                pj, fj = previous[j], following[j]
+                new_area = 0.5 * abs(
+                    (x[pj] - x[fj]) * (y[j] - y[pj]) -
+                    (x[pj] - x[j]) * (y[fj] - y[pj])
+                )
+                areas[j] = max(new_area, area)  # never below dropped ones
+                heapq.heappush(heap, (areas[j], j))
+
+    return keep
+
+
+def simplify(track, tolerance=DEFAULT_TOLERANCE, method=DOUGLAS_PEUCKER):
+    """
+    :param track: Track
+        Track to simplify
+    :param tolerance: float
+        Tolerance (meters) of simplification
+    :param method: str
+        Simplification algorithm: douglas-peucker or visvalingam
+    :return: Track
+        Points of track kept (each track segment simplified on its own)
+    """
+
+    if method == DOUGLAS_PEUCKER:
+        algorithm = douglas_peucker
+    elif method == VISVALINGAM:
+        algorithm = visvalingam
+    else:
+        raise ValueError("Unknown simplification " + str(method) +
+                         ": choose one of " + ", ".join(METHODS))
+
+    x, y = project(track.lat, track.lon)
+    keep, segments = [], []
+    bounds = np.append(track.segments, len(track))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        segments.append(sum(len(k) for k in keep))
+        keep.append(start + np.flatnonzero(
+            algorithm(x[start:end], y[start:end], tolerance)))
+
+    keep = np.concatenate(keep) if keep else np.zeros(0, dtype=np.int64)
+    return Track(track.lat[keep], track.lon[keep], track.ele[keep],
+                 track.time[keep], segments)
+
+
+def get_int_dtype(values):
+    """
+    :param values: numpy.ndarray
+        Integers
+    :return: numpy.dtype
+        Smallest signed integer type that holds values
+    """
+
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if not values.size or \
+                (values.min() >= info.min and values.max() <= info.max):
+            return dtype
+
+    return np.int64
+
+
+def encode(values, scale):
+    """
+    :param values: numpy.ndarray
+        Values, NaN if missing
+    :param scale: float
+        Fixed point scale (e.g 1e5 to keep 5 decimals)
+    :return: tuple numpy.ndarray, numpy.ndarray, numpy.ndarray
+        First value, deltas between consecutive values (of the smallest
+        integer type) as fixed point integers, and positions of missing
+        values
+    """
+
+    missing = np.isnan(values)
+    fixed = np.zeros(len(values), dtype=np.int64)
+    fixed[~missing] = np.round(values[~missing] * scale)
+    if missing.any():  # missing values repeat the last (or first) known one
+        first_known = int(np.argmax(~missing))
+        last = np.maximum.accumulate(
+            np.where(missing, first_known, np.arange(len(values))))
+        fixed = fixed[last]
+
+    deltas = np.diff(fixed)
+    return fixed[:1], deltas.astype(get_int_dtype(deltas)), \
+        np.flatnonzero(missing).astype(np.int32)
+
+
+def decode(first, deltas, missing, scale):
+    """
+    :param first: numpy.ndarray
+        First value, as saved by encode()
+    :param deltas: numpy.ndarray
+        Deltas, as saved by encode()
+    :param missing: numpy.ndarray
+        Positions of missing values
+    :param scale: float
+        Fixed point scale
+    :return: numpy.ndarray
+        Values, NaN if missing
+    """
+
+    fixed = np.cumsum(np.concatenate((first, deltas)), dtype=np.int64)
+    values = fixed / scale
+    values[missing] = np.nan
+    return values
+
+
+def encode_track(track):
+    """
+    :param track: Track
+        Track to encode
+    :return: {} str -> numpy.ndarray
+        Delta-encoded fixed point fields of track
+    """
+
+    arrays = {}
+    for field, scale in FIELDS:
+        first, deltas, missing = encode(getattr(track, field), scale)
+        arrays[field + "_first"] = first
+        arrays[field] = deltas
+        arrays[field + "_missing"] = missing
+
+    arrays["segments"] = track.segments.astype(np.int32)
+    return arrays
+
+
+def decode_track(arrays):
+    """
+    :param arrays: {} str -> numpy.ndarray
+        Fields of track, as encoded by encode_track()
+    :return: Track
+        Decoded track
+    """
+
+    return Track(*[
+        decode(arrays[field + "_first"], arrays[field],
+               arrays[field + "_missing"], scale)
+        for field, scale in FIELDS
+    ], segments=arrays["segments"])
+
+
+def get_bbox(track):
+    """
+    :param track: Track
+        Track
+    :return: [] of float
+        Min latitude, min longitude, max latitude, max longitude of points
+    """
+
+    if not len(track):
+        return [np.nan] * 4
+
+    return [float(track.lat.min()), float(track.lon.min()),
+            float(track.lat.max()), float(track.lon.max())]
+
+
+def _simplify_file(args):
+    gpx_file, tolerance, method = args
+    signature = get_signature(gpx_file)
+    track = Track.from_gpx(gpx_file)
+    simplified = simplify(track, tolerance, method)
+    return os.path.basename(gpx_file), signature, len(track), \
+        encode_track(simplified), get_bbox(simplified)
+
+
+class TrackStore(object):
+    """
+    Simplified tracks, saved as delta-encoded fixed point integers (one .npz
+    per track) in a folder. The bounding box of each track is kept in an
+    index, so that spatial queries only decode the tracks that may match.
+    """
+
+    def __init__(self, folder):
+        """
+        :param folder: str
+            Folder of store (created if it does not exist)
+        """
+
+        object.__init__(self)
+
+        self.folder = folder
+        self.tracks = {}  # name -> signature, points, stored points, bbox
+        self.names = []  # sorted names of tracks
+        self.boxes = np.zeros((0, 4))  # bounding box of each name
+
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        self.load()
+
+    def __len__(self):
+        return len(self.names)
+
+    def _get_file(self, name):
+        return os.path.join(self.folder, name)
+
+    def _update_boxes(self):
+        self.names = sorted(self.tracks)
+        self.boxes = np.array(
+            [self.tracks[n]["bbox"] for n in self.names], dtype=float
+        ).reshape(-1, 4)
+
+    def load(self):
+        """
+        :return: void
+            Loads index of store (if any)
+        """
+
+        try:
+            with open(self._get_file(INDEX_FILE)) as i:
+                index = json.load(i)
+        except (OSError, ValueError):
+            return  # empty store
+
+        if index.get("version") == STORE_VERSION:
+            self.tracks = index["tracks"]
+            self._update_boxes()
+
+    def save(self):
+        """
+        :return: void
+            Saves index of store
+        """
+
+        tmp_file = self._get_file(INDEX_FILE + "." + str(os.getpid()))
+        with open(tmp_file, "w") as o:
+            json.dump({"version": STORE_VERSION, "tracks": self.tracks}, o)
+        os.replace(tmp_file, self._get_file(INDEX_FILE))
+
+    def put(self, name, arrays, bbox, signature="", points=None):
+        """
+        :param name: str
+            Name of track (e.g name of .gpx file)
+        :param arrays: {} str -> numpy.ndarray
+            Encoded track (see encode_track())
+        :param bbox: [] of float
+            Bounding box of track
+        :param signature: str
+            Signature of source file (to know when it changes)
+        :param points: int
+            Points of track before simplification
+        :return: void
+            Saves track (call save() to save index)
+        """
+
+        track_file = self._get_file(name + TRACK_EXTENSION)
+        tmp_file = track_file + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_file, "wb") as o:
+            np.savez_compressed(o, **arrays)
+        os.replace(tmp_file, track_file)
+
+        self.tracks[name] = {
+            "signature": signature,
+            "points": points,
+            "stored_points": int(len(arrays["lat_first"]) +
+                                 len(arrays["lat"])),
+            "bbox": bbox
+        }
+
+    def add(self, name, track, tolerance=DEFAULT_TOLERANCE,
+            method=DOUGLAS_PEUCKER):
+        """
+        :param name: str
+            Name of track
+        :param track: Track
+            Track to store
+        :param tolerance: float
+            Tolerance (meters) of simplification
+        :param method: str
+            Simplification algorithm: douglas-peucker or visvalingam
+        :return: void
+            Simplifies and saves track
+        """
+
+        simplified = simplify(track, tolerance, method)
+        self.put(name, encode_track(simplified), get_bbox(simplified),
+                 points=len(track))
+        self._update_boxes()
+        self.save()
+
+    def add_folder(self, gpx_folder, tolerance=DEFAULT_TOLERANCE,
+                   method=DOUGLAS_PEUCKER, workers=None):
+        """
+        :param gpx_folder: str
+            Folder with .gpx files (e.g downloaded with -gpx y)
+        :param tolerance: float
+            Tolerance (meters) of simplification
+        :param method: str
+            Simplification algorithm: douglas-peucker or visvalingam
+        :param workers: int
+            Number of processes (None: all cores)
+        :return: int
+            Stores tracks new or changed since last time (on a process
+            pool), returns number of tracks stored
+        """
+
+        if method not in METHODS:
+            raise ValueError("Unknown simplification " + str(method) +
+                             ": choose one of " + ", ".join(METHODS))
+
+        files = []
+        for f in sorted(os.listdir(gpx_folder)):
+            path = os.path.join(gpx_folder, f)
+            if f.lower().endswith(GPX_EXTENSION) and \
+                    self.tracks.get(f, {}).get("signature") != \
+                    get_signature(path):
+                files.append((path, tolerance, method))
+
+        if len(files) < 2 or workers == 1:
+            results = map(_simplify_file, files)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            results = executor.map(_simplify_file, files, chunksize=16)
+
+        try:
+            for name, signature, points, arrays, bbox in results:
+                self.put(name, arrays, bbox, signature, points)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+            self._update_boxes()
+            self.save()
+
+        return len(files)
+
+    def get_track(self, name):
+        """
+        :param name: str
+            Name of track
+        :return: Track
+            Simplified track
+        """
+
+        with np.load(self._get_file(name + TRACK_EXTENSION),
+                     allow_pickle=False) as saved:
+            return decode_track(saved)
+
+    def find_in_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        :param min_lat: float
+            Min latitude of area
+        :param min_lon: float
+            Min longitude of area
+        :param max_lat: float
+            Max latitude of area
+        :param max_lon: float
+            Max longitude of area
+        :return: [] of str
+            Names of tracks whose bounding box overlaps area (only the
+            index is read)
+        """
+
+        b = self.boxes
+        overlaps = (b[:, 0] <= max_lat) & (b[:, 2] >= min_lat) & \
+            (b[:, 1] <= max_lon) & (b[:, 3] >= min_lon)
+        return [self.names[i] for i in np.flatnonzero(overlaps)]
+
+    def find_passing(self, lat, lon, radius):
+        """
+        :param lat: float
+            Latitude of place
+        :param lon: float
+            Longitude of place
+        :param radius: float
+            Max distance (meters) of track from place
+        :return: [] of str
+            Names of tracks passing within radius of place. Only tracks
+            whose bounding box is near place are read
+        """
+
+        dlat = np.degrees(radius / EARTH_RADIUS_METERS)
+        dlon = dlat / max(np.cos(np.radians(lat)), 1e-9)
+        candidates = self.find_in_bbox(lat - dlat, lon - dlon, lat + dlat,
+                                       lon + dlon)
+
+        passing = []
+        for name in candidates:
+            if self.get_distance(name, lat, lon) <= radius:
+                passing.append(name)
+
+        return passing
+
+    def get_distance(self, name, lat, lon):
+        """
+        :param name: str
+            Name of track
+        :param lat: float
+            Latitude of place
+        :param lon: float
+            Longitude of place
+        :return: float
+            Min distance (meters) of (simplified) track from place
+        """
+
+        track = self.get_track(name)
+        x, y = project(track.lat, track.lon, lat)
+        x0, y0 = project(np.array([lat]), np.array([lon]), lat)
+        if len(x) < 2:
+            return float(np.hypot(x - x0, y - y0).min()) if len(x) else \
+                float("inf")
+
+        joined = ~track.get_breaks()  # not between track segments
+        return float(min(
+            np.hypot(x - x0, y - y0).min(),
+            get_segment_distances(
+                x0[0], y0[0], x[:-1][joined], y[:-1][joined], x[1:][joined],
+                y[1:][joined]
+            ).min(initial=np.inf)
+        ))  # segments between points, not only points
+
+    def get_size(self):
+        """
+        :return: int
+            Bytes of files of store
+        """
+
+        return sum(
+            os.path.getsize(self._get_file(f))
+            for f in os.listdir(self.folder)
+        )
@@ -3,11 +3,17 @@
 
 import argparse
 import os
+import sys
 from datetime import datetime
 
-from pygce.models.bot import GarminConnectBot
+from pygce.models.garmin.cache import ParseCache
+from pygce.models.garmin.failures import ParseFailuresMonitor, \
+    DEFAULT_BATCH_DAYS
+from pygce.models.garmin.utils import GARMIN_CONNECT_URL
+from pygce.models.logger import configure_logging
+from pygce.models.metrics import get_metrics
 
-AVAILABLE_OUTPUT_FORMATS = ["json", "csv"]
+AVAILABLE_OUTPUT_FORMATS = ["json", "csv", "ndjson"]
 
 
 def parse_yyyy_mm_dd(d):
@@ -22,17 +28,14 @@ def parse_yyyy_mm_dd(d):
     return datetime.strptime(d, "%Y-%m-%d")
 
 
-def create_args():
+def add_login_args(parser):
     """
-    :return: ArgumentParser
-        Parser that handles cmd arguments.
+    :param parser: ArgumentParser
+        Parser to add arguments to
+    :return: void
+        Adds arguments to login to Garmin Connect with chromedriver
     """
 
-    parser = argparse.ArgumentParser(
-        usage="-user <username (email) to login to Garmin Connect> -password <password "
-              "to login to Garmin Connect> -c <path to "
-              "chromedriver to use> -d <days to save. e.g -d 2017-12-30 or "
-              "-d 2016-01-01 2017-12-30> -o <path to output file>")
     parser.add_argument("-user", dest="user",
                         help="username (email) to login to Garmin Connect",
                         required=True)
@@ -42,10 +45,109 @@ def create_args():
     parser.add_argument("-url", dest="url",
                         help="url to connect to (e.g "
                              "https://connect.garmin.com)",
-                        default=GarminConnectBot.DEFAULT_BASE_URL,
+                        default=GARMIN_CONNECT_URL,
                         required=False)
     parser.add_argument("-chrome", dest="path_chromedriver",
                         help="path to chromedriver to use", required=True)
+
+
+def add_stores_args(parser):
+    """
+    :param parser: ArgumentParser
+        Parser to add arguments to
+    :return: void
+        Adds arguments of folders and files where to keep data besides output
+        file
+    """
+
+    parser.add_argument("-cache", dest="path_cache",
+                        help="folder where to cache parsed data: days that "
+                             "did not change are not parsed again",
+                        default=None,
+                        required=False)
+    parser.add_argument("-steps-store", dest="path_steps_store",
+                        help="folder of the store where to add the 15-minute "
+                             "steps of each day (a days x 96 matrix)",
+                        default=None,
+                        required=False)
+    parser.add_argument("-archive", dest="path_archive",
+                        help="folder where to keep the raw html of each day "
+                             "(compressed), to parse it again later with "
+                             "'pygce reparse'",
+                        default=None,
+                        required=False)
+    parser.add_argument("-metrics", dest="path_metrics",
+                        help="path where to save timings and counters of run "
+                             "(.json, or .prom for a Prometheus textfile)",
+                        default=None,
+                        required=False)
+
+
+def parse_sample_rate(event_rate):
+    """
+    :param event_rate: str
+        Event and rate of log sampling, e.g wait_attempt=10
+    :return: tuple str, int
+        Event and rate (log 1 of every rate messages)
+    """
+
+    event, _, rate = str(event_rate).partition("=")
+    try:
+        rate = int(rate)
+    except ValueError:
+        rate = 0
+
+    if not event.strip() or rate < 1:
+        raise argparse.ArgumentTypeError(
+            "expected <event>=<positive integer> (e.g wait_attempt=10), got " +
+            repr(event_rate))
+
+    return event.strip(), rate
+
+
+def add_logging_args(parser):
+    """
+    :param parser: ArgumentParser
+        Parser to add arguments to
+    :return: void
+        Adds arguments of log messages
+    """
+
+    parser.add_argument("-log-level", dest="log_level",
+                        help="min level of log messages (e.g DEBUG, INFO)",
+                        default="DEBUG",
+                        required=False)
+    parser.add_argument("-log-sample", nargs="*", dest="log_sample",
+                        type=parse_sample_rate,
+                        help="log only 1 of every n debug messages of events. "
+                             "e.g -log-sample wait_attempt=10 go_to=2",
+                        default=[],
+                        required=False)
+
+
+def configure_logging_args(args):
+    """
+    :param args: Namespace
+        Arguments parsed (with those of add_logging_args)
+    :return: void
+        Configures log messages
+    """
+
+    configure_logging(str(args.log_level).upper(), dict(args.log_sample))
+
+
+def create_args():
+    """
+    :return: ArgumentParser
+        Parser that handles cmd arguments.
+    """
+
+    parser = argparse.ArgumentParser(
+        usage="-user <username (email) to login to Garmin Connect> -password <password "
+              "to login to Garmin Connect> -c <path to "
+              "chromedriver to use> -d <days to save. e.g -d 2017-12-30 or "
+              "-d 2016-01-01 2017-12-30> -o <path to output file>")
+    add_login_args(parser)
     parser.add_argument("-d", nargs="*", dest="days",
                         help="days to save. e.g -d 2017-12-30 or -d "
                              "2016-01-01 2017-12-30",
@@ -56,6 +158,20 @@ def create_args():
                         required=False)
     parser.add_argument("-out", dest="path_out", help="path to output file",
                         required=True)
+    add_stores_args(parser)
+    parser.add_argument("-max-failures", dest="max_failure_rate",
+                        help="abort if a field cannot be parsed in more than "
+                             "this fraction of the first days (e.g 0.5)",
+                        type=float,
+                        default=None,
+                        required=False)
+    parser.add_argument("-failures-batch", dest="failures_batch",
+                        help="number of first days to check for parse "
+                             "failures (default {})".format(DEFAULT_BATCH_DAYS),
+                        type=int,
+                        default=DEFAULT_BATCH_DAYS,
+                        required=False)
+    add_logging_args(parser)
     return parser
 
 
@@ -76,9 +192,78 @@ def parse_args(parser):
         days = [parse_yyyy_mm_dd(raw_days[0]), parse_yyyy_mm_dd(raw_days[1])]
 
     args.gpx_out = (args.gpx_out.startswith("y"))
+    configure_logging_args(args)
 
     return str(args.user), str(args.password), str(args.url), str(
-        args.path_chromedriver), days, args.gpx_out, str(args.path_out)
+        args.path_chromedriver), days, args.gpx_out, str(args.path_out), \
+        args.path_cache, args.path_steps_store, args.path_archive, \
+        args.path_metrics, args.max_failure_rate, args.failures_batch
+
+
+def create_bot(user, password, url, chromedriver, gpx_out, path_cache=None,
+               path_steps_store=None, path_archive=None,
+               failures_monitor=None):
+    """
+    :param user: str
+        User to use
+    :param password: str
+        Password to use
+    :param url: str
+        Url to connect to
+    :param chromedriver: str
+        Path to chromedriver to use
+    :param gpx_out: bool
+        Download .gpx files of activities
+    :param path_cache: str
+        Folder of cache of parsed sections, None to always parse
+    :param path_steps_store: str
+        Folder of store of 15-minute steps, None to not store them
+    :param path_archive: str
+        Folder of archive of raw html, None to not keep it
+    :param failures_monitor: ParseFailuresMonitor
+        Aborts the run when too many days cannot be parsed
+    :return: GarminConnectBot
+        Bot (with a browser open) that saves data to the given stores
+    """
+
+    from pygce.models.bot import GarminConnectBot  # slow: selenium ...
+
+    parse_cache = ParseCache(path_cache) if path_cache else None
+    steps_store = None
+    if path_steps_store:
+        from pygce.models.garmin.steps_store import StepsStore  # numpy
+
+        steps_store = StepsStore(path_steps_store)
+
+    page_archive = None
+    if path_archive:
+        from pygce.models.garmin.archive import PageArchive
+
+        page_archive = PageArchive(path_archive)
+
+    return GarminConnectBot(user, password, gpx_out, chromedriver, url=url,
+                            parse_cache=parse_cache,
+                            failures_monitor=failures_monitor,
+                            steps_store=steps_store,
+                            page_archive=page_archive)
+
+
+def report_missing_days(bot):
+    """
+    :param bot: GarminConnectBot
+        Bot that fetched days
+    :return: int
+        Prints days the bot gave up on (if any), returns exit status: 1 if
+        some are missing, 0 otherwise
+    """
+
+    if not bot.missing_days:
+        return 0
+
+    print("Missing {} days: {}".format(
+        len(bot.missing_days), " ".join(str(d) for d in bot.missing_days)),
+        file=sys.stderr)
+    return 1
 
 
 def check_args(user, password, url, chromedriver, days, path_out):
@@ -117,28 +302,561 @@ def check_args(user, password, url, chromedriver, days, path_out):
     return True
 
 
+def create_query_args():
+    """
+    :return: ArgumentParser
+        Parser that handles cmd arguments of query subcommand.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="pygce query",
+        usage="pygce query -f <output file (.csv or .ndjson) or folder with "
+              "steps details> -d <days. e.g -d 2019-03-01 2019-03-31> "
+              "-fields <sections or fields to keep. e.g -fields SLEEP "
+              "STEPS:total>")
+    parser.add_argument("-f", dest="path",
+                        help="output file (.csv or .ndjson) or folder with "
+                             "step_details_<date> files",
+                        required=True)
+    parser.add_argument("-d", nargs="*", dest="days",
+                        help="first (and last) day. e.g -d 2019-03-01 or -d "
+                             "2019-03-01 2019-03-31 (default: all days)",
+                        default=[],
+                        required=False)
+    parser.add_argument("-fields", nargs="*", dest="fields",
+                        help="sections or fields to keep. e.g -fields SLEEP "
+                             "STEPS:total (default: all)",
+                        default=None,
+                        required=False)
+    return parser
+
+
+def query(argv):
+    """
+    :param argv: [] of str
+        Arguments of query subcommand
+    :return: void
+        Prints (as one json object per line) days of output file in range,
+        reading only them thanks to a date index kept next to the file
+    """
+
+    import json
+
+    from pygce.models.garmin.query import DaysQuery, StepsDetailsQuery
+
+    args = create_query_args().parse_args(argv)
+    days = [str(parse_yyyy_mm_dd(d).date()) for d in args.days]
+    min_date = days[0] if days else None
+    max_date = days[-1] if days else None
+
+    if os.path.isdir(args.path):
+        records = StepsDetailsQuery(args.path).iter_days(min_date, max_date)
+    else:
+        records = DaysQuery(args.path).iter_days(min_date, max_date,
+                                                 args.fields)
+
+    for record in records:
+        print(json.dumps(record))
+
+
+def create_gpx_args():
+    """
+    :return: ArgumentParser
+        Parser that handles cmd arguments of gpx subcommand.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="pygce gpx",
+        usage="pygce gpx -f <folder with .gpx files> -out <path to summary "
+              "file (.csv)> -j <processes>")
+    parser.add_argument("-f", dest="folder",
+                        help="folder with .gpx files", required=True)
+    parser.add_argument("-out", dest="path_out",
+                        help="path where to save summary of each track "
+                             "(.csv). Default: print it",
+                        default=None,
+                        required=False)
+    parser.add_argument("-j", dest="workers", type=int,
+                        help="number of processes (default: all cores)",
+                        default=None,
+                        required=False)
+    return parser
+
+
+def gpx(argv):
+    """
+    :param argv: [] of str
+        Arguments of gpx subcommand
+    :return: void
+        Summarises (distance, moving time, elevation gain ...) each track of
+        folder. Tracks are saved as .npz next to .gpx files, so that later
+        runs read only new tracks
+    """
+
+    import json
+
+    from pygce.analysis.gpx import save_summaries, summarize_folder
+
+    args = create_gpx_args().parse_args(argv)
+    summaries = summarize_folder(args.folder, args.workers)
+    if args.path_out:
+        save_summaries(summaries, args.path_out)
+    else:
+        for summary in summaries:
+            print(json.dumps(summary))
+
+
+def create_tracks_args():
+    """
+    :return: ArgumentParser
+        Parser that handles cmd arguments of tracks subcommand.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="pygce tracks",
+        usage="pygce tracks -store <folder of store> -f <folder with .gpx "
+              "files to add> -tolerance <meters> -method <douglas-peucker or "
+              "visvalingam> -near <latitude> <longitude> <meters>")
+    parser.add_argument("-store", dest="store",
+                        help="folder of the store of simplified tracks",
+                        required=True)
+    parser.add_argument("-f", dest="folder",
+                        help="folder with .gpx files to add (only new or "
+                             "changed ones are added)",
+                        default=None,
+                        required=False)
+    parser.add_argument("-tolerance", dest="tolerance", type=float,
+                        help="tolerance (meters) of simplification "
+                             "(default 2)",
+                        default=2.0,
+                        required=False)
+    parser.add_argument("-method", dest="method",
+                        help="simplification: douglas-peucker (default) or "
+                             "visvalingam",
+                        default="douglas-peucker",
+                        required=False)
+    parser.add_argument("-near", nargs=3, type=float, dest="near",
+                        help="print tracks passing within meters of a place. "
+                             "e.g -near 45.4384 10.9916 50",
+                        default=None,
+                        required=False)
+    parser.add_argument("-j", dest="workers", type=int,
+                        help="number of processes (default: all cores)",
+                        default=None,
+                        required=False)
+    return parser
+
+
+def tracks(argv):
+    """
+    :param argv: [] of str
+        Arguments of tracks subcommand
+    :return: void
+        Adds .gpx files to store of simplified tracks, and prints tracks
+        passing near a place
+    """
+
+    from pygce.analysis.tracks import TrackStore
+
+    args = create_tracks_args().parse_args(argv)
+    store = TrackStore(args.store)
+    if args.folder:
+        added = store.add_folder(args.folder, args.tolerance, args.method,
+                                 args.workers)
+        print("Added {} tracks ({} in store, {} bytes)".format(
+            added, len(store), store.get_size()))
+
+    if args.near:
+        lat, lon, radius = args.near
+        for name in store.find_passing(lat, lon, radius):
+            print(name)
+
+
+def create_reparse_args():
+    """
+    :return: ArgumentParser
+        Parser that handles cmd arguments of reparse subcommand.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="pygce reparse",
+        usage="pygce reparse -archive <folder of archive> -d <days. e.g -d "
+              "2019-03-01 2019-03-31> -out <path to output file (.csv or "
+              ".ndjson)>")
+    parser.add_argument("-archive", dest="path_archive",
+                        help="folder of archive of raw html (saved with "
+                             "-archive)",
+                        required=True)
+    parser.add_argument("-d", nargs="*", dest="days",
+                        help="first (and last) day. e.g -d 2019-03-01 or -d "
+                             "2019-03-01 2019-03-31 (default: all days)",
+                        default=[],
+                        required=False)
+    parser.add_argument("-out", dest="path_out",
+                        help="path to output file (.csv or .ndjson)",
+                        required=True)
+    return parser
+
+
+def reparse(argv):
+    """
+    :param argv: [] of str
+        Arguments of reparse subcommand
+    :return: void
+        Parses again days kept in archive (e.g after parsers are fixed) and
+        saves them, without connecting to Garmin Connect
+    """
+
+    from pygce.models.garmin.archive import PageArchive
+    from pygce.models.garmin.writers import CSVDaysWriter, NDJSONDaysWriter
+
+    args = create_reparse_args().parse_args(argv)
+    days = [str(parse_yyyy_mm_dd(d).date()) for d in args.days]
+    writers = {"csv": CSVDaysWriter, "ndjson": NDJSONDaysWriter}
+    format_out = args.path_out.split(".")[-1]
+    if format_out not in writers:
+        raise ValueError("Output file must be .csv or .ndjson")
+
+    archive = PageArchive(args.path_archive)
+    with writers[format_out](args.path_out) as writer:
+        for timeline in archive.iter_timelines(days[0] if days else None,
+                                               days[-1] if days else None):
+            timeline.parse()
+            writer.write(timeline)
+
+
+def create_sync_args():
+    """
+    :return: ArgumentParser
+        Parser that handles cmd arguments of sync subcommand.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="pygce sync",
+        usage="pygce sync -user <username (email)> -password <password> "
+              "-chrome <path to chromedriver> -out <path to output file "
+              "(.csv or .ndjson)> -watch -interval <seconds>")
+    add_login_args(parser)
+    parser.add_argument("-out", dest="path_out",
+                        help="path to output file (.csv or .ndjson) where to "
+                             "append days that changed",
+                        required=True)
+    parser.add_argument("-gpx", dest="gpx_out",
+                        help="download .gpx files too [y/n]",
+                        default="n",
+                        required=False)
+    add_stores_args(parser)
+    parser.add_argument("-days-back", dest="days_back", type=int,
+                        help="days before today to fetch again (default 1: "
+                             "today and yesterday)",
+                        default=1,
+                        required=False)
+    parser.add_argument("-watch", dest="watch", action="store_true",
+                        help="keep running: fetch days again every interval "
+                             "with the same browser session")
+    parser.add_argument("-interval", dest="interval", type=float,
+                        help="seconds between syncs (default 3600)",
+                        default=3600,
+                        required=False)
+    parser.add_argument("-cycles", dest="cycles", type=int,
+                        help="stop watching after these many syncs (default: "
+                             "never)",
+                        default=None,
+                        required=False)
+    add_logging_args(parser)
+    return parser
+
+
+def sync(argv):
+    """
+    :param argv: [] of str
+        Arguments of sync subcommand
+    :return: int
+        Fetches today and the previous days, and appends the ones that
+        changed to output file. With -watch, keeps doing it on schedule with
+        the same logged in browser (logging in again only when the session
+        expires); timings, memory and cpu of each sync go to -metrics.
+        Returns 1 if a single sync missed days, 0 otherwise
+    """
+
+    from pygce.models.sync import DaysSync
+
+    args = create_sync_args().parse_args(argv)
+    configure_logging_args(args)
+    bot = create_bot(str(args.user), str(args.password), str(args.url),
+                     str(args.path_chromedriver),
+                     args.gpx_out.startswith("y"), args.path_cache,
+                     args.path_steps_store, args.path_archive)
+    days_sync = DaysSync(bot, args.path_out, args.days_back,
+                         args.path_metrics)
+    try:
+        days_sync.watch(args.interval, args.cycles if args.watch else 1)
+        if not args.watch:  # watch fetches them again at next sync
+            return report_missing_days(bot)
+    except KeyboardInterrupt:
+        print("Stopped after {} syncs".format(days_sync.cycles))
+    finally:
+        bot.close()
+
+
+def create_batch_args():
+    """
+    :return: ArgumentParser
+        Parser that handles cmd arguments of batch subcommand.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="pygce batch",
+        usage="pygce batch -manifest <accounts (.json)> -chrome <path to "
+              "chromedriver> -j <browsers> -report <path to report (.json)>")
+    parser.add_argument("-manifest", dest="path_manifest",
+                        help="json with the accounts to export: name, user, "
+                             "password (or password_env), days (first and "
+                             "last) and out (.csv or .ndjson) of each",
+                        required=True)
+    parser.add_argument("-chrome", dest="path_chromedriver",
+                        help="path to chromedriver to use", required=True)
+    parser.add_argument("-j", dest="workers", type=int,
+                        help="browsers open at the same time (default 2)",
+                        default=2,
+                        required=False)
+    parser.add_argument("-profiles", dest="path_profiles",
+                        help="folder with the browser profile of each account "
+                             "(default: profiles)",
+                        default="profiles",
+                        required=False)
+    parser.add_argument("-batch-days", dest="batch_days", type=int,
+                        help="days of an account fetched before moving to the "
+                             "next one (default 7)",
+                        default=7,
+                        required=False)
+    parser.add_argument("-report", dest="path_report",
+                        help="path where to save days per minute of each "
+                             "account and overall (.json)",
+                        default=None,
+                        required=False)
+    parser.add_argument("-metrics", dest="path_metrics",
+                        help="path where to save timings and counters of run "
+                             "(.json, or .prom for a Prometheus textfile)",
+                        default=None,
+                        required=False)
+    add_logging_args(parser)
+    return parser
+
+
+def batch(argv):
+    """
+    :param argv: [] of str
+        Arguments of batch subcommand
+    :return: void
+        Exports days of all accounts of manifest with a fixed pool of
+        browsers (a profile per account), taking accounts in turn, and
+        saves a throughput report
+    """
+
+    import json
+
+    from pygce.models.batch import BatchRunner, load_manifest
+
+    args = create_batch_args().parse_args(argv)
+    configure_logging_args(args)
+    runner = BatchRunner(load_manifest(args.path_manifest),
+                         args.path_chromedriver, args.workers,
+                         args.path_profiles, args.batch_days)
+    try:
+        report = runner.run()
+        print(json.dumps({k: v for k, v in report.items()
+                          if k != "accounts"}))
+    finally:
+        if args.path_report:
+            runner.save_report(args.path_report)
+
+        if args.path_metrics:
+            get_metrics().save(args.path_metrics)
+
+
+def create_queue_args():
+    """
+    :return: ArgumentParser
+        Parser that handles cmd arguments of queue subcommand.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="pygce queue",
+        usage="pygce queue <enqueue, work, status, retry or merge> -db <path "
+              "to queue (.sqlite)> -manifest <accounts (.json)> -chrome <path "
+              "to chromedriver> -f <folder of days>")
+    parser.add_argument("action",
+                        choices=["enqueue", "work", "status", "retry",
+                                 "merge"],
+                        help="enqueue days of accounts of manifest, work on "
+                             "jobs, show status, retry failed jobs or merge "
+                             "days of an account into one file")
+    parser.add_argument("-db", dest="path_db",
+                        help="path of queue (.sqlite), e.g on a shared "
+                             "filesystem",
+                        required=True)
+    parser.add_argument("-manifest", dest="path_manifest",
+                        help="json with the accounts (see pygce batch)",
+                        default=None,
+                        required=False)
+    parser.add_argument("-chrome", dest="path_chromedriver",
+                        help="path to chromedriver to use",
+                        default=None,
+                        required=False)
+    parser.add_argument("-f", dest="path_folder",
+                        help="folder where to save a file per day of each "
+                             "account",
+                        default="days",
+                        required=False)
+    parser.add_argument("-lease", dest="lease_seconds", type=float,
+                        help="seconds a worker holds a job before it is "
+                             "given to another worker (default 600)",
+                        default=600,
+                        required=False)
+    parser.add_argument("-attempts", dest="max_attempts", type=int,
+                        help="claims of a job before it fails (default 3)",
+                        default=3,
+                        required=False)
+    parser.add_argument("-batch-jobs", dest="batch_jobs", type=int,
+                        help="jobs a worker claims at a time (default 1)",
+                        default=1,
+                        required=False)
+    parser.add_argument("-jobs", dest="max_jobs", type=int,
+                        help="stop the worker after these many jobs",
+                        default=None,
+                        required=False)
+    parser.add_argument("-wait", dest="wait", action="store_true",
+                        help="keep the worker waiting for new jobs when the "
+                             "queue is empty",
+                        default=False,
+                        required=False)
+    parser.add_argument("-profiles", dest="path_profiles",
+                        help="folder with the browser profile of each account "
+                             "(default: profiles)",
+                        default="profiles",
+                        required=False)
+    parser.add_argument("-account", dest="account",
+                        help="account to retry or merge (default: all)",
+                        default=None,
+                        required=False)
+    parser.add_argument("-out", dest="path_out",
+                        help="path of merged output of account (.ndjson)",
+                        default=None,
+                        required=False)
+    parser.add_argument("-metrics", dest="path_metrics",
+                        help="path where to save timings and counters of "
+                             "worker (.json, or .prom for a Prometheus "
+                             "textfile)",
+                        default=None,
+                        required=False)
+    add_logging_args(parser)
+    return parser
+
+
+def queue(argv):
+    """
+    :param argv: [] of str
+        Arguments of queue subcommand
+    :return: void
+        Shares days to fetch among workers on many machines: enqueue adds a
+        job per day of each account of manifest, work claims jobs (with a
+        lease, so that jobs of crashed workers are taken by others) and saves
+        each day in its own file, status prints jobs per state, retry puts
+        failed jobs back in queue and merge joins days of an account
+    """
+
+    import json
+
+    from pygce.models.batch import load_manifest
+    from pygce.models.queue import QueueWorker, WorkQueue, merge_days
+
+    parser = create_queue_args()
+    args = parser.parse_args(argv)
+    configure_logging_args(args)
+    if args.action in ("enqueue", "work") and not args.path_manifest:
+        parser.error(args.action + " needs -manifest")
+    if args.action == "work" and not args.path_chromedriver:
+        parser.error("work needs -chrome")
+    if args.action == "merge" and not (args.account and args.path_out):
+        parser.error("merge needs -account and -out")
+
+    work_queue = WorkQueue(args.path_db, args.lease_seconds, args.max_attempts)
+    try:
+        if args.action == "enqueue":
+            for account in load_manifest(args.path_manifest):
+                added = work_queue.enqueue(
+                    account.name,
+                    [str(day.date()) for day in account.get_days()])
+                print("{}: {} days added".format(account.name, added))
+        elif args.action == "work":
+            worker = QueueWorker(work_queue, load_manifest(args.path_manifest),
+                                 args.path_chromedriver, args.path_folder,
+                                 batch_jobs=args.batch_jobs,
+                                 profiles_folder=args.path_profiles)
+            try:
+                worker.run(args.max_jobs, args.wait)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                print("{}: {} jobs done, {} failed".format(
+                    worker.owner, worker.done, worker.failed))
+                if args.path_metrics:
+                    get_metrics().save(args.path_metrics)
+        elif args.action == "status":
+            for account, states in sorted(work_queue.get_counts().items()):
+                print(json.dumps(dict(account=account, **states)))
+            for account, date, state, attempts, error in \
+                    work_queue.get_errors():
+                print("{} {} {} after {} attempts: {}".format(
+                    account, date, state, attempts, error))
+        elif args.action == "retry":
+            print("{} jobs back in queue".format(
+                work_queue.retry_failed(args.account)))
+        else:
+            print("{} days merged".format(
+                merge_days(args.path_folder, args.account, args.path_out)))
+    finally:
+        work_queue.close()
+
+
+SUBCOMMANDS = {
+    "query": query,
+    "batch": batch,
+    "queue": queue,
+    "sync": sync,
+    "reparse": reparse,
+    "gpx": gpx,
+    "tracks": tracks
+}  # name -> function(arguments)
+
+
 def main():
-    user, password, url, chromedriver, days, gpx_out, path_out = \
-        parse_args(create_args())
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+
+    user, password, url, chromedriver, days, gpx_out, path_out, path_cache, \
+        path_steps_store, path_archive, path_metrics, max_failure_rate, \
+        failures_batch = parse_args(create_args())
 
     if check_args(user, password, url, chromedriver, days, path_out):
-        bot = GarminConnectBot(user, password, gpx_out, chromedriver, url=url)
+        failures_monitor = ParseFailuresMonitor(max_failure_rate,
+                                                failures_batch)
+        bot = create_bot(user, password, url, chromedriver, gpx_out,
+                         path_cache, path_steps_store, path_archive,
+                         failures_monitor)
 
-        format_out = path_out.split('.')[-1]
         try:
-            if format_out == "json":
-                bot.save_json_days(days[0], days[1], path_out)
-            elif format_out == "csv":
-                bot.save_csv_days(days[0], days[1], path_out)
-            else:
-              raise("Error while parsing output format. Output file must be .json or .csv")
-        except Exception as e:
-            raise e
+            bot.save_days(days[0], days[1], path_out)
+            return report_missing_days(bot)
         finally:
             bot.close()
+
+            if path_metrics:
+                get_metrics().save(path_metrics)
     else:
         print("Error while parsing args. Run 'pygce -h' for help")
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,455 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Exports days of many accounts with a fixed pool of browsers """
+
+import collections
+import json
+import os
+import re
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from pygce.models.garmin.utils import GARMIN_CONNECT_URL
+from pygce.models.garmin.writers import CSVDaysWriter, NDJSONDaysWriter
+from pygce.models.logger import log_error, log_message
+from pygce.models.metrics import get_metrics
+
+DEFAULT_WORKERS = 2  # browsers open at the same time
+DEFAULT_BATCH_DAYS = 7  # days of an account fetched before switching
+DEFAULT_PROFILES_FOLDER = "profiles"
+MAX_BROWSER_FAILURES = 3  # failed starts of an account before its days fail
+WRITERS = {
+    "csv": CSVDaysWriter,
+    "ndjson": NDJSONDaysWriter
+}  # format of output file -> streaming writer
+NAME_PATTERN = re.compile(r"^[\w.@-]+$")  # names are folder names too
+
+
+class Account(object):
+    """ Garmin Connect account and days to export """
+
+    def __init__(self, name, user, password, first_day, last_day,
+                 output_file, url=GARMIN_CONNECT_URL, gpx=False):
+        """
+        :param name: str
+            Unique name of account (folder of its browser profile)
+        :param user: str
+            Username (email) to login to Garmin Connect
+        :param password: str
+            Password to login to Garmin Connect
+        :param first_day: datetime
+            First day to export
+        :param last_day: datetime
+            Last day to export
+        :param output_file: str
+            Path of output file of account (.csv or .ndjson)
+        :param url: str
+            Url to connect to
+        :param gpx: bool
+            Download .gpx files of activities
+        """
+
+        object.__init__(self)
+
+        if not NAME_PATTERN.match(str(name)):
+            raise ValueError("Invalid account name " + repr(name) + ": use "
+                             "letters, digits, '.', '@', '_' or '-'")
+
+        if first_day > last_day:
+            raise ValueError("First day of " + name + " is after last day")
+
+        if output_file.split(".")[-1] not in WRITERS:
+            raise ValueError("Output file of " + name + " must be .csv or "
+                             ".ndjson")
+
+        self.name = name
+        self.user = user
+        self.password = password
+        self.first_day = first_day
+        self.last_day = last_day
+        self.output_file = output_file
+        self.url = url
+        self.gpx = gpx
+
+    def get_days(self):
+        """
+        :return: [] of datetime
+            Days to export, in order
+        """
+
+        return [
+            self.first_day + timedelta(days=i)
+            for i in range((self.last_day - self.first_day).days + 1)
+        ]
+
+    @staticmethod
+    def from_dict(d):
+        """
+        :param d: {}
+            Entry of manifest: name, user, password (or password_env, name
+            of environment variable with password), days (first and last)
+            and out; url and gpx are optional
+        :return: Account
+            Account of entry
+        """
+
+        try:
+            password = d["password"] if "password" in d else \
+                os.environ[d["password_env"]]
+            days = [datetime.strptime(str(day).strip(), "%Y-%m-%d")
+                    for day in d["days"]]
+            return Account(str(d["name"]), str(d["user"]), str(password),
+                           days[0], days[-1], str(d["out"]),
+                           str(d.get("url", GARMIN_CONNECT_URL)),
+                           bool(d.get("gpx", False)))
+        except (KeyError, IndexError, TypeError) as e:
+            raise ValueError("Invalid account " + repr(d.get("name")) +
+                             " in manifest: missing or bad " + str(e))
+
+
+def load_manifest(manifest_file):
+    """
+    :param manifest_file: str
+        Path of manifest (.json) with a list of accounts (see
+        Account.from_dict)
+    :return: [] of Account
+        Accounts of manifest
+    """
+
+    with open(manifest_file) as i:
+        manifest = json.load(i)
+
+    entries = manifest["accounts"] if isinstance(manifest, dict) else manifest
+    accounts = [Account.from_dict(d) for d in entries]
+    names = [a.name for a in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError("Names of accounts in manifest must be unique")
+
+    return accounts
+
+
+def create_account_bot(account, chromedriver, profile_dir):
+    """
+    :param account: Account
+        Account to login with
+    :param chromedriver: str
+        Path to chromedriver to use
+    :param profile_dir: str
+        Folder of the Chrome profile of account
+    :return: GarminConnectBot
+        Bot of account, with its own browser profile
+    """
+
+    from pygce.models.bot import GarminConnectBot  # slow: selenium ...
+
+    return GarminConnectBot(account.user, account.password, account.gpx,
+                            chromedriver, url=account.url,
+                            profile_dir=profile_dir)
+
+
+class AccountStats(object):
+    """ Throughput of an account in a batch """
+
+    def __init__(self):
+        object.__init__(self)
+
+        self.days = 0
+        self.failed_days = 0
+        self.seconds = 0.0  # time spent by workers on account
+        self.browser_starts = 0
+        self.browser_failures = 0
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        """
+        :return: {}
+            Days exported and failed, busy time and days per minute
+        """
+
+        return {
+            "days": self.days,
+            "failed_days": self.failed_days,
+            "busy_seconds": self.seconds,
+            "browser_starts": self.browser_starts,
+            "browser_failures": self.browser_failures,
+            "days_per_minute": 60.0 * self.days / self.seconds
+            if self.seconds > 0 else None,
+            "wall_seconds": self.finished - self.started
+            if self.finished is not None else None
+        }
+
+
+class BatchRunner(object):
+    """
+    Exports the days of many accounts with a fixed pool of browsers. Each
+    worker takes a few days of the next account (round robin, so accounts
+    progress together), restarting its browser with the profile of the
+    account when it changes. An account is held by one worker until its
+    browser is closed (one Chrome per profile), and its days are written in
+    order to its own output file.
+    """
+
+    def __init__(self, accounts, chromedriver, workers=DEFAULT_WORKERS,
+                 profiles_folder=DEFAULT_PROFILES_FOLDER,
+                 batch_days=DEFAULT_BATCH_DAYS, bot_factory=None):
+        """
+        :param accounts: [] of Account
+            Accounts to export
+        :param chromedriver: str
+            Path to chromedriver to use
+        :param workers: int
+            Browsers open at the same time
+        :param profiles_folder: str
+            Folder with a browser profile per account
+        :param batch_days: int
+            Days of an account a worker fetches before taking the next
+            account (more days: fewer browser restarts, less fairness)
+        :param bot_factory: callable
+            (account, chromedriver, profile folder) -> bot. None to use
+            GarminConnectBot
+        """
+
+        object.__init__(self)
+
+        self.accounts = collections.OrderedDict((a.name, a) for a in accounts)
+        self.chromedriver = chromedriver
+        self.workers = max(1, int(workers))
+        self.profiles_folder = profiles_folder
+        self.batch_days = max(1, int(batch_days))
+        self.bot_factory = bot_factory or create_account_bot
+        self.stats = {name: AccountStats() for name in self.accounts}
+        self.started = None
+        self.finished = None
+
+        self._pending = {
+            name: collections.deque(a.get_days())
+            for name, a in self.accounts.items()
+        }  # days still to fetch
+        self._turns = collections.deque(self.accounts)  # round robin
+        self._busy = set()  # accounts held by a worker
+        self._writers = {}  # name -> DaysWriter
+        self._condition = threading.Condition()
+
+    def take(self, current=None):
+        """
+        :param current: Account
+            Account held by the worker (its browser is open), None if none
+        :return: tuple Account, [] of datetime
+            Next account (in turn) not held by another worker, and its next
+            days to fetch. Waits while all accounts with days left are held;
+            None when there is nothing left
+        """
+
+        current = current.name if current is not None else None
+        with self._condition:
+            while True:
+                for _ in range(len(self._turns)):
+                    name = self._turns[0]
+                    self._turns.rotate(-1)
+                    if (name in self._busy and name != current) or \
+                            not self._pending[name]:
+                        continue
+
+                    pending = self._pending[name]
+                    days = [pending.popleft() for _ in
+                            range(min(self.batch_days, len(pending)))]
+                    self._busy.add(name)
+                    return self.accounts[name], days
+
+                if not self._busy - {current}:
+                    return None  # no days left
+
+                self._condition.wait()
+
+    def release(self, account, days=()):
+        """
+        :param account: Account
+            Account held by a worker (its browser must be closed)
+        :param days: [] of datetime
+            Days taken but not fetched, to fetch again later
+        :return: void
+            Lets other workers take account
+        """
+
+        with self._condition:
+            self._pending[account.name].extendleft(reversed(list(days)))
+            self._busy.discard(account.name)
+            self._condition.notify_all()
+
+    def _get_profile_dir(self, account):
+        return os.path.join(self.profiles_folder, account.name)
+
+    def _save_day(self, bot, account, day):
+        writer = self._writers[account.name]
+        output_folder = os.path.dirname(account.output_file)
+        for d in bot.iter_parsed_days(day, day):
+            writer.write(d)
+            if isinstance(writer, CSVDaysWriter):
+                bot.save_csv_steps_details([d], output_folder)
+            else:
+                bot.save_json_steps_details([d], output_folder)
+            bot.save_gpx([d])
+
+        if bot.missing_days:  # bot gave up on day: count it as failed
+            raise ValueError(str(day.date()) + " could not be fetched")
+
+    def _fetch(self, bot, account, days):
+        stats = self.stats[account.name]
+        metrics = get_metrics()
+        for day in days:
+            start = time.perf_counter()
+            try:
+                with metrics.timer("batch_day"):
+                    self._save_day(bot, account, day)
+                stats.days += 1
+                metrics.incr("batch_days")
+            except Exception as e:  # next days may work
+                traceback.print_exc()
+                log_error(e, date=day.date())
+                stats.failed_days += 1
+                metrics.incr("batch_failed_days")
+            finally:
+                stats.seconds += time.perf_counter() - start
+
+    def _work(self, worker):
+        bot, current = None, None
+        try:
+            while True:
+                job = self.take(current)
+                if job is None:
+                    break
+
+                account, days = job
+                if current is not None and current is not account:
+                    try:
+                        bot.close()  # before another worker opens profile
+                    finally:
+                        bot = None
+                        self.release(current)
+                        current = None
+
+                stats = self.stats[account.name]
+                try:
+                    with get_metrics().tagged(account=account.name,
+                                              worker=worker):
+                        if bot is None:  # switch profile
+                            with get_metrics().timer("browser_start"):
+                                bot = self.bot_factory(
+                                    account, self.chromedriver,
+                                    self._get_profile_dir(account))
+                            stats.browser_starts += 1
+                            current = account
+
+                        self._fetch(bot, account, days)
+                except Exception as e:  # e.g browser did not start
+                    log_error(e, account=account.name)
+                    stats.browser_failures += 1
+                    if bot is not None:
+                        try:
+                            bot.close()
+                        except Exception:
+                            pass  # browser is broken anyway
+                    bot, current = None, None
+                    if stats.browser_failures < MAX_BROWSER_FAILURES:
+                        self.release(account, days)  # fetch them later
+                    else:  # give up account: fail all its days
+                        with self._condition:
+                            days += self._pending[account.name]
+                            self._pending[account.name].clear()
+                        stats.failed_days += len(days)
+                        stats.finished = time.time()
+                        self.release(account)
+                    continue
+
+                if not self._pending[account.name]:  # done: free profile
+                    stats.finished = time.time()
+                    if bot is not None:
+                        try:
+                            bot.close()
+                        finally:
+                            bot, current = None, None
+                    self.release(account)
+        finally:
+            if bot is not None:
+                bot.close()
+            if current is not None:
+                self.release(current)
+
+    def run(self):
+        """
+        :return: {}
+            Exports days of all accounts, returns throughput report
+        """
+
+        self.started = time.time()
+        for name, account in self.accounts.items():
+            folder = os.path.dirname(account.output_file)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+
+            writer = WRITERS[account.output_file.split(".")[-1]](
+                account.output_file)
+            writer.open()
+            self._writers[name] = writer
+            self.stats[name].started = self.started
+
+        threads = [
+            threading.Thread(target=self._work, args=(i,),
+                             name="pygce-worker-" + str(i))
+            for i in range(min(self.workers, len(self.accounts)))
+        ]  # an account is fetched by one worker at a time
+        try:
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+        finally:
+            for writer in self._writers.values():
+                writer.close()
+
+        self.finished = time.time()
+        report = self.get_report()
+        log_message("Exported", report["days"], "days of",
+                    len(self.accounts), "accounts in",
+                    round(report["wall_seconds"], 1), "s")
+        return report
+
+    def get_report(self):
+        """
+        :return: {}
+            Days exported, wall time and days per minute, overall and of
+            each account
+        """
+
+        wall = (self.finished or time.time()) - (self.started or time.time())
+        days = sum(s.days for s in self.stats.values())
+        return {
+            "workers": self.workers,
+            "batch_days": self.batch_days,
+            "days": days,
+            "failed_days": sum(s.failed_days for s in self.stats.values()),
+            "browser_starts": sum(s.browser_starts
+                                  for s in self.stats.values()),
+            "wall_seconds": wall,
+            "days_per_minute": 60.0 * days / wall if wall > 0 else None,
+            "accounts": {
+                name: stats.to_dict() for name, stats in self.stats.items()
+            }
+        }
+
+    def save_report(self, output_file):
+        """
+        :param output_file: str
+            Path where to save report (.json)
+        :return: void
+            Saves throughput report
+        """
+
+        with open(output_file, "w") as o:
+            json.dump(self.get_report(), o, sort_keys=True, indent=4,
+                      separators=(',', ': '))
@@ -2,31 +2,28 @@
 # -*- coding: utf-8 -*-
 
 
-import csv
+import collections
 import json
 import os
+import time
 import traceback
 from datetime import timedelta
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
 
-from bs4 import BeautifulSoup
-from hal.internet.selenium.forms import SeleniumFormFiller
-from hal.internet.utils import add_params_to_url
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
-
-from pygce.models.garmin.utils import json2pretty
+from pygce.models.garmin.failures import ParseFailuresMonitor
+from pygce.models.garmin.utils import GARMIN_CONNECT_URL, json2pretty
 from pygce.models.garmin.timeline import GCDayTimeline
+from pygce.models.garmin.writers import CSVDaysWriter, NDJSONDaysWriter, \
+    get_steps_details_file, write_csv_steps_details
 from pygce.models.logger import log_error, log_message
+from pygce.models.metrics import get_metrics
 
 
 class GarminConnectBot(object):
     """ Navigate through Garmin Connect app via a bot """
 
     USER_PATH = "/modern/"
-    DEFAULT_BASE_URL = "https://connect.garmin.com"
+    DEFAULT_BASE_URL = GARMIN_CONNECT_URL
     BASE_LOGIN_URL = "https://sso.garmin.com/sso/login?service=https%3A%2F" \
                      "%2Fconnect.garmin.com" \
                      "%2Fmodern%2F&webhost=olaxpw" \
@@ -41,12 +38,16 @@ class GarminConnectBot(object):
     USERNAME_FIELD_NAME = "username"  # html name of username in login form
     PASSWORD_FIELD_NAME = "password"  # html name of password in login form
     BROWSER_WAIT_TIMEOUT_SECONDS = 3  # max seconds before url request is
+    MAX_DAY_ATTEMPTS = 3  # fetches of a day before it is given up
     BROWSER_GENERAL_ERROR = "If the error persist, please open an issue."
     BROWSER_TIMEOUT_ERROR = "Cannot complete request (cannot find {}). I " \
                             "suggest setting a larger browser timeout page. " + BROWSER_GENERAL_ERROR
 
     def __init__(self, user_name, password, download_gpx, chromedriver_path,
-                 url=DEFAULT_BASE_URL):
+                 url=DEFAULT_BASE_URL, parse_cache=None,
+                 failures_monitor=None, steps_store=None, page_archive=None,
+                 profile_dir=None, release_inputs=True,
+                 max_day_attempts=MAX_DAY_ATTEMPTS):
         """
         :param user_name: str
             Username (email) to login to Garmin Connect
@@ -58,12 +59,39 @@ class GarminConnectBot(object):
             Path to Chrome driver to use as browser
         :param url: str
             Url to base downloads on
+        :param parse_cache: ParseCache
+            Cache of parsed sections, None to always parse
+        :param failures_monitor: ParseFailuresMonitor
+            Aborts the run when too many days cannot be parsed. None to never
+            abort
+        :param steps_store: StepsStore
+            Store where to add the 15-minute steps bins of each parsed day,
+            None to not store them
+        :param page_archive: PageArchive
+            Archive where to keep the raw html of each day fetched (to parse
+            it again later), None to not keep it
+        :param profile_dir: str
+            Folder of the Chrome profile to use (cookies are kept there, so
+            a later bot with the same profile may not need to login again).
+            None to use a new temporary profile
+        :param release_inputs: bool
+            Drop raw html of each day once it is parsed (and archived), so
+            that memory does not grow with the days kept. False to keep it
+            (e.g to debug parsers)
+        :param max_day_attempts: int
+            Fetches of a day (e.g its page did not load) before it is given
+            up and reported as missing
         """
 
         object.__init__(self)
 
+        from selenium import webdriver  # slow to import: only when needed
+
         browser_options = webdriver.ChromeOptions()
         browser_options.add_argument('--whitelisted-ips')
+        if profile_dir is not None:  # one Chrome at a time per profile
+            browser_options.add_argument(
+                '--user-data-dir=' + os.path.abspath(profile_dir))
         self.browser = webdriver.Chrome(
             executable_path=chromedriver_path,
             options=browser_options
@@ -76,16 +104,34 @@ class GarminConnectBot(object):
         self.download_gpx = download_gpx
         self.user_url = url + self.USER_PATH
         self.base_url = url
+        self.parse_cache = parse_cache
+        self.failures_monitor = failures_monitor
+        if self.failures_monitor is None:
+            self.failures_monitor = ParseFailuresMonitor()
+        self.steps_store = steps_store
+        self.page_archive = page_archive
+        self.release_inputs = release_inputs
+        self.max_day_attempts = max(1, int(max_day_attempts))
+        self.missing_days = []  # days given up by last fetch
 
         garmin_region = self.user_url.split("/")[2].split("connect.")[-1]
         log_message("Region:", garmin_region)
 
         self.login_url = \
             self.BASE_LOGIN_URL.replace("garmin.com", garmin_region)
+        self.login_host = urlparse(self.login_url).netloc
 
     def _wait_for(self, locator, element, attempts=3):
+        with get_metrics().timer("wait_for"):
+            return self._wait_for_attempts(locator, element, attempts)
+
+    def _wait_for_attempts(self, locator, element, attempts):
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+
         for i in range(attempts):
-            log_message("attempt", str(i))
+            log_message("attempt", i, event="wait_attempt")
+            get_metrics().incr("wait_attempts")
 
             try:
                 WebDriverWait(
@@ -102,6 +148,7 @@ class GarminConnectBot(object):
                 pass  # maybe next time
 
         log_message(self.BROWSER_TIMEOUT_ERROR.format(element))
+        get_metrics().incr("wait_timeouts")
         return False
 
     def _perform_login(self):
@@ -111,21 +158,54 @@ class GarminConnectBot(object):
         # todo may not be needed self._wait_for(By.CLASS_NAME, "activity-tracking-disclaimer")
 
     def _go_to(self, url, locator=None, element=None):
-        log_message("GET", url)
-        self.browser.get(url)
+        start = time.perf_counter()
+        with get_metrics().timer("go_to"):
+            self.browser.get(url)
+        log_message("GET", event="go_to", url=url,
+                    elapsed=round(time.perf_counter() - start, 3))
+
+        if self.is_session_expired():  # redirected to login page
+            log_message("Session expired: logging in again", url=url)
+            get_metrics().incr("relogins")
+            self.user_logged_in = False
+            if self.login():
+                with get_metrics().timer("go_to"):
+                    self.browser.get(url)
 
         if locator and element:
             if not self._wait_for(locator, element):
                 raise ValueError(url + " not fully loaded")
 
+    def is_session_expired(self):
+        """
+        :return: bool
+            True iff user was logged in but browser has been redirected to
+            the login page (e.g session cookies expired)
+        """
+
+        return self.user_logged_in and \
+            urlparse(str(self.browser.current_url)).netloc == self.login_host
+
     def login(self):
         """
         :return: bool
             True iff correctly logged in
         """
 
+        with get_metrics().timer("login"):
+            return self._login()
+
+    def _login(self):
+        from hal.internet.selenium.forms import SeleniumFormFiller
+
         try:
             self._go_to(self.login_url)  # open login url
+            if urlparse(str(self.browser.current_url)).netloc != \
+                    self.login_host:  # redirected: session of profile
+                get_metrics().incr("logins_reused")
+                self.user_logged_in = True
+                return True
+
             SeleniumFormFiller(self.browser).fill_login_form(
                 self.user_name, self.USERNAME_FIELD_NAME,
                 self.user_password, self.PASSWORD_FIELD_NAME
@@ -140,7 +220,14 @@ class GarminConnectBot(object):
             return False  # something went wrong
 
     def get_html_parser(self, page_format="html.parser"):
-        return BeautifulSoup(str(self.browser.page_source), page_format)
+        from bs4 import BeautifulSoup
+
+        metrics = get_metrics()
+        with metrics.timer("page_source"):
+            page_source = str(self.browser.page_source)
+
+        with metrics.timer("soup"):
+            return BeautifulSoup(page_source, page_format)
 
     def _get_user_id(self):
         self.go_to_dashboard()
@@ -168,6 +255,8 @@ class GarminConnectBot(object):
             Navigates to user homepage
         """
 
+        from selenium.webdriver.common.by import By
+
         if not self.user_logged_in:
             self.login()
 
@@ -186,11 +275,15 @@ class GarminConnectBot(object):
             Navigates to daily summary of given date
         """
 
+        from selenium.webdriver.common.by import By
+
         self._find_user_id()
         url = self._get_day_url(date_time)
         self._go_to(url, By.CLASS_NAME, "ui-datepicker-trigger")
 
     def _get_steps_details_url(self, date_time):
+        from hal.internet.utils import add_params_to_url
+
         url = urljoin(self.base_url, self.STEPS_DETAILS_PATH)
         url = urljoin(url, self.user_id)
 
@@ -199,6 +292,8 @@ class GarminConnectBot(object):
         return url
 
     def go_to_steps_details(self, date_time):
+        from selenium.webdriver.common.by import By
+
         self._find_user_id()
         url = self._get_steps_details_url(date_time)
         self._go_to(url, By.TAG_NAME, "pre")
@@ -208,10 +303,12 @@ class GarminConnectBot(object):
             self.go_to_steps_details(date_time)
             soup = self.get_html_parser()
             steps_details_html = soup.find('pre').text
-            log_message("found steps details data")
+            log_message("found data", section="steps details",
+                        date=date_time.date())
         except:
             steps_details_html = '[]'
-            log_message("NOT found steps details data")
+            log_message("NOT found data", section="steps details",
+                        date=date_time.date())
 
         return steps_details_html
 
@@ -223,35 +320,43 @@ class GarminConnectBot(object):
             Data about day
         """
 
-        log_message("Getting day", str(date_time))
+        with get_metrics().tagged(date=date_time.date()):
+            return self._get_day(date_time)
+
+    def _get_day(self, date_time):
+        log_message("Getting day", date=date_time.date())
         self.go_to_day(date_time)
         soup = self.get_html_parser()
 
         tabs_html = soup.find("div", {"class": "tab-content"})
+        if tabs_html is None:  # page not loaded (or not a timeline)
+            raise ValueError(self._get_day_url(date_time) + " has no "
+                             "tab-content")
+
         summary_html = soup.find("div", {
             "class": "content page steps sleep calories timeline"})
         steps_html = soup.find("div", {"class": "row-fluid bottom-m"})
 
         try:
             sleep_html = tabs_html.find("div", {"id": "pane5"})
-            log_message("found sleep data")
+            log_message("found data", section="sleep")
         except:
             sleep_html = None
-            log_message("NOT found sleep data")
+            log_message("NOT found data", section="sleep")
 
         try:
             activities_html = tabs_html.find("div", {"id": "pane4"})
-            log_message("found activities data")
+            log_message("found data", section="activities")
         except:
             activities_html = None
-            log_message("NOT found activities data")
+            log_message("NOT found data", section="activities")
 
         try:
             breakdown_html = tabs_html.find("div", {"id": "pane2"})
-            log_message("found breakdown data")
+            log_message("found data", section="breakdown")
         except:
             breakdown_html = None
-            log_message("NOT found breakdown data")
+            log_message("NOT found data", section="breakdown")
 
         yesterday = date_time + timedelta(days=-1)
         today = date_time
@@ -283,26 +388,97 @@ class GarminConnectBot(object):
             breakdown_html
         )
 
-    def get_days(self, min_date_time, max_date_time):
+    def iter_days(self, min_date_time, max_date_time):
         """
         :param min_date_time: datetime
             Datetime object with date, this is the date when to start downloading data
         :param max_date_time: datetime
             Datetime object with date, this is the date when to stop downloading data
-        :return: [] of GCDayTimline
-            List of data about days
+        :return: generator of GCDayTimline
+            Data about days, fetched one at a time. Days that fail to load
+            are fetched again after the others (so they may come out of
+            order), up to self.max_day_attempts times; days given up are
+            left in self.missing_days
         """
 
+        from selenium.common.exceptions import WebDriverException  # slow
+
         days_delta = (
             max_date_time - min_date_time
         ).days  # days from begin to end
-        days = []  # output list
 
-        for i in range(days_delta + 1):  # including last day
-            day = min_date_time + timedelta(days=i)
-            days.append(self.get_day(day))
+        pending = collections.deque(
+            (min_date_time + timedelta(days=i), 1)
+            for i in range(days_delta + 1)  # including last day
+        )  # day and attempt
+        self.missing_days = []
+        metrics = get_metrics()
+        while pending:
+            date_time, attempt = pending.popleft()
+            try:
+                day = self.get_day(date_time)
+            except (ValueError, WebDriverException) as e:  # e.g slow network
+                log_error(e, date=date_time.date(), attempt=attempt)
+                if attempt < self.max_day_attempts:
+                    pending.append((date_time, attempt + 1))  # retry later
+                    metrics.incr("day_retries")
+                else:
+                    self.missing_days.append(date_time.date())
+                    metrics.incr("missing_days")
+                continue
+
+            if self.page_archive is not None:  # before parsing changes it
+                self.page_archive.put_timeline(day)
+
+            yield day
+
+        if self.missing_days:
+            self.missing_days.sort()
+            log_error(
+                "Missing " + str(len(self.missing_days)) + " days after " +
+                str(self.max_day_attempts) + " attempts: " +
+                ", ".join(str(d) for d in self.missing_days)
+            )
+
+    def get_days(self, min_date_time, max_date_time):
+        """
+        :param min_date_time: datetime
+            Datetime object with date, this is the date when to start downloading data
+        :param max_date_time: datetime
+            Datetime object with date, this is the date when to stop downloading data
+        :return: [] of GCDayTimline
+            List of data about days
+        """
 
-        return days
+        return list(self.iter_days(min_date_time, max_date_time))
+
+    def iter_parsed_days(self, min_date_time, max_date_time):
+        """
+        :param min_date_time: datetime
+            Datetime object with date, this is the date when to start downloading data
+        :param max_date_time: datetime
+            Datetime object with date, this is the date when to stop downloading data
+        :return: generator of GCDayTimline
+            Parsed data about days, fetched one at a time
+        """
+
+        for d in self.iter_days(min_date_time, max_date_time):
+            d.parse(self.parse_cache)  # parse
+            if self.release_inputs:  # parsed values are all that is needed
+                d.release_inputs()
+            get_metrics().incr("days")
+            self.failures_monitor.add_day(d)  # fail fast if markup changed
+            if self.steps_store is not None:
+                with get_metrics().timer("write", date=d.date,
+                                         section="steps store"):
+                    self.steps_store.put_timeline(d)
+
+            yield d
+
+        if self.steps_store is not None:
+            self.steps_store.flush()
+
+        self.failures_monitor.log_summary()
 
     def parse_days(self, min_date_time, max_date_time):
         """
@@ -314,39 +490,25 @@ class GarminConnectBot(object):
             List of data about days
         """
 
-        data = self.get_days(min_date_time, max_date_time)  # get raw data
-
-        for d in data:
-            d.parse()  # parse
-
-        return data
+        return list(self.iter_parsed_days(min_date_time, max_date_time))
 
     @staticmethod
     def save_json_steps_details(data, output_folder):
         for d in data:
             steps_details = d.sections["steps details"].to_dict()
-            output_file = 'step_details_' + str(d.date) + '.json'
-            output_file = os.path.join(output_folder, output_file)
+            output_file = get_steps_details_file(output_folder, d.date, "json")
 
             json_data = steps_details
             json_data['date'] = str(d.date)
 
-            json2pretty(json_data, output_file)
+            with get_metrics().timer("write", date=d.date,
+                                     section="steps details"):
+                json2pretty(json_data, output_file)
 
     @staticmethod
     def save_csv_steps_details(data, output_folder):
         for d in data:
-            steps_details = d.sections["steps details"].to_dict()
-            output_file = 'step_details_' + str(d.date) + '.csv'
-            output_file = os.path.join(output_folder, output_file)
-
-            steps_details = list(steps_details.values())[0]
-            csv_headers = steps_details[0].keys()  # sample of keys
-            with open(output_file, "w") as o:  # write to file
-                dict_writer = csv.DictWriter(o, csv_headers)
-                dict_writer.writeheader()
-
-                dict_writer.writerows(steps_details)
+            write_csv_steps_details(d, output_folder)
 
     def save_json_days(self, min_date_time, max_date_time, output_file):
         """
@@ -361,13 +523,18 @@ class GarminConnectBot(object):
         """
 
         data = self.parse_days(min_date_time, max_date_time)
+        data.sort(key=lambda d: d.date)  # retried days are fetched last
         self.save_json_steps_details(data, os.path.dirname(output_file))
         for d in data:  # remove steps details
             del d.sections["steps details"]
 
-        json_data = [json.loads(d.to_json()) for d in
-                     data]  # convert to json objects
-        json2pretty(json_data, output_file)
+        metrics = get_metrics()
+        with metrics.timer("serialize"):
+            json_data = [json.loads(d.to_json()) for d in
+                         data]  # convert to json objects
+
+        with metrics.timer("write"):
+            json2pretty(json_data, output_file)
 
         self.save_gpx(data)
 
@@ -380,22 +547,62 @@ class GarminConnectBot(object):
         :param output_file: str
             Path where to save output to
         :return: void
-            Retrieves data about days in given range, then saves csv dump
+            Retrieves data about days in given range, then saves csv dump.
+            Each day is written as soon as it is parsed, so memory does not
+            grow with the range: days fetched again after failing to load
+            are written last (out of date order).
         """
 
-        data = self.parse_days(min_date_time, max_date_time)
-        self.save_csv_steps_details(data, os.path.dirname(output_file))
-        for d in data:  # remove steps details
-            del d.sections["steps details"]
+        output_folder = os.path.dirname(output_file)
+        with CSVDaysWriter(output_file) as writer:
+            for d in self.iter_parsed_days(min_date_time, max_date_time):
+                self.save_csv_steps_details([d], output_folder)
+                writer.write(d)
+                self.save_gpx([d])
 
-        csv_data = [d.to_csv_dict() for d in data]  # get csv
-        csv_headers = csv_data[0].keys()  # get headers for a sample dict
-        with open(output_file, "w") as o:  # write to file
-            dict_writer = csv.DictWriter(o, csv_headers)
-            dict_writer.writeheader()
-            dict_writer.writerows(csv_data)
+    def save_ndjson_days(self, min_date_time, max_date_time, output_file):
+        """
+        :param min_date_time: datetime
+            Datetime object with date, this is the date when to start downloading data
+        :param max_date_time: datetime
+            Datetime object with date, this is the date when to stop downloading data
+        :param output_file: str
+            Path where to save output to
+        :return: void
+            Retrieves data about days in given range, then saves one json
+            object per line (streamed like csv dumps, so days fetched again
+            are written last, and indexable by date)
+        """
+
+        output_folder = os.path.dirname(output_file)
+        with NDJSONDaysWriter(output_file) as writer:
+            for d in self.iter_parsed_days(min_date_time, max_date_time):
+                self.save_json_steps_details([d], output_folder)
+                writer.write(d)
+                self.save_gpx([d])
+
+    def save_days(self, min_date_time, max_date_time, output_file):
+        """
+        :param min_date_time: datetime
+            Datetime object with date, this is the date when to start downloading data
+        :param max_date_time: datetime
+            Datetime object with date, this is the date when to stop downloading data
+        :param output_file: str
+            Path where to save output to (.json, .csv or .ndjson)
+        :return: void
+            Retrieves data about days in given range, then saves them in the
+            format of the output file
+        """
 
-        self.save_gpx(csv_data)
+        format_out = output_file.split('.')[-1]
+        if format_out == "json":
+            self.save_json_days(min_date_time, max_date_time, output_file)
+        elif format_out == "csv":
+            self.save_csv_days(min_date_time, max_date_time, output_file)
+        elif format_out == "ndjson":
+            self.save_ndjson_days(min_date_time, max_date_time, output_file)
+        else:
+            raise ValueError("Output file must be .json, .csv or .ndjson")
 
     def save_gpx(self, data):
         """
@@ -411,7 +618,8 @@ class GarminConnectBot(object):
                 for activity in timeline.activities:
                     self._go_to(activity["gpx"])
                     log_message(
-                        "Saved .gpx for", activity["name"], activity["time_day"]
+                        "Saved .gpx for", activity["name"], activity["time_day"],
+                        url=activity["gpx"]
                     )
 
     def close(self):
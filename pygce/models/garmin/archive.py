@@ -0,0 +1,467 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Compressed archive of the raw html of sections, to parse days again """
+
+import collections
+import hashlib
+import json
+import os
+import re
+import zlib
+from datetime import datetime
+
+from pygce.models.garmin.timeline import GCDayTimeline
+from pygce.models.logger import log_message
+from pygce.models.metrics import get_metrics
+
+ARCHIVE_VERSION = 1
+SETTINGS_FILE = "archive.json"  # codec and dictionary in use
+BLOBS_FOLDER = "blobs"  # <hash[:2]>/<hash>: compressed raw html of sections
+DAYS_FOLDER = "days"  # <yyyy-mm-dd>.json: hash of each section of day
+DICTIONARIES_FOLDER = "dictionaries"  # <id>.dict
+ZSTD = "zstd"
+ZLIB = "zlib"
+CODEC_HEADERS = {ZSTD: b"z", ZLIB: b"d"}  # first byte of blobs
+NO_DICTIONARY = "0" * 8
+DEFAULT_LEVEL = 19  # zstd level (zlib uses at most 9)
+DEFAULT_TRAIN_AFTER = 100  # blobs to store before training a dictionary
+DEFAULT_TRAIN_SAMPLES = 1000  # max blobs to train dictionary on
+DEFAULT_DICTIONARY_SIZE = 64 * 1024  # bytes (zlib uses the last 32 KB only)
+ZLIB_DICTIONARY_SIZE = 32 * 1024  # window of zlib
+TIMELINE_SECTIONS = [
+    "summary", "steps", "steps details", "sleep", "activities", "breakdown"
+]  # in the order of the arguments of GCDayTimeline
+TAG_PATTERN = re.compile(rb"[^>]*>")  # chunks of markup, up to end of tag
+
+
+def get_zstandard():
+    """
+    :return: module
+        zstandard module, None if it is not installed
+    """
+
+    try:
+        import zstandard  # optional: pip3 install zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+
+def train_zlib_dictionary(samples, size=ZLIB_DICTIONARY_SIZE):
+    """
+    :param samples: [] of bytes
+        Raw html of sections
+    :param size: int
+        Max bytes of dictionary
+    :return: bytes
+        Markup chunks (up to the end of a tag) repeated across samples, the
+        ones saving most bytes last (zlib finds closer matches cheaper)
+    """
+
+    counts = collections.Counter()
+    for sample in samples:
+        counts.update(set(TAG_PATTERN.findall(sample)))
+
+    chunks = sorted(
+        (count * len(chunk), chunk) for chunk, count in counts.items()
+        if count > 1 and len(chunk) > 3
+    )  # least useful first
+    dictionary, total = [], 0
+    for _, chunk in reversed(chunks):
+        if total + len(chunk) > size:
+            break
+
+        dictionary.append(chunk)
+        total += len(chunk)
+
+    return b"".join(reversed(dictionary))
+
+
+class PageArchive(object):
+    """
+    Raw html of the sections of each day, stored once per distinct content
+    (blobs are named by sha256 of their content) and compressed with a
+    dictionary trained on stored sections, since every day repeats almost
+    the same markup. A manifest per day lists its sections, so that days can
+    be rebuilt (as GCDayTimeline) and parsed again, e.g after parsers are
+    fixed. New archives use zstandard when installed, zlib otherwise: an
+    archive keeps the codec it was created with.
+    """
+
+    def __init__(self, folder, codec=None, level=DEFAULT_LEVEL,
+                 train_after=DEFAULT_TRAIN_AFTER):
+        """
+        :param folder: str
+            Folder of archive (created if it does not exist)
+        :param codec: str
+            Compression of blobs: zstd or zlib. None to use the one of the
+            archive (zstd when installed for a new archive)
+        :param level: int
+            Compression level
+        :param train_after: int
+            Train a dictionary (and compress again blobs stored so far) as
+            soon as these many blobs are stored without one. None to train
+            only when train() is called
+        """
+
+        object.__init__(self)
+
+        if codec is not None and codec not in CODEC_HEADERS:
+            raise ValueError("Unknown codec " + str(codec) + ": choose one "
+                             "of " + ", ".join(CODEC_HEADERS))
+
+        self.folder = folder
+        self.codec = codec
+        self.level = level
+        self.train_after = train_after
+        self.dictionary_id = NO_DICTIONARY  # dictionary of new blobs
+        self._dictionaries = {NO_DICTIONARY: b""}  # id -> bytes (loaded)
+        self._compressors = {}  # (codec, dictionary id) -> compressor
+        self._blobs_without_dictionary = None  # counted on first put
+
+        for sub_folder in (BLOBS_FOLDER, DAYS_FOLDER, DICTIONARIES_FOLDER):
+            path = os.path.join(self.folder, sub_folder)
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+        if not self.load() and self.codec is None:
+            self.codec = ZSTD if get_zstandard() is not None else ZLIB
+
+        if self.codec == ZSTD and get_zstandard() is None:
+            raise ValueError("Archive " + str(folder) + " uses zstd: pip3 "
+                             "install zstandard")
+
+        if not os.path.exists(self._get_file(SETTINGS_FILE)):
+            self._save_settings()  # codec of archive from now on
+
+    def _get_file(self, *names):
+        return os.path.join(self.folder, *names)
+
+    def _get_saved_codec(self):
+        for path in self._iter_blob_files():  # archive saved no settings
+            with open(path, "rb") as i:
+                header = i.read(1)
+
+            for codec, codec_header in CODEC_HEADERS.items():
+                if header == codec_header:
+                    return codec
+
+        return None
+
+    def load(self):
+        """
+        :return: bool
+            Loads codec and dictionary in use, True iff archive has them
+        """
+
+        try:
+            with open(self._get_file(SETTINGS_FILE)) as i:
+                settings = json.load(i)
+        except (OSError, ValueError):
+            settings = {"version": ARCHIVE_VERSION,
+                        "codec": self._get_saved_codec()}
+
+        if settings.get("version") != ARCHIVE_VERSION or \
+                settings.get("codec") not in CODEC_HEADERS:
+            return False  # new archive
+
+        if self.codec is None:
+            self.codec = settings["codec"]
+        elif self.codec != settings["codec"]:
+            raise ValueError("Archive " + str(self.folder) + " uses " +
+                             settings["codec"] + ", not " + str(self.codec))
+
+        self.dictionary_id = settings.get("dictionary", NO_DICTIONARY)
+        return True
+
+    def _save_settings(self):
+        _write_atomic(self._get_file(SETTINGS_FILE), json.dumps({
+            "version": ARCHIVE_VERSION,
+            "codec": self.codec,
+            "dictionary": self.dictionary_id
+        }).encode("utf-8"))
+
+    def _get_dictionary(self, dictionary_id):
+        if dictionary_id not in self._dictionaries:
+            path = self._get_file(DICTIONARIES_FOLDER, dictionary_id + ".dict")
+            with open(path, "rb") as i:
+                self._dictionaries[dictionary_id] = i.read()
+
+        return self._dictionaries[dictionary_id]
+
+    def compress(self, content):
+        """
+        :param content: bytes
+            Raw content
+        :return: bytes
+            Blob: codec, id of dictionary and compressed content
+        """
+
+        dictionary = self._get_dictionary(self.dictionary_id)
+        if self.codec == ZSTD:
+            key = (ZSTD, self.dictionary_id)
+            if key not in self._compressors:
+                zstandard = get_zstandard()
+                self._compressors[key] = zstandard.ZstdCompressor(
+                    level=self.level,
+                    dict_data=zstandard.ZstdCompressionDict(dictionary)
+                    if dictionary else None
+                )
+
+            compressed = self._compressors[key].compress(content)
+        else:  # compressobj cannot be reused: one per blob
+            compressor = zlib.compressobj(
+                min(self.level, 9), zlib.DEFLATED, 15, 9,
+                zlib.Z_DEFAULT_STRATEGY, dictionary[-ZLIB_DICTIONARY_SIZE:]
+            ) if dictionary else zlib.compressobj(min(self.level, 9))
+            compressed = compressor.compress(content) + compressor.flush()
+
+        return CODEC_HEADERS[self.codec] + \
+            self.dictionary_id.encode("ascii") + compressed
+
+    def decompress(self, blob):
+        """
+        :param blob: bytes
+            Blob made by compress()
+        :return: bytes
+            Raw content
+        """
+
+        header, dictionary_id = blob[:1], blob[1:9].decode("ascii")
+        dictionary = self._get_dictionary(dictionary_id)
+        if header == CODEC_HEADERS[ZSTD]:
+            zstandard = get_zstandard()
+            if zstandard is None:
+                raise ValueError("Blob compressed with zstd: pip3 install "
+                                 "zstandard to read it")
+
+            return zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(dictionary)
+                if dictionary else None
+            ).decompress(blob[9:])
+
+        if header == CODEC_HEADERS[ZLIB]:
+            decompressor = zlib.decompressobj(
+                15, dictionary[-ZLIB_DICTIONARY_SIZE:]
+            ) if dictionary else zlib.decompressobj()
+            return decompressor.decompress(blob[9:]) + decompressor.flush()
+
+        raise ValueError("Unknown blob codec " + repr(header))
+
+    def _get_blob_file(self, key):
+        return self._get_file(BLOBS_FOLDER, key[:2], key)
+
+    def _iter_blob_files(self):
+        for root, _, files in os.walk(self._get_file(BLOBS_FOLDER)):
+            for f in files:
+                if not f.endswith(".tmp"):
+                    yield os.path.join(root, f)
+
+    def put_blob(self, content):
+        """
+        :param content: str
+            Raw html of section
+        :return: str
+            Key (sha256) of content, stored only if not already in archive
+        """
+
+        content = content.encode("utf-8")
+        key = hashlib.sha256(content).hexdigest()
+        path = self._get_blob_file(key)
+        if os.path.exists(path):
+            get_metrics().incr("archive_duplicates")
+            return key
+
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+        blob = self.compress(content)
+        _write_atomic(path, blob)
+        metrics = get_metrics()
+        metrics.incr("archive_blobs")
+        metrics.incr("archive_raw_bytes", len(content))
+        metrics.incr("archive_stored_bytes", len(blob))
+
+        if self.dictionary_id == NO_DICTIONARY and \
+                self.train_after is not None:
+            if self._blobs_without_dictionary is None:
+                self._blobs_without_dictionary = \
+                    sum(1 for _ in self._iter_blob_files())
+            else:
+                self._blobs_without_dictionary += 1
+
+            if self._blobs_without_dictionary >= self.train_after:
+                self.train()
+
+        return key
+
+    def get_blob(self, key):
+        """
+        :param key: str
+            Key of content
+        :return: str
+            Raw html of section
+        """
+
+        with open(self._get_blob_file(key), "rb") as i:
+            return self.decompress(i.read()).decode("utf-8")
+
+    def train(self, max_samples=DEFAULT_TRAIN_SAMPLES,
+              size=DEFAULT_DICTIONARY_SIZE, recompress=True):
+        """
+        :param max_samples: int
+            Max blobs to train dictionary on
+        :param size: int
+            Max bytes of dictionary
+        :param recompress: bool
+            Compress again blobs stored with another dictionary
+        :return: str
+            Trains a dictionary on stored blobs and uses it for new blobs,
+            returns its id (dictionaries are never removed: old blobs keep
+            being readable)
+        """
+
+        samples = []
+        for path in self._iter_blob_files():
+            if len(samples) >= max_samples:
+                break
+
+            with open(path, "rb") as i:
+                samples.append(self.decompress(i.read()))
+
+        if not samples:
+            return self.dictionary_id
+
+        with get_metrics().timer("train", section="page archive"):
+            if self.codec == ZSTD:
+                zstandard = get_zstandard()
+                try:
+                    dictionary = zstandard.train_dictionary(
+                        size, samples).as_bytes()
+                except zstandard.ZstdError as e:  # e.g too few samples
+                    log_message("Cannot train zstd dictionary:", e)
+                    self._blobs_without_dictionary = 0  # retry later
+                    return self.dictionary_id
+            else:
+                dictionary = train_zlib_dictionary(
+                    samples, min(size, ZLIB_DICTIONARY_SIZE))
+
+        dictionary_id = hashlib.sha256(dictionary).hexdigest()[:8]
+        _write_atomic(
+            self._get_file(DICTIONARIES_FOLDER, dictionary_id + ".dict"),
+            dictionary
+        )
+        self._dictionaries[dictionary_id] = dictionary
+        self.dictionary_id = dictionary_id
+        self._save_settings()
+        log_message("Trained", self.codec, "dictionary of", len(dictionary),
+                    "bytes on", len(samples), "sections")
+
+        if recompress:
+            self.recompress()
+
+        return dictionary_id
+
+    def recompress(self):
+        """
+        :return: int
+            Compresses again (with the dictionary in use) blobs stored with
+            another one, returns number of blobs compressed again
+        """
+
+        header = CODEC_HEADERS[self.codec] + self.dictionary_id.encode("ascii")
+        count = 0
+        for path in self._iter_blob_files():
+            with open(path, "rb") as i:
+                blob = i.read()
+
+            if blob[:9] != header:
+                _write_atomic(path, self.compress(self.decompress(blob)))
+                count += 1
+
+        return count
+
+    def _get_day_file(self, date):
+        return self._get_file(DAYS_FOLDER, str(date) + ".json")
+
+    def put_timeline(self, timeline):
+        """
+        :param timeline: GCDayTimeline
+            Day (its raw html, parsed or not)
+        :return: void
+            Stores raw html of sections of day, and its manifest
+        """
+
+        with get_metrics().timer("write", date=timeline.date,
+                                 section="page archive"):
+            sections = {
+                name: self.put_blob(timeline.sections[name].html)
+                for name in TIMELINE_SECTIONS
+            }
+            _write_atomic(self._get_day_file(timeline.date), json.dumps({
+                "date": str(timeline.date),
+                "sections": sections
+            }).encode("utf-8"))
+
+    def get_dates(self):
+        """
+        :return: [] of str
+            Days (yyyy-mm-dd) in archive, sorted
+        """
+
+        return sorted(
+            f[:-len(".json")] for f in os.listdir(self._get_file(DAYS_FOLDER))
+            if f.endswith(".json")
+        )
+
+    def get_timeline(self, date):
+        """
+        :param date: str or datetime.date
+            Day
+        :return: GCDayTimeline
+            Day rebuilt from its raw html (not parsed yet)
+        """
+
+        with open(self._get_day_file(date)) as i:
+            manifest = json.load(i)
+
+        date_time = datetime.strptime(manifest["date"], "%Y-%m-%d")
+        return GCDayTimeline(date_time, *[
+            self.get_blob(manifest["sections"][name])
+            for name in TIMELINE_SECTIONS
+        ])
+
+    def iter_timelines(self, min_date=None, max_date=None):
+        """
+        :param min_date: str
+            First day (yyyy-mm-dd), None from first day
+        :param max_date: str
+            Last day (yyyy-mm-dd), None to last day
+        :return: generator of GCDayTimeline
+            Days in range rebuilt from their raw html, one at a time
+        """
+
+        for date in self.get_dates():
+            if (min_date is None or date >= str(min_date)) and \
+                    (max_date is None or date <= str(max_date)):
+                yield self.get_timeline(date)
+
+    def get_size(self):
+        """
+        :return: int
+            Bytes of files of archive
+        """
+
+        return sum(
+            os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(self.folder) for f in files
+        )
+
+
+def _write_atomic(path, data):
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "wb") as o:
+        o.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,171 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" On-disk cache of parsed sections, keyed by hash of their raw html """
+
+import hashlib
+import os
+import pickle
+import time
+
+from pygce.models.logger import log_message
+from pygce.models.metrics import get_metrics
+
+CACHE_VERSION = "2"  # bump when parsers change: old entries are then ignored
+DEFAULT_MAX_ENTRIES = 50000  # max sections kept (least recently used go)
+CACHE_FILE_EXTENSION = ".pickle"
+
+
+class ParseCache(object):
+    """
+    Keeps parsed values of sections on disk, so that sections with the same
+    raw html source as before are not parsed again. Entries are evicted by
+    age and least recent use.
+    """
+
+    def __init__(self, folder, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_age_seconds=None):
+        """
+        :param folder: str
+            Folder where to save cache entries
+        :param max_entries: int
+            Max number of entries to keep (least recently used go first)
+        :param max_age_seconds: float
+            Entries not used for longer than this are discarded. None to keep
+            entries regardless of their age
+        """
+
+        object.__init__(self)
+
+        self.folder = folder
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        self.evict()
+
+    @staticmethod
+    def get_key(section):
+        """
+        :param section: GCDaySection
+            Section to find key of
+        :return: str
+            Unique key of section (type and raw html source)
+        """
+
+        h = hashlib.sha1()
+        h.update(CACHE_VERSION.encode("utf-8"))
+        h.update(section.__class__.__name__.encode("utf-8"))
+        h.update(b"\0")
+        h.update(section.html.encode("utf-8"))
+        return h.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.folder, key[:2], key + CACHE_FILE_EXTENSION)
+
+    def _is_expired(self, last_used):
+        if self.max_age_seconds is None:
+            return False
+
+        return time.time() - last_used > self.max_age_seconds
+
+    def get(self, section):
+        """
+        :param section: GCDaySection
+            Section to find
+        :return: dict
+            Parsed values of section, None if not in cache
+        """
+
+        path = self._get_path(self.get_key(section))
+        try:
+            if self._is_expired(os.path.getmtime(path)):
+                os.remove(path)
+                return None
+
+            with open(path, "rb") as i:
+                state = pickle.load(i)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None  # not in cache (or corrupted)
+
+        os.utime(path)  # mark as recently used
+        return state
+
+    def put(self, section):
+        """
+        :param section: GCDaySection
+            Parsed section
+        :return: void
+            Saves parsed values of section
+        """
+
+        path = self._get_path(self.get_key(section))
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+        tmp_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "wb") as o:
+            pickle.dump(section.get_parsed_state(), o)
+        os.replace(tmp_path, path)  # never leave half-written entries
+
+    def parse(self, section):
+        """
+        :param section: GCDaySection
+            Section to parse
+        :return: void
+            Restores parsed values of section if its raw html source has
+            already been parsed, otherwise parses it (and saves values)
+        """
+
+        state = self.get(section)
+        if state is not None:
+            section.set_parsed_state(state)
+            self.hits += 1
+            get_metrics().incr("parse_cache_hits", section=section.tag)
+        else:
+            section.parse()
+            self.put(section)
+            self.misses += 1
+            get_metrics().incr("parse_cache_misses", section=section.tag)
+
+    def _get_entries(self):
+        entries = []
+        for root, _, files in os.walk(self.folder):
+            for f in files:
+                if f.endswith(CACHE_FILE_EXTENSION):
+                    path = os.path.join(root, f)
+                    try:
+                        entries.append((os.path.getmtime(path), path))
+                    except OSError:
+                        pass  # removed in the meantime
+
+        return entries
+
+    def evict(self):
+        """
+        :return: int
+            Removes expired entries and least recently used ones (when there
+            are too many); returns number of entries removed
+        """
+
+        entries = sorted(self._get_entries(), reverse=True)  # newest first
+        to_remove = [
+            path for i, (last_used, path) in enumerate(entries)
+            if i >= self.max_entries or self._is_expired(last_used)
+        ]
+
+        for path in to_remove:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        if to_remove:
+            log_message("Evicted", len(to_remove), "cache entries")
+
+        return len(to_remove)
@@ -0,0 +1,112 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Fails fast when parsers keep failing (e.g Garmin changed markup) """
+
+from pygce.models.logger import log_error, log_message
+
+DEFAULT_BATCH_DAYS = 7  # days to parse before checking failure rates
+
+
+class ParseFailureError(ValueError):
+    """ Too many days could not be parsed """
+
+
+class ParseFailuresMonitor(object):
+    """
+    Counts, for each field of each section, days where the field could not be
+    parsed. Once the first batch of days is parsed (or all days, when they are
+    fewer), aborts the run if a field failed in too many of them.
+    """
+
+    def __init__(self, max_failure_rate=None, batch_days=DEFAULT_BATCH_DAYS):
+        """
+        :param max_failure_rate: float
+            Max fraction (in [0, 1]) of days of the first batch where the same
+            field may fail. None to never abort
+        :param batch_days: int
+            Days in the first batch
+        """
+
+        object.__init__(self)
+
+        self.max_failure_rate = max_failure_rate
+        self.batch_days = batch_days
+        self.days_count = 0
+        self.failed_days = {}  # (section, field) -> days where it failed
+        self.errors = {}  # (section, field) -> name of error -> count
+
+    def add_day(self, timeline):
+        """
+        :param timeline: GCDayTimeline
+            Parsed day
+        :return: void
+            Counts fields that failed in day. Raises ParseFailureError if the
+            first batch is complete and failure rates are too high
+        """
+
+        self.days_count += 1
+        for key, error in timeline.get_failed_fields().items():
+            self.failed_days[key] = self.failed_days.get(key, 0) + 1
+            errors = self.errors.setdefault(key, {})
+            errors[error] = errors.get(error, 0) + 1
+
+        if self.days_count == self.batch_days:
+            self.check()
+
+    def get_failure_rates(self):
+        """
+        :return: {} of (str, str) -> float
+            (section, field) -> fraction of days where it failed
+        """
+
+        if self.days_count == 0:
+            return {}
+
+        return {
+            key: float(days) / self.days_count
+            for key, days in self.failed_days.items()
+        }
+
+    def check(self):
+        """
+        :return: void
+            Raises ParseFailureError if a field failed in too many days
+        """
+
+        if self.max_failure_rate is None:
+            return
+
+        too_many = sorted(
+            (key, rate) for key, rate in self.get_failure_rates().items()
+            if rate > self.max_failure_rate
+        )
+        if too_many:
+            details = ", ".join(
+                section + ":" + field + " (" + str(int(rate * 100)) + "%, " +
+                ", ".join(sorted(self.errors[(section, field)])) + ")"
+                for (section, field), rate in too_many
+            )
+            error = ParseFailureError(
+                "Too many days could not be parsed in the first " +
+                str(self.days_count) + " days: " + details
+            )
+            log_error(error, "Garmin Connect markup may have changed")
+            raise error
+
+    def log_summary(self):
+        """
+        :return: void
+            Logs fields that failed at least once. Raises ParseFailureError
+            if the days were fewer than a batch (so never checked) and failure
+            rates are too high
+        """
+
+        for (section, field), days in sorted(self.failed_days.items()):
+            log_message(
+                "Failed to parse", field, "in", days, "of", self.days_count,
+                "days", section=section
+            )
+
+        if 0 < self.days_count < self.batch_days:
+            self.check()
@@ -0,0 +1,375 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Finds days in output files by date, without parsing the whole files """
+
+import bisect
+import csv
+import io
+import json
+import os
+import re
+
+INDEX_EXTENSION = ".idx.json"  # index is saved next to data file
+INDEX_VERSION = 3  # bump when index changes: old indices are rebuilt
+STEPS_DETAILS_PATTERN = re.compile(
+    r"^step_details_(\d{4}-\d{2}-\d{2})\.(csv|json)$"
+)
+DATE_PATTERN = re.compile(rb"^\d{4}-\d{2}-\d{2}$")
+NDJSON_DATE_PATTERN = re.compile(rb'^\{\s*"date":\s*"(\d{4}-\d{2}-\d{2})"')
+MAX_DATE = "9999-12-31"
+
+
+def get_format(data_file):
+    """
+    :param data_file: str
+        Path to output file
+    :return: str
+        Format of file: csv or ndjson
+    """
+
+    extension = os.path.splitext(data_file)[1].lower()
+    if extension == ".csv":
+        return "csv"
+
+    if extension in (".ndjson", ".jsonl"):
+        return "ndjson"
+
+    raise ValueError("Cannot index " + str(data_file) +
+                     ": only .csv and .ndjson files can be indexed")
+
+
+def iter_records(stream, offset, file_format):
+    """
+    :param stream: file
+        Binary stream of csv or ndjson file, at offset
+    :param offset: int
+        Position of stream
+    :param file_format: str
+        Format of file: csv or ndjson
+    :return: generator of (int, int, bytes)
+        Start, end and bytes of each record of file. A csv record may span
+        many lines (quoted newlines), an ndjson record is always one line
+        (quotes in its strings are escaped). A last record with no newline
+        is not yielded: it may be still being written
+    """
+
+    count_quotes = file_format == "csv"
+    start, record, quotes = offset, [], 0
+    for line in stream:
+        record.append(line)
+        if count_quotes:
+            quotes += line.count(b'"')
+        offset += len(line)
+        if not line.endswith(b"\n"):
+            return  # being written: index it once complete
+
+        if quotes % 2 == 0:  # record is complete
+            yield start, offset, b"".join(record)
+            start, record, quotes = offset, [], 0
+
+
+def get_record_date(record, file_format):
+    """
+    :param record: bytes
+        Record of file
+    :param file_format: str
+        Format of file: csv or ndjson
+    :return: str
+        Date (yyyy-mm-dd) of record, None if record has no date (e.g
+        headers)
+    """
+
+    if file_format == "csv":
+        date = record.split(b",", 1)[0].strip().strip(b'"')
+        return date.decode("ascii") if DATE_PATTERN.match(date) else None
+
+    match = NDJSON_DATE_PATTERN.match(record)
+    if match:
+        return match.group(1).decode("ascii")
+
+    try:  # date is not the first key: parse record
+        date = str(json.loads(record.decode("utf-8")).get("date"))
+        return date if DATE_PATTERN.match(date.encode("ascii")) else None
+    except (ValueError, AttributeError, UnicodeError):
+        return None
+
+
+class DateIndex(object):
+    """
+    Sorted date -> (start, end) byte offsets of the records of a csv or
+    ndjson output file, saved next to it. When the file only grew (days
+    appended), only new records are indexed.
+    """
+
+    def __init__(self, data_file):
+        """
+        :param data_file: str
+            Path to output file (.csv or .ndjson)
+        """
+
+        object.__init__(self)
+
+        self.data_file = data_file
+        self.format = get_format(data_file)
+        self.index_file = data_file + INDEX_EXTENSION
+        self.size = 0  # bytes of file indexed
+        self.mtime_ns = None
+        self.entries = []  # sorted (date, start, end)
+
+    def _get_signature(self):
+        stat = os.stat(self.data_file)
+        return stat.st_size, stat.st_mtime_ns
+
+    def load(self):
+        """
+        :return: bool
+            Loads saved index, True iff it exists and is valid
+        """
+
+        try:
+            with open(self.index_file) as i:
+                saved = json.load(i)
+        except (OSError, ValueError):
+            return False
+
+        if saved.get("version") != INDEX_VERSION or \
+                saved.get("format") != self.format:
+            return False
+
+        self.size = saved["size"]
+        self.mtime_ns = saved["mtime_ns"]
+        self.entries = [tuple(e) for e in saved["entries"]]
+        return True
+
+    def save(self):
+        """
+        :return: void
+            Saves index next to data file
+        """
+
+        tmp_file = self.index_file + "." + str(os.getpid())
+        with open(tmp_file, "w") as o:
+            json.dump({
+                "version": INDEX_VERSION,
+                "format": self.format,
+                "size": self.size,
+                "mtime_ns": self.mtime_ns,
+                "entries": self.entries
+            }, o)
+        os.replace(tmp_file, self.index_file)
+
+    def _is_prefix_unchanged(self, stream):
+        """
+        :return: bool
+            True iff the last record indexed is still where it was (so the
+            file was only appended to)
+        """
+
+        if not self.entries:
+            return self.size == 0
+
+        date, start, end = max(self.entries, key=lambda e: e[1])
+        if end != self.size:
+            return False
+
+        stream.seek(start)
+        return get_record_date(stream.read(end - start), self.format) == date
+
+    def update(self):
+        """
+        :return: DateIndex
+            Indexes records of file not indexed yet (all of them if the file
+            was rewritten), and saves index if it changed
+        """
+
+        if not self.entries:
+            self.load()
+
+        size, mtime_ns = self._get_signature()
+        if (size, mtime_ns) == (self.size, self.mtime_ns):
+            return self
+
+        with open(self.data_file, "rb") as stream:
+            if size < self.size or not self._is_prefix_unchanged(stream):
+                self.size, self.entries = 0, []  # rewritten: start over
+
+            stream.seek(self.size)
+            new_entries = []
+            indexed = self.size  # end of last complete record
+            for start, end, record in iter_records(stream, self.size,
+                                                   self.format):
+                date = get_record_date(record, self.format)
+                if date is not None:
+                    new_entries.append((date, start, end))
+                indexed = end
+
+        self.entries = sorted(self.entries + new_entries)
+        self.mtime_ns = mtime_ns
+        self.size = indexed  # a partial record is read again next time
+        self.save()
+        return self
+
+    def find(self, min_date=None, max_date=None):
+        """
+        :param min_date: str
+            First date (yyyy-mm-dd), None from first day
+        :param max_date: str
+            Last date (yyyy-mm-dd), None to last day
+        :return: [] of (str, int, int)
+            Date, start and end of records of days in range (sorted by date)
+        """
+
+        lo = bisect.bisect_left(self.entries, (str(min_date or ""),))
+        hi = bisect.bisect_right(self.entries,
+                                 (str(max_date or MAX_DATE), float("inf")))
+        return self.entries[lo:hi]
+
+    def find_latest(self, min_date=None, max_date=None):
+        """
+        :param min_date: str
+            First date (yyyy-mm-dd), None from first day
+        :param max_date: str
+            Last date (yyyy-mm-dd), None to last day
+        :return: [] of (str, int, int)
+            Like find() but only the last record of each day (days appended
+            again, e.g by sync, replace their older records)
+        """
+
+        entries = self.find(min_date, max_date)
+        return [
+            e for i, e in enumerate(entries)
+            if i + 1 == len(entries) or entries[i + 1][0] != e[0]
+        ]  # sorted by date then offset: last of each date is newest
+
+
+def parse_fields(fields):
+    """
+    :param fields: [] of str
+        Sections (e.g SLEEP) or fields (e.g SLEEP:deep_sleep_time) to keep
+    :return: [] of (str, str)
+        Section (upper case) and field (None for the whole section)
+    """
+
+    parsed = []
+    for f in fields or []:
+        section, _, field = str(f).partition(":")
+        parsed.append((section.strip().upper(), field.strip() or None))
+
+    return parsed
+
+
+class DaysQuery(object):
+    """ Reads only the days of an output file in a range of dates """
+
+    def __init__(self, data_file):
+        """
+        :param data_file: str
+            Path to output file (.csv or .ndjson)
+        """
+
+        object.__init__(self)
+
+        self.data_file = data_file
+        self.index = DateIndex(data_file).update()
+        self.headers = None
+        if self.index.format == "csv":
+            with open(data_file, "r", newline="") as i:
+                self.headers = next(csv.reader(i), [])
+
+    def _parse(self, record, fields):
+        text = record.decode("utf-8")
+        if self.index.format == "csv":
+            values = next(csv.reader(io.StringIO(text, newline="")))
+            day = dict(zip(self.headers, values))
+            if fields:
+                day = {
+                    h: v for h, v in day.items() if h == "date" or any(
+                        h.upper().startswith(s + ":") and
+                        (f is None or h.split(":", 1)[1] == f)
+                        for s, f in fields
+                    )
+                }
+
+            return day
+
+        day = json.loads(text)
+        if fields:
+            projected = {"date": day.get("date")}
+            for name, section in day.items():
+                for s, f in fields:
+                    if name.upper() != s:
+                        continue
+
+                    if f is None:
+                        projected[name] = section
+                    elif isinstance(section, dict) and f in section:
+                        projected.setdefault(name, {})[f] = section[f]
+
+            day = projected
+
+        return day
+
+    def iter_days(self, min_date=None, max_date=None, fields=None):
+        """
+        :param min_date: str
+            First date (yyyy-mm-dd), None from first day
+        :param max_date: str
+            Last date (yyyy-mm-dd), None to last day
+        :param fields: [] of str
+            Sections (e.g SLEEP) or fields (e.g SLEEP:deep_sleep_time) to
+            keep, None to keep all
+        :return: generator of {}
+            Days in range (sorted by date): only their records are read.
+            When a day was written more than once, only its last record is
+        """
+
+        fields = parse_fields(fields)
+        with open(self.data_file, "rb") as stream:
+            for _, start, end in self.index.find_latest(min_date, max_date):
+                stream.seek(start)
+                yield self._parse(stream.read(end - start), fields)
+
+
+class StepsDetailsQuery(object):
+    """ Reads steps details files of days in a range of dates """
+
+    def __init__(self, folder):
+        """
+        :param folder: str
+            Folder with step_details_<date>.csv (or .json) files
+        """
+
+        object.__init__(self)
+
+        self.folder = folder
+        self.entries = []  # sorted (date, file name)
+        for name in os.listdir(folder):
+            match = STEPS_DETAILS_PATTERN.match(name)
+            if match:
+                self.entries.append((match.group(1), name))
+
+        self.entries.sort()
+
+    def iter_days(self, min_date=None, max_date=None):
+        """
+        :param min_date: str
+            First date (yyyy-mm-dd), None from first day
+        :param max_date: str
+            Last date (yyyy-mm-dd), None to last day
+        :return: generator of {}
+            Date and 15-minute bins of days in range (sorted by date)
+        """
+
+        lo = bisect.bisect_left(self.entries, (str(min_date or ""),))
+        hi = bisect.bisect_right(self.entries, (str(max_date or MAX_DATE),
+                                                "~"))
+        for date, name in self.entries[lo:hi]:
+            path = os.path.join(self.folder, name)
+            with open(path, "r", newline="") as i:
+                if name.endswith(".csv"):
+                    bins = list(csv.DictReader(i))
+                else:
+                    bins = json.load(i).get("15-min bins", [])
+
+            yield {"date": date, "bins": bins}
@@ -0,0 +1,361 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Dense store of the 15-minute steps bins of each day """
+
+import json
+import os
+
+import numpy as np
+
+from pygce.models.logger import log_message
+
+SLOTS_PER_DAY = 96  # 15-minute bins
+MINUTES_PER_SLOT = 15
+SLOTS_PER_HOUR = 60 // MINUTES_PER_SLOT
+MISSING = -1  # steps of bins not fetched (yet)
+STEPS_FILE = "steps.npy"  # days x bins, int32
+TOTALS_FILE = "totals.npy"  # total steps of day reported by Garmin, int32
+INDEX_FILE = "index.json"  # first date and number of days stored
+DEFAULT_ACTIVE_STEPS = 250  # min steps in an hour to count it as active
+
+
+class StepsStore(object):
+    """
+    Steps of each 15-minute bin of each day, in a (days x 96) int32 matrix
+    saved as .npy and memory-mapped. Rows are consecutive calendar days from
+    the first date stored (the date index), bins not fetched are -1. The
+    matrix grows (doubling its rows) as days are added, so it can be filled
+    incrementally as days are exported.
+    """
+
+    def __init__(self, folder):
+        """
+        :param folder: str
+            Folder of store (created if it does not exist)
+        """
+
+        object.__init__(self)
+
+        self.folder = folder
+        self.start = None  # date of first row (numpy.datetime64)
+        self.days = 0  # rows in use (the others are room for new days)
+        self.steps = np.full((0, SLOTS_PER_DAY), MISSING, dtype=np.int32)
+        self.totals = np.full(0, MISSING, dtype=np.int32)
+
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        self.load()
+
+    def __len__(self):
+        return self.days
+
+    def _get_file(self, name):
+        return os.path.join(self.folder, name)
+
+    def load(self):
+        """
+        :return: void
+            Memory-maps matrix of store (if any)
+        """
+
+        try:
+            with open(self._get_file(INDEX_FILE)) as i:
+                index = json.load(i)
+        except (OSError, ValueError):
+            return  # empty store
+
+        self.start = np.datetime64(index["start"], "D")
+        self.days = int(index["days"])
+        self.steps = np.load(self._get_file(STEPS_FILE), mmap_mode="r+")
+        self.totals = np.load(self._get_file(TOTALS_FILE), mmap_mode="r+")
+
+    def _save_index(self, start, days):
+        tmp_file = self._get_file(INDEX_FILE + "." + str(os.getpid()))
+        with open(tmp_file, "w") as o:
+            json.dump({"start": str(start), "days": int(days)}, o)
+        os.replace(tmp_file, self._get_file(INDEX_FILE))
+
+    def _save(self, start, days, steps, totals):
+        for name, data in ((STEPS_FILE, steps), (TOTALS_FILE, totals)):
+            tmp_file = self._get_file(name + "." + str(os.getpid()))
+            np.save(tmp_file, data)  # appends .npy to name
+            os.replace(tmp_file + ".npy", self._get_file(name))
+
+        self._save_index(start, days)
+
+    def _resize(self, first, last):
+        """
+        :param first: numpy.datetime64
+            First date to store
+        :param last: numpy.datetime64
+            Last date to store
+        :return: void
+            Grows matrix (rewriting it) to hold days from first to last
+        """
+
+        start = first if self.start is None else min(first, self.start)
+        end = last if self.start is None else \
+            max(last, self.start + len(self) - 1)
+        days = int((end - start).astype(int)) + 1
+        if start == self.start and days <= self.steps.shape[0]:
+            if days > self.days:  # room left for new days
+                self.days = days
+                self._save_index(self.start, self.days)
+            return
+
+        rows = days
+        if self.start is not None and start == self.start:
+            rows = max(days, 2 * self.steps.shape[0])  # amortise appends
+
+        steps = np.full((rows, SLOTS_PER_DAY), MISSING, dtype=np.int32)
+        totals = np.full(rows, MISSING, dtype=np.int32)
+        if self.start is not None:
+            offset = int((self.start - start).astype(int))
+            steps[offset:offset + self.days] = self.steps[:self.days]
+            totals[offset:offset + self.days] = self.totals[:self.days]
+
+        self.steps, self.totals = None, None  # release old memory map
+        self._save(start, days, steps, totals)
+        self.load()
+
+    def get_row(self, date):
+        """
+        :param date: numpy.datetime64 or str or datetime.date
+            Day
+        :return: int
+            Row of day in matrix (may be out of matrix)
+        """
+
+        return int((np.datetime64(date, "D") - self.start).astype(int))
+
+    def get_dates(self):
+        """
+        :return: numpy.ndarray
+            Date of each row
+        """
+
+        if self.start is None:
+            return np.array([], dtype="datetime64[D]")
+
+        return self.start + np.arange(self.days)
+
+    def put(self, bins, total=None, date=None):
+        """
+        :param bins: [] of {}
+            15-minute bins, with time (yyyy-mm-dd hh:mm:ss) and steps
+        :param total: int
+            Total steps of day reported by Garmin (None if unknown)
+        :param date: numpy.datetime64 or str or datetime.date
+            Day of bins to store (bins of other days are skipped), None to
+            store bins of all days
+        :return: int
+            Stores bins, returns number of bins stored
+        """
+
+        times = np.array([b["time"] for b in bins], dtype="datetime64[m]")
+        steps = np.array([b["steps"] for b in bins], dtype=np.int32)
+        days = times.astype("datetime64[D]")
+        if date is not None:
+            date = np.datetime64(date, "D")
+            keep = days == date
+            times, steps, days = times[keep], steps[keep], days[keep]
+            first = last = date
+        elif days.size:
+            first, last = days.min(), days.max()
+        else:
+            return 0
+
+        self._resize(first, last)
+        slots = (times - days).astype(int) // MINUTES_PER_SLOT
+        self.steps[(days - self.start).astype(int), slots] = steps
+        if date is not None and total is not None:
+            self.totals[self.get_row(date)] = int(total)
+
+        return int(steps.size)
+
+    def put_timeline(self, timeline):
+        """
+        :param timeline: GCDayTimeline
+            Parsed day
+        :return: int
+            Stores steps bins of day, returns number of bins stored
+        """
+
+        return self.put(
+            timeline.sections["steps details"].bins,
+            timeline.sections["steps"].total,
+            timeline.date
+        )
+
+    def flush(self):
+        """
+        :return: void
+            Writes changes to disk
+        """
+
+        for data in (self.steps, self.totals):
+            if isinstance(data, np.memmap):
+                data.flush()
+
+    def get_rows(self, min_date=None, max_date=None):
+        """
+        :param min_date: numpy.datetime64 or str or datetime.date
+            First day (None: first day stored)
+        :param max_date: numpy.datetime64 or str or datetime.date
+            Last day (None: last day stored)
+        :return: tuple numpy.ndarray, numpy.ndarray
+            Dates and steps bins (view of store) of days in range
+        """
+
+        if self.start is None:
+            return self.get_dates(), self.steps
+
+        first = 0 if min_date is None else max(self.get_row(min_date), 0)
+        last = len(self) - 1 if max_date is None else \
+            min(self.get_row(max_date), len(self) - 1)
+        rows = slice(first, max(last + 1, first))
+        return self.get_dates()[rows], self.steps[rows]
+
+    def get_hourly_steps(self, min_date=None, max_date=None):
+        """
+        :param min_date: numpy.datetime64 or str or datetime.date
+            First day (None: first day stored)
+        :param max_date: numpy.datetime64 or str or datetime.date
+            Last day (None: last day stored)
+        :return: tuple numpy.ndarray, numpy.ndarray
+            Dates and steps of each hour (days x 24) of days in range, NaN if
+            no bin of hour is known
+        """
+
+        dates, steps = self.get_rows(min_date, max_date)
+        hours = np.asarray(steps).reshape(len(dates), 24, SLOTS_PER_HOUR)
+        known = hours != MISSING
+        hourly = np.where(known, hours, 0).sum(axis=2).astype(float)
+        hourly[~known.any(axis=2)] = np.nan
+        return dates, hourly
+
+    def get_totals(self, min_date=None, max_date=None):
+        """
+        :param min_date: numpy.datetime64 or str or datetime.date
+            First day (None: first day stored)
+        :param max_date: numpy.datetime64 or str or datetime.date
+            Last day (None: last day stored)
+        :return: tuple numpy.ndarray, numpy.ndarray
+            Dates and total steps (sum of bins) of days in range, NaN if no
+            bin of day is known
+        """
+
+        dates, hourly = self.get_hourly_steps(min_date, max_date)
+        known = ~np.isnan(hourly)
+        totals = np.where(known, hourly, 0).sum(axis=1)
+        totals[~known.any(axis=1)] = np.nan
+        return dates, totals
+
+    def get_hourly_profile(self, min_date=None, max_date=None):
+        """
+        :param min_date: numpy.datetime64 or str or datetime.date
+            First day (None: first day stored)
+        :param max_date: numpy.datetime64 or str or datetime.date
+            Last day (None: last day stored)
+        :return: numpy.ndarray
+            Average steps of each hour of day (24), over days in range
+        """
+
+        _, hourly = self.get_hourly_steps(min_date, max_date)
+        return _nan_mean(hourly, axis=0)
+
+    def get_weekday_profiles(self, min_date=None, max_date=None):
+        """
+        :param min_date: numpy.datetime64 or str or datetime.date
+            First day (None: first day stored)
+        :param max_date: numpy.datetime64 or str or datetime.date
+            Last day (None: last day stored)
+        :return: numpy.ndarray
+            Average steps of each hour (7 x 24) of each weekday (Monday
+            first), over days in range
+        """
+
+        dates, hourly = self.get_hourly_steps(min_date, max_date)
+        weekdays = (dates.astype(int) + 3) % 7  # 1970-01-01 was a Thursday
+        one_hot = (weekdays[None, :] == np.arange(7)[:, None]).astype(float)
+        known = ~np.isnan(hourly)
+        sums = one_hot @ np.where(known, hourly, 0.0)
+        counts = one_hot @ known
+        return np.divide(sums, counts, out=np.full(sums.shape, np.nan),
+                         where=counts > 0)
+
+    def get_weekday_averages(self, min_date=None, max_date=None):
+        """
+        :param min_date: numpy.datetime64 or str or datetime.date
+            First day (None: first day stored)
+        :param max_date: numpy.datetime64 or str or datetime.date
+            Last day (None: last day stored)
+        :return: numpy.ndarray
+            Average total steps of each weekday (Monday first)
+        """
+
+        dates, totals = self.get_totals(min_date, max_date)
+        weekdays = (dates.astype(int) + 3) % 7
+        known = ~np.isnan(totals)
+        sums = np.bincount(weekdays[known], totals[known], minlength=7)
+        counts = np.bincount(weekdays[known], minlength=7)
+        return np.divide(sums, counts, out=np.full(7, np.nan),
+                         where=counts > 0)
+
+    def get_active_hours(self, min_steps=DEFAULT_ACTIVE_STEPS, min_date=None,
+                         max_date=None):
+        """
+        :param min_steps: int
+            Min steps in an hour to count it as active
+        :param min_date: numpy.datetime64 or str or datetime.date
+            First day (None: first day stored)
+        :param max_date: numpy.datetime64 or str or datetime.date
+            Last day (None: last day stored)
+        :return: tuple numpy.ndarray, numpy.ndarray
+            Dates and active hours (bool, days x 24) of days in range
+        """
+
+        dates, hourly = self.get_hourly_steps(min_date, max_date)
+        with np.errstate(invalid="ignore"):
+            return dates, hourly >= min_steps
+
+    def reconcile(self, tolerance=0, min_date=None, max_date=None):
+        """
+        :param tolerance: int
+            Max difference between sum of bins and total of day
+        :param min_date: numpy.datetime64 or str or datetime.date
+            First day (None: first day stored)
+        :param max_date: numpy.datetime64 or str or datetime.date
+            Last day (None: last day stored)
+        :return: [] of (numpy.datetime64, float, int)
+            Days where sum of bins differs from total steps reported by
+            Garmin (GCDaySteps.total), with both values. Bins are in GMT,
+            totals in the time zone of the user: they may differ by the steps
+            of a few hours
+        """
+
+        dates, totals = self.get_totals(min_date, max_date)
+        first = self.get_row(dates[0]) if dates.size else 0
+        reported = np.asarray(self.totals[first:first + dates.size])
+        known = ~np.isnan(totals) & (reported != MISSING)
+        different = known & (np.abs(np.where(known, totals, 0) - reported) >
+                             tolerance)
+        mismatches = [
+            (d, float(t), int(r)) for d, t, r in
+            zip(dates[different], totals[different], reported[different])
+        ]
+        for d, t, r in mismatches:
+            log_message("Steps bins sum to", int(t), "but total is", r,
+                        date=d)
+
+        return mismatches
+
+
+def _nan_mean(values, axis):
+    known = ~np.isnan(values)
+    sums = np.where(known, values, 0.0).sum(axis=axis)
+    counts = known.sum(axis=axis)
+    return np.divide(sums, counts, out=np.full(sums.shape, np.nan),
+                     where=counts > 0)
@@ -6,9 +6,8 @@ import abc
 import json
 from datetime import datetime, timedelta
 
-from bs4 import BeautifulSoup
-
 from pygce.models.garmin import utils
+from pygce.models.metrics import get_metrics
 
 
 class GCDaySection:
@@ -16,7 +15,11 @@ class GCDaySection:
     Standard section in the Garmin Connect timeline of day.
     """
 
-    def __init__(self, raw_html, tag=""):
+    TAG = ""  # unique key in order not to mistake this GCDaySection with another one
+    CSV_FIELDS = ()  # fields (in order) this section writes to csv rows
+    PARSE_INPUTS = ("tag", "html", "_soup")  # fields NOT found by parsing
+
+    def __init__(self, raw_html, tag=None):
         """
         :param raw_html: str
             HTML source snippet with information about section
@@ -24,9 +27,29 @@ class GCDaySection:
             Unique str in order not to mistake this GCDaySection with another one
         """
 
-        self.tag = tag  # unique key in order not to mistake this GCDaySection with another one
+        self.tag = self.TAG if tag is None else tag
         self.html = str(raw_html)
-        self.soup = BeautifulSoup(self.html, "html.parser")
+        self._soup = None  # built on first use
+        self.parse_results = []  # (field, None or name of error) of parsing
+
+    @property
+    def soup(self):
+        """
+        :return: BeautifulSoup
+            Parser of raw html source (built only when needed, e.g parsed
+            values may come from cache)
+        """
+
+        if self._soup is None:
+            if self.html is None:
+                raise ValueError("Raw html of " + str(self.tag) + " was "
+                                 "released after parsing")
+
+            from bs4 import BeautifulSoup  # slow to import: only when needed
+
+            self._soup = BeautifulSoup(self.html, "html.parser")
+
+        return self._soup
 
     @abc.abstractmethod
     def parse(self):
@@ -35,6 +58,57 @@ class GCDaySection:
             Parses raw html source and tries to finds all information
         """
 
+    def parse_field(self, field, parser, *args):
+        """
+        :param field: str
+            Name of field (or group of fields) found by parser
+        :param parser: callable
+            Parses raw html source and stores value(s) of field
+        :param args: []
+            Args of parser
+        :return: void
+            Runs parser, field is left untouched (None) if parser fails.
+            Outcome is saved in self.parse_results
+        """
+
+        try:
+            parser(*args)
+            self.parse_results.append((field, None))
+        except Exception as e:
+            self.parse_results.append((field, e.__class__.__name__))
+
+    def release_inputs(self):
+        """
+        :return: void
+            Drops raw html source and its parser (the largest fields of a
+            section), keeping only values found by parsing. The section
+            cannot be parsed again
+        """
+
+        self.html = None
+        self._soup = None
+
+    def get_parsed_state(self):
+        """
+        :return: dict
+            Values found by parsing (obj fields that are not parse inputs)
+        """
+
+        return {
+            k: v for k, v in self.__dict__.items()
+            if k not in self.PARSE_INPUTS
+        }
+
+    def set_parsed_state(self, state):
+        """
+        :param state: dict
+            Values found by a previous parsing of the same raw html source
+        :return: void
+            Restores parsed values without parsing again
+        """
+
+        self.__dict__.update(state)
+
     def to_dict(self):
         """
         :return: dict
@@ -55,6 +129,15 @@ class GCDaySection:
 
         return json.dumps(d)
 
+    @classmethod
+    def get_csv_headers(cls):
+        """
+        :return: [] of str
+            Columns this section writes to csv rows, known before parsing
+        """
+
+        return [str(cls.TAG) + ":" + k for k in cls.CSV_FIELDS]
+
     def to_csv_dict(self):
         """
         :return: {}
@@ -63,9 +146,9 @@ class GCDaySection:
 
         d = self.to_dict()
         csv_d = {}
-        for k in d.keys():
+        for k in self.CSV_FIELDS:
             new_key = str(self.tag) + ":" + k
-            csv_d[new_key] = str(d[k])  # edit key
+            csv_d[new_key] = str(d.get(k))  # edit key
         return csv_d
 
 
@@ -75,33 +158,25 @@ class GCDaySummary(GCDaySection):
     Common features are likes, comment, kcal
     """
 
+    TAG = "SUMMARY"
+    CSV_FIELDS = ("likes", "comment", "kcal_count")
+
     def __init__(self, raw_html):
         """
         :param raw_html: str
             HTML source snippet with information about section
         """
 
-        super().__init__(raw_html, tag="SUMMARY")
+        super().__init__(raw_html)
 
         self.likes = None
         self.comment = None
         self.kcal_count = None
 
     def parse(self):
-        try:
-            self.parse_likes()
-        except:
-            pass
-
-        try:
-            self.parse_comment()
-        except:
-            pass
-
-        try:
-            self.parse_kcal_count()
-        except:
-            pass
+        self.parse_field("likes", self.parse_likes)
+        self.parse_field("comment", self.parse_comment)
+        self.parse_field("kcal_count", self.parse_kcal_count)
 
     def parse_likes(self):
         """
@@ -153,13 +228,16 @@ class GCDaySteps(GCDaySection):
     Common features are total, goal, distance, avg daily
     """
 
+    TAG = "STEPS"
+    CSV_FIELDS = ("total", "goal", "avg", "distance")
+
     def __init__(self, raw_html):
         """
         :param raw_html: str
             HTML source snippet with information about section
         """
 
-        super().__init__(raw_html, tag="STEPS")
+        super().__init__(raw_html)
 
         self.total = None
         self.goal = None
@@ -167,15 +245,8 @@ class GCDaySteps(GCDaySection):
         self.distance = None
 
     def parse(self):
-        try:
-            self.parse_steps_count()
-        except:
-            pass
-
-        try:
-            self.parse_steps_stats()
-        except:
-            pass
+        self.parse_field("steps_count", self.parse_steps_count)
+        self.parse_field("steps_stats", self.parse_steps_stats)
 
     def parse_steps_count(self):
         """
@@ -222,11 +293,15 @@ class GCDaySteps(GCDaySection):
 class GCDetailsSteps(GCDaySection):
     """Steps divided into 15-minute bins"""
 
+    TAG = "STEPS DETAILS"
+    CSV_FIELDS = ()  # bins are saved in their own file, not in the day row
+    BINS_CSV_FIELDS = ("time", "steps")  # columns of the bins csv file
+    PARSE_INPUTS = GCDaySection.PARSE_INPUTS + ("date_time", "content")
     DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
     OUT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
     def __init__(self, date_time, raw_html):
-        super().__init__(raw_html, tag="STEPS DETAILS")
+        super().__init__(raw_html)
 
         self.date_time = date_time
         self.content = json.loads(self.html)
@@ -242,7 +317,19 @@ class GCDetailsSteps(GCDaySection):
 
         return int(raw)
 
+    def release_inputs(self):
+        super().release_inputs()
+        self.content = None
+
     def parse(self):
+        self.parse_field("bins", self.parse_bins)
+
+    def parse_bins(self):
+        """
+        :return: void
+            Finds steps of each 15-minute bin
+        """
+
         for data in self.content:
             date_time = data['startGMT'][:-2]  # remove trailing 0
             date_time = datetime.strptime(date_time, self.DATE_FORMAT)
@@ -267,13 +354,19 @@ class GCDaySleep(GCDaySection):
     Common features are total, deep total, light total, awake total
     """
 
+    TAG = "SLEEP"
+    CSV_FIELDS = (
+        "night_sleep_time", "nap_time", "total_sleep_time", "bed_time",
+        "wake_time", "deep_sleep_time", "light_sleep_time", "awake_sleep_time"
+    )
+
     def __init__(self, raw_html):
         """
         :param raw_html: str
             HTML source snippet with information about section
         """
 
-        super().__init__(raw_html, tag="SLEEP")
+        super().__init__(raw_html)
 
         self.night_sleep_time = None
         self.nap_time = None
@@ -285,20 +378,9 @@ class GCDaySleep(GCDaySection):
         self.awake_sleep_time = None  # time during night you were awake
 
     def parse(self):
-        try:
-            self.parse_sleep_totals()
-        except:
-            pass
-
-        try:
-            self.parse_bed_time()
-        except:
-            pass
-
-        try:
-            self.parse_sleep_times()
-        except:
-            pass
+        self.parse_field("sleep_totals", self.parse_sleep_totals)
+        self.parse_field("bed_time", self.parse_bed_time)
+        self.parse_field("sleep_times", self.parse_sleep_times)
 
     def parse_sleep_totals(self):
         """
@@ -375,23 +457,32 @@ class GCDayActivities(GCDaySection):
 
     GPX_DOWNLOAD_URL = "https://connect.garmin.com/modern/proxy/download-service/export/gpx/activity/"
 
+    TAG = "ACTIVITIES"
+    CSV_FIELDS = ("kcal", "duration", "distance")
+
     def __init__(self, raw_html):
         """
         :param raw_html: str
             HTML source snippet with information about section
         """
 
-        super().__init__(raw_html, tag="ACTIVITIES")
+        super().__init__(raw_html)
         self.activities = []
 
     def parse(self):
         rows = self.soup.find_all("tr")
         for r in rows[1:]:  # discard header
-            try:
-                activity = self.parse_activity(r)
-                self.activities.append(activity)
-            except:
-                pass
+            self.parse_field("activity", self.parse_activity_row, r)
+
+    def parse_activity_row(self, raw_html):
+        """
+        :param raw_html: str html code
+            Raw HTML code of row of table containing activity to parse
+        :return: void
+            Parses activity and stores it
+        """
+
+        self.activities.append(self.parse_activity(raw_html))
 
     @staticmethod
     def parse_activity(raw_html):
@@ -512,13 +603,19 @@ class GCDayBreakdown(GCDaySection):
     Common features are highly active %, active %, sedentary %, sleep %
     """
 
+    TAG = "BREAKDOWN"
+    CSV_FIELDS = ("highly_active", "active", "sedentary", "sleeping")
+    VALUES_FIELDS = (
+        "highly_active", "active", "sedentary", "sleeping"
+    )  # fields in the same order as values in the chart
+
     def __init__(self, raw_html):
         """
         :param raw_html: str
             HTML source snippet with information about section
         """
 
-        super().__init__(raw_html, tag="BREAKDOWN")
+        super().__init__(raw_html)
 
         self.highly_active = None
         self.active = None
@@ -530,25 +627,20 @@ class GCDayBreakdown(GCDaySection):
         values = [str(v.text).strip().replace("%", "") for v in
                   values]  # remove jibberish
 
-        try:
-            self.highly_active = utils.parse_num(values[0])
-        except:
-            pass  # None
+        for i, field in enumerate(self.VALUES_FIELDS):
+            self.parse_field(field, self.parse_value, field, values[i:i + 1])
 
-        try:
-            self.active = utils.parse_num(values[1])
-        except:
-            pass  # None
-
-        try:
-            self.sedentary = utils.parse_num(values[2])
-        except:
-            pass  # None
+    def parse_value(self, field, values):
+        """
+        :param field: str
+            Name of field to store
+        :param values: [] of str
+            Raw value of field (empty if not found)
+        :return: void
+            Parses value and stores it
+        """
 
-        try:
-            self.sleeping = utils.parse_num(values[3])
-        except:
-            pass  # None
+        setattr(self, field, utils.parse_num(values[0]))
 
     def to_dict(self):
         return {
@@ -570,6 +662,14 @@ class GCDayTimeline(object):
     - breakdown (highly active %, active %, sedentary %, sleep %)
     """
 
+    CSV_SECTIONS = [
+        GCDaySummary,
+        GCDaySteps,
+        GCDaySleep,
+        GCDayActivities,
+        GCDayBreakdown
+    ]  # sections (in order) with a column in csv rows
+
     def __init__(self, date_time, summary_html,
                  steps_section_html, steps_details_html,
                  sleep_section_html, activities_section_html,
@@ -601,14 +701,56 @@ class GCDayTimeline(object):
             "breakdown": GCDayBreakdown(breakdown_section_html)
         }  # list of sections in day
 
-    def parse(self):
+    def parse(self, cache=None):
         """
+        :param cache: ParseCache
+            Parsed values of sections already seen. When given, sections with
+            the same raw html source as before are not parsed again
         :return: void
             Finds all sections to parse, then builds corresponding objects and parses everything
         """
 
+        metrics = get_metrics()
         for section in self.sections.values():  # parse each section
-            section.parse()
+            with metrics.timer("parse", date=self.date, section=section.tag):
+                if cache is None:
+                    section.parse()
+                else:
+                    cache.parse(section)
+
+            for field, error in section.parse_results:
+                if error is None:
+                    metrics.incr("parsed_fields", section=section.tag,
+                                 field=field)
+                else:
+                    metrics.incr("parse_failures", section=section.tag,
+                                 field=field, error=error)
+
+    def release_inputs(self):
+        """
+        :return: void
+            Drops raw html sources of all sections once parsed, so that
+            parsed days kept in memory (e.g for .json outputs) hold only
+            parsed values
+        """
+
+        for section in self.sections.values():
+            section.release_inputs()
+
+    def get_failed_fields(self):
+        """
+        :return: {} of (str, str) -> str
+            (section tag, field) -> name of error, for each field that could
+            not be parsed
+        """
+
+        failed = {}
+        for section in self.sections.values():
+            for field, error in section.parse_results:
+                if error is not None:
+                    failed[(section.tag, field)] = error
+
+        return failed
 
     def __getattr__(self, item):
         return self.sections[item]
@@ -621,6 +763,19 @@ class GCDayTimeline(object):
 
         return self.sections
 
+    @classmethod
+    def get_csv_headers(cls):
+        """
+        :return: [] of str
+            Columns of csv rows, the same for every day (parsed or not)
+        """
+
+        headers = ["date"]
+        for section in cls.CSV_SECTIONS:
+            headers += section.get_csv_headers()
+
+        return headers
+
     def to_csv_dict(self):
         """
         :return: {}
@@ -0,0 +1,216 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Streaming writers of parsed days """
+
+import csv
+import io
+import json
+import os
+
+from pygce.models.garmin.timeline import GCDayTimeline, GCDetailsSteps
+from pygce.models.metrics import get_metrics
+
+
+class DaysWriter(object):
+    """ Writes days to a file one at a time, as soon as they are parsed """
+
+    def __init__(self, output_file, append=False):
+        """
+        :param output_file: str
+            Path where to save output to
+        :param append: bool
+            Add days to the end of output file instead of overwriting it
+        """
+
+        object.__init__(self)
+
+        self.output_file = output_file
+        self.append = append
+        self.rows_count = 0
+        self._stream = None
+
+    def is_new_file(self):
+        """
+        :return: bool
+            True iff output file is written from scratch (it is overwritten,
+            or there is nothing to append to)
+        """
+
+        return not self.append or not os.path.exists(self.output_file) or \
+            os.path.getsize(self.output_file) == 0
+
+    def open(self):
+        """
+        :return: void
+            Opens output file
+        """
+
+        self._stream = open(self.output_file, "a" if self.append else "w",
+                            newline="")
+
+    def serialize(self, timeline):
+        """
+        :param timeline: GCDayTimeline
+            Parsed day
+        :return: object
+            Record of day to write
+        """
+
+        raise NotImplementedError()
+
+    def format_record(self, record):
+        """
+        :param record: object
+            Record of day
+        :return: str
+            Text of record, as written to output file
+        """
+
+        raise NotImplementedError()
+
+    def write_record(self, record):
+        """
+        :param record: object
+            Record of day
+        :return: void
+            Writes record to output file
+        """
+
+        self._stream.write(self.format_record(record))
+
+    def write(self, timeline):
+        """
+        :param timeline: GCDayTimeline
+            Parsed day to write
+        :return: void
+            Writes record of day
+        """
+
+        metrics = get_metrics()
+        with metrics.tagged(date=timeline.date):
+            with metrics.timer("serialize"):
+                record = self.serialize(timeline)
+
+            with metrics.timer("write"):
+                self.write_record(record)
+
+        self.rows_count += 1
+
+    def close(self):
+        """
+        :return: void
+            Flushes and closes output file
+        """
+
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CSVDaysWriter(DaysWriter):
+    """
+    Writes days to a csv file one row at a time. Columns are declared by the
+    sections definitions, so nothing needs to be buffered to find headers.
+    """
+
+    def __init__(self, output_file, append=False):
+        """
+        :param output_file: str
+            Path where to save output to
+        :param append: bool
+            Add days to the end of output file instead of overwriting it
+        """
+
+        DaysWriter.__init__(self, output_file, append)
+
+        self.headers = GCDayTimeline.get_csv_headers()
+        self._buffer = io.StringIO(newline="")  # text of a row
+        self._writer = csv.DictWriter(self._buffer, self.headers)
+
+    def open(self):
+        """
+        :return: void
+            Opens output file and writes headers (unless appending to them)
+        """
+
+        write_headers = self.is_new_file()
+        DaysWriter.open(self)
+        if write_headers:
+            csv.DictWriter(self._stream, self.headers).writeheader()
+
+    def serialize(self, timeline):
+        return timeline.to_csv_dict()
+
+    def format_record(self, record):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._writer.writerow(record)
+        return self._buffer.getvalue()
+
+
+class NDJSONDaysWriter(DaysWriter):
+    """
+    Writes days to a newline-delimited json file: one json object per line,
+    starting with the date of the day (so days can be indexed by date without
+    parsing them). Steps details are saved in their own files.
+    """
+
+    SKIP_SECTIONS = ("steps details",)
+
+    def serialize(self, timeline):
+        record = {"date": str(timeline.date)}  # first key of line
+        for name, section in timeline.sections.items():
+            if name not in self.SKIP_SECTIONS:
+                record[name] = json.loads(section.to_json())
+
+        return record
+
+    def format_record(self, record):
+        return json.dumps(record) + "\n"
+
+
+def get_steps_details_file(output_folder, date, extension):
+    """
+    :param output_folder: str
+        Folder where to save steps details
+    :param date: datetime.date
+        Day of steps details
+    :param extension: str
+        Format of file (e.g "csv", "json")
+    :return: str
+        Path of steps details file of day
+    """
+
+    output_file = 'step_details_' + str(date) + '.' + extension
+    return os.path.join(output_folder, output_file)
+
+
+def write_csv_steps_details(timeline, output_folder):
+    """
+    :param timeline: GCDayTimeline
+        Parsed day
+    :param output_folder: str
+        Folder where to save steps details
+    :return: int
+        Writes 15-minutes bins of day to its own csv file (just headers when
+        the day has no bins), returns number of rows written
+    """
+
+    output_file = get_steps_details_file(output_folder, timeline.date, "csv")
+    bins = timeline.sections["steps details"].bins
+    with get_metrics().timer("write", date=timeline.date,
+                             section="steps details"), \
+            open(output_file, "w") as o:  # write to file
+        dict_writer = csv.DictWriter(o, GCDetailsSteps.BINS_CSV_FIELDS)
+        dict_writer.writeheader()
+        dict_writer.writerows(bins)
+
+    return len(bins)
@@ -4,37 +4,140 @@
 
 """ App logging tools """
 
+import atexit
 import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
 
 # formatting
 LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 
 LOG_LEVEL = logging.DEBUG
 
+RECORD_FIELDS = ("date", "section", "url", "elapsed")  # structured fields
+
+
+class StructuredFormatter(logging.Formatter):
+    """ Appends structured fields of records (date, url ...) to messages """
+
+    def format(self, record):
+        text = super().format(record)
+        fields = [
+            k + "=" + str(getattr(record, k)) for k in RECORD_FIELDS
+            if getattr(record, k, None) is not None
+        ]
+        if fields:
+            text += " " + " ".join(fields)
+
+        return text
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only 1 of every n records of high-frequency events (records are
+    grouped by their "event" field)
+    """
+
+    def __init__(self, sample_rates=None):
+        """
+        :param sample_rates: {} of str -> int
+            Event -> keep 1 of every these records. Records of other events
+            are always kept
+        """
+
+        logging.Filter.__init__(self)
+
+        self.sample_rates = dict(sample_rates or {})
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        rate = self.sample_rates.get(getattr(record, "event", None))
+        if not rate or rate <= 1:
+            return True
+
+        with self._lock:
+            count = self._counts.get(record.event, 0)
+            self._counts[record.event] = count + 1
+
+        return count % rate == 0
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Puts records on a queue as they are: unlike QueueHandler, messages are
+    formatted by the listener thread, only when actually emitted
+    """
+
+    def prepare(self, record):
+        return record  # same process: no need to make record picklable
+
+
 LOGGER = logging.getLogger("pygce")
 LOGGER.setLevel(LOG_LEVEL)
+LOGGER.propagate = False
 
 STREAM_HANDLER = logging.StreamHandler()
-STREAM_HANDLER.setLevel(LOG_LEVEL)
-STREAM_HANDLER.setFormatter(logging.Formatter(LOG_FORMAT))
+STREAM_HANDLER.setLevel(logging.NOTSET)  # level is set by logger
+STREAM_HANDLER.setFormatter(StructuredFormatter(LOG_FORMAT))
+
+SAMPLING_FILTER = SamplingFilter()
+
+LOG_QUEUE = queue.Queue()
+QUEUE_HANDLER = DeferredQueueHandler(LOG_QUEUE)
+QUEUE_HANDLER.addFilter(SAMPLING_FILTER)  # dropped records are never queued
+QUEUE_LISTENER = QueueListener(LOG_QUEUE, STREAM_HANDLER)
 
-LOGGER.addHandler(STREAM_HANDLER)
+LOGGER.addHandler(QUEUE_HANDLER)
+QUEUE_LISTENER.start()
+atexit.register(QUEUE_LISTENER.stop)  # flush records left in queue
 
 
 def get_logger():
     return LOGGER
 
 
-def log_message(*message):
+def configure_logging(level=None, sample_rates=None):
+    """
+    :param level: int or str
+        Min level of records to log (e.g logging.INFO or "INFO")
+    :param sample_rates: {} of str -> int
+        Event -> keep 1 of every these debug records
+    :return: void
+        Sets level and sampling of logger
+    """
+
+    if level is not None:
+        LOGGER.setLevel(level)
+
+    if sample_rates is not None:
+        SAMPLING_FILTER.sample_rates = dict(sample_rates)
+
+
+def log_message(*message, **fields):
+    """
+    :param message: [] of anything
+        Parts of message (joined by spaces, only if record is emitted)
+    :param fields: {}
+        Structured fields of record (e.g date, url, section, elapsed, and
+        event to group records to sample)
+    :return: void
+        Logs debug message
+    """
+
     logger = get_logger()
-    logger.debug(" ".join(message))
+    if not logger.isEnabledFor(logging.DEBUG):
+        return  # nothing to do
+
+    logger.debug(" ".join(["%s"] * len(message)), *message, extra=fields)
 
 
-def log_error(exception, cause=None):
+def log_error(exception, cause=None, **fields):
     logger = get_logger()
     text = str(exception)
 
     if cause:
         text += " because " + str(cause)
 
-    logger.error(text)
+    logger.error(text, extra=fields)
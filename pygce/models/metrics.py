@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+""" Run timers and counters """
+
+import json
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+PERCENTILES = [50, 95, 99]  # percentiles of timings in reports
+PROMETHEUS_PREFIX = "pygce"
+PROMETHEUS_EXTENSION = ".prom"
+
+
+def get_percentile(sorted_values, percentile):
+    """
+    :param sorted_values: [] of float
+        Values sorted in ascending order
+    :param percentile: float
+        Percentile to find (in [0, 100])
+    :return: float
+        Nearest-rank percentile of values
+    """
+
+    if not sorted_values:
+        return None
+
+    rank = int(math.ceil(percentile / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def get_stats(values):
+    """
+    :param values: [] of float
+        Timings (seconds)
+    :return: {}
+        Count, total, mean and percentiles of timings
+    """
+
+    sorted_values = sorted(values)
+    total = sum(sorted_values)
+    stats = {
+        "count": len(sorted_values),
+        "total": total,
+        "mean": total / len(sorted_values) if sorted_values else None,
+    }
+    for p in PERCENTILES:
+        stats["p" + str(p)] = get_percentile(sorted_values, p)
+
+    return stats
+
+
+def get_resource_usage():
+    """
+    :return: {}
+        CPU seconds, peak and current resident memory (bytes) of this
+        process. Current memory is None where /proc is not available
+    """
+
+    usage = {"cpu_seconds": time.process_time(), "max_rss_bytes": None,
+             "rss_bytes": None}
+    try:
+        import resource  # not on Windows
+
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage["max_rss_bytes"] = max_rss if sys.platform == "darwin" else \
+            max_rss * 1024  # kilobytes on Linux
+    except ImportError:
+        pass
+
+    try:
+        with open("/proc/self/statm") as i:
+            pages = int(i.read().split()[1])
+        usage["rss_bytes"] = pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return usage
+
+
+def _get_prometheus_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join(
+        k + "=\"" + str(v).replace("\\", "\\\\").replace("\"", "\\\"") + "\""
+        for k, v in sorted(labels.items())
+    ) + "}"
+
+
+class Metrics(object):
+    """
+    Collects timings of run phases (login, page loads, parsing ...) and
+    counters. Each value is tagged (e.g by date and section), either
+    explicitly or by the enclosing tagged() block.
+    """
+
+    def __init__(self):
+        object.__init__(self)
+
+        self.started = time.time()
+        self.timings = {}  # (phase, tags) -> [] of seconds
+        self.counters = {}  # (name, tags) -> value
+        self.gauges = {}  # (name, tags) -> last value
+        self._lock = threading.Lock()
+        self._local = threading.local()  # tags of enclosing blocks
+
+    def _get_context(self):
+        if not hasattr(self._local, "tags"):
+            self._local.tags = {}
+
+        return self._local.tags
+
+    def _get_key(self, name, tags):
+        all_tags = dict(self._get_context())
+        all_tags.update(tags)
+        return name, tuple(sorted(all_tags.items()))
+
+    @contextmanager
+    def tagged(self, **tags):
+        """
+        :param tags: {}
+            Tags to add to every value recorded in block
+        :return: void
+            Tags values recorded in block (by this thread)
+        """
+
+        previous = self._get_context()
+        current = dict(previous)
+        current.update({k: str(v) for k, v in tags.items()})
+        self._local.tags = current
+        try:
+            yield
+        finally:
+            self._local.tags = previous
+
+    def observe(self, phase, seconds, **tags):
+        """
+        :param phase: str
+            Name of phase timed
+        :param seconds: float
+            Time spent in phase
+        :param tags: {}
+            Tags of value
+        :return: void
+            Records timing of phase
+        """
+
+        key = self._get_key(phase, {k: str(v) for k, v in tags.items()})
+        with self._lock:
+            self.timings.setdefault(key, []).append(seconds)
+
+    @contextmanager
+    def timer(self, phase, **tags):
+        """
+        :param phase: str
+            Name of phase to time
+        :param tags: {}
+            Tags of value
+        :return: void
+            Records time spent in block (even when block raises)
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start, **tags)
+
+    def incr(self, name, value=1, **tags):
+        """
+        :param name: str
+            Name of counter
+        :param value: float
+            Amount to add to counter
+        :param tags: {}
+            Tags of value
+        :return: void
+            Increments counter
+        """
+
+        key = self._get_key(name, {k: str(v) for k, v in tags.items()})
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **tags):
+        """
+        :param name: str
+            Name of gauge
+        :param value: float
+            Current value
+        :param tags: {}
+            Tags of value
+        :return: void
+            Sets gauge (e.g memory in use) to value
+        """
+
+        key = self._get_key(name, {k: str(v) for k, v in tags.items()})
+        with self._lock:
+            self.gauges[key] = value
+
+    def _get_phases(self):
+        phases = {}  # phase -> all timings (regardless of tags)
+        for (phase, _), values in self.timings.items():
+            phases.setdefault(phase, []).extend(values)
+
+        return phases
+
+    def _get_counters_totals(self):
+        totals = {}  # counter -> total (regardless of tags)
+        for (name, _), value in self.counters.items():
+            totals[name] = totals.get(name, 0) + value
+
+        return totals
+
+    def to_dict(self):
+        """
+        :return: {}
+            Report with totals and percentiles of each phase (overall and
+            by tags) and counters
+        """
+
+        with self._lock:
+            phases = {
+                phase: get_stats(values)
+                for phase, values in sorted(self._get_phases().items())
+            }
+            series = [
+                {
+                    "phase": phase,
+                    "tags": dict(tags),
+                    "stats": get_stats(values)
+                }
+                for (phase, tags), values in sorted(self.timings.items())
+            ]
+            counters = [
+                {
+                    "name": name,
+                    "tags": dict(tags),
+                    "value": value
+                }
+                for (name, tags), value in sorted(self.counters.items())
+            ]
+            counters_totals = self._get_counters_totals()
+            gauges = [
+                {
+                    "name": name,
+                    "tags": dict(tags),
+                    "value": value
+                }
+                for (name, tags), value in sorted(self.gauges.items())
+            ]
+
+        return {
+            "elapsed": time.time() - self.started,
+            "phases": phases,
+            "counters": counters_totals,
+            "series": series,
+            "series counters": counters,
+            "gauges": gauges
+        }
+
+    def to_prometheus(self):
+        """
+        :return: str
+            Report in the Prometheus text format (one summary per phase,
+            tags are left out to keep the number of series small)
+        """
+
+        name = PROMETHEUS_PREFIX + "_phase_seconds"
+        lines = [
+            "# TYPE " + name + " summary"
+        ]
+        with self._lock:
+            phases = self._get_phases()
+            counters_totals = self._get_counters_totals()
+            gauges = sorted(self.gauges.items())
+
+        for phase, values in sorted(phases.items()):
+            stats = get_stats(values)
+            for p in PERCENTILES:
+                labels = _get_prometheus_labels({
+                    "phase": phase,
+                    "quantile": str(p / 100.0)
+                })
+                lines.append(name + labels + " " + repr(stats["p" + str(p)]))
+
+            labels = _get_prometheus_labels({"phase": phase})
+            lines.append(name + "_sum" + labels + " " + repr(stats["total"]))
+            lines.append(name + "_count" + labels + " " + str(stats["count"]))
+
+        for counter, value in sorted(counters_totals.items()):
+            counter_name = PROMETHEUS_PREFIX + "_" + counter + "_total"
+            lines.append("# TYPE " + counter_name + " counter")
+            lines.append(counter_name + " " + repr(value))
+
+        declared = set()
+        for (gauge, tags), value in gauges:
+            gauge_name = PROMETHEUS_PREFIX + "_" + gauge
+            if gauge_name not in declared:
+                lines.append("# TYPE " + gauge_name + " gauge")
+                declared.add(gauge_name)
+            lines.append(gauge_name + _get_prometheus_labels(dict(tags)) +
+                         " " + repr(value))
+
+        elapsed_name = PROMETHEUS_PREFIX + "_run_seconds"
+        lines.append("# TYPE " + elapsed_name + " gauge")
+        lines.append(elapsed_name + " " + repr(time.time() - self.started))
+        return "\n".join(lines) + "\n"
+
+    def save(self, output_file):
+        """
+        :param output_file: str
+            Path where to save report to. Prometheus textfile if it ends with
+            .prom, json otherwise
+        :return: void
+            Saves report
+        """
+
+        with open(output_file, "w") as o:
+            if output_file.endswith(PROMETHEUS_EXTENSION):
+                o.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), o, sort_keys=True, indent=4,
+                          separators=(',', ': '))
+
+
+METRICS = Metrics()
+
+
+def get_metrics():
+    return METRICS
@@ -0,0 +1,638 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Work queue of (account, day) jobs, shared by workers through SQLite """
+
+import os
+import socket
+import sqlite3
+import time
+import traceback
+from datetime import datetime
+
+from pygce.models.batch import DEFAULT_PROFILES_FOLDER, create_account_bot
+from pygce.models.garmin.writers import NDJSONDaysWriter
+from pygce.models.logger import log_error, log_message
+from pygce.models.metrics import get_metrics
+
+DEFAULT_LEASE_SECONDS = 600  # workers not renewing leases for longer crashed
+DEFAULT_MAX_ATTEMPTS = 3  # then jobs are marked as failed
+DEFAULT_POLL_SECONDS = 30  # wait of idle workers before claiming again
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+STATES = [PENDING, LEASED, DONE, FAILED]
+DAY_EXTENSION = ".json"  # one file per day: <folder>/<account>/<date>.json
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    account TEXT NOT NULL,
+    date TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_expires REAL,
+    updated REAL NOT NULL,
+    error TEXT,
+    PRIMARY KEY (account, date)
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, date, account);
+CREATE TABLE IF NOT EXISTS accounts (
+    account TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    lease_expires REAL NOT NULL
+);
+"""  # accounts: worker with a browser open on the profile of each account
+
+
+def get_owner():
+    """
+    :return: str
+        Name of this worker (host and process), to tell leases apart
+    """
+
+    return socket.gethostname() + ":" + str(os.getpid())
+
+
+class WorkQueue(object):
+    """
+    Jobs (account, day) in a SQLite database, e.g on a filesystem shared by
+    many machines. Workers claim jobs with a lease: when a worker crashes,
+    its leases expire and its jobs are claimed by other workers. An account
+    is held by one worker at a time (one browser per profile, one session
+    per account) until the worker releases it. Every change is a short
+    transaction, so many workers can share the database.
+    """
+
+    def __init__(self, db_file, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, timeout=60.0):
+        """
+        :param db_file: str
+            Path of database (created if it does not exist)
+        :param lease_seconds: float
+            Seconds a claimed job belongs to a worker, unless renewed
+        :param max_attempts: int
+            Claims of a job before it is marked as failed
+        :param timeout: float
+            Max seconds to wait for other workers to unlock the database
+        """
+
+        object.__init__(self)
+
+        self.db_file = db_file
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._db = sqlite3.connect(db_file, timeout=timeout,
+                                   isolation_level=None)  # explicit BEGIN
+        self._db.executescript(SCHEMA)
+
+    def _transaction(self):
+        self._db.execute("BEGIN IMMEDIATE")  # lock now: no lost updates
+
+    def enqueue(self, account, dates):
+        """
+        :param account: str
+            Name of account
+        :param dates: [] of str
+            Days (yyyy-mm-dd) to fetch
+        :return: int
+            Adds jobs not already in queue (whatever their state), returns
+            number of jobs added
+        """
+
+        now = time.time()
+        self._transaction()
+        try:
+            added = 0
+            for date in dates:
+                added += self._db.execute(
+                    "INSERT OR IGNORE INTO jobs (account, date, state, updated)"
+                    " VALUES (?, ?, ?, ?)", (account, str(date), PENDING, now)
+                ).rowcount
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+        return added
+
+    def _expire(self, now):
+        self._db.execute(
+            "DELETE FROM accounts WHERE lease_expires < ?", (now,)
+        )  # worker crashed with a browser open
+        self._db.execute(
+            "UPDATE jobs SET state = ?, owner = NULL, lease_expires = NULL, "
+            "updated = ?, error = 'lease expired' WHERE state = ? AND "
+            "lease_expires < ? AND attempts >= ?",
+            (FAILED, now, LEASED, now, self.max_attempts)
+        )  # crashed too many times
+        return self._db.execute(
+            "UPDATE jobs SET state = ?, owner = NULL, lease_expires = NULL, "
+            "updated = ? WHERE state = ? AND lease_expires < ?",
+            (PENDING, now, LEASED, now)
+        ).rowcount
+
+    def reclaim(self):
+        """
+        :return: int
+            Puts back in queue jobs whose lease expired (their worker
+            crashed or hangs), returns their number. Jobs claimed too many
+            times are marked as failed
+        """
+
+        self._transaction()
+        try:
+            count = self._expire(time.time())
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+        if count:
+            log_message("Reclaimed", count, "expired jobs")
+            get_metrics().incr("queue_reclaimed", count)
+
+        return count
+
+    def claim(self, owner, limit=1, accounts=None, current_account=None):
+        """
+        :param owner: str
+            Name of worker
+        :param limit: int
+            Max jobs to claim
+        :param accounts: [] of str
+            Claim only jobs of these accounts, None for any account
+        :param current_account: str
+            Account the worker has a browser open for: its jobs are claimed
+            first, so that the browser is not restarted
+        :return: [] of (str, str)
+            Jobs (account and day) of one account, not held by other
+            workers: the current account if it has jobs left, otherwise the
+            account with the oldest day (so that accounts progress
+            together). The account is held by owner until released
+        """
+
+        now = time.time()
+        query = "SELECT account FROM jobs WHERE state = ? AND account NOT " \
+                "IN (SELECT account FROM accounts WHERE owner != ?)"
+        params = [PENDING, owner]
+        if accounts is not None:
+            query += " AND account IN (" + ",".join("?" * len(accounts)) + ")"
+            params += list(accounts)
+        query += " ORDER BY account = ? DESC, date, account LIMIT 1"
+        params.append(current_account)
+
+        self._transaction()
+        try:
+            reclaimed = self._expire(now)
+            jobs = []
+            row = self._db.execute(query, params).fetchone()
+            if row is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO accounts (account, owner, "
+                    "lease_expires) VALUES (?, ?, ?)",
+                    (row[0], owner, now + self.lease_seconds)
+                )
+                jobs = self._db.execute(
+                    "SELECT account, date FROM jobs WHERE state = ? AND "
+                    "account = ? ORDER BY date LIMIT ?",
+                    (PENDING, row[0], int(limit))
+                ).fetchall()
+            self._db.executemany(
+                "UPDATE jobs SET state = ?, owner = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated = ? WHERE account = ? AND "
+                "date = ?",
+                [(LEASED, owner, now + self.lease_seconds, now, a, d)
+                 for a, d in jobs]
+            )
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+        metrics = get_metrics()
+        metrics.incr("queue_claimed", len(jobs))
+        if reclaimed:
+            metrics.incr("queue_reclaimed", reclaimed)
+
+        return [(a, d) for a, d in jobs]
+
+    def _update_leased(self, owner, account, date, state, error=None):
+        now = time.time()
+        self._transaction()
+        try:
+            updated = self._db.execute(
+                "UPDATE jobs SET state = ?, owner = ?, lease_expires = ?, "
+                "updated = ?, error = COALESCE(?, error) WHERE account = ? AND "
+                "date = ? AND state = ? AND owner = ?",
+                (state, owner if state == LEASED else None,
+                 now + self.lease_seconds if state == LEASED else None,
+                 now, error, account, str(date), LEASED, owner)
+            ).rowcount
+            if state == LEASED:
+                self._db.execute(
+                    "UPDATE accounts SET lease_expires = ? WHERE account = ? "
+                    "AND owner = ?",
+                    (now + self.lease_seconds, account, owner)
+                )  # worker is alive: keep account too
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+        return updated > 0
+
+    def renew(self, owner, account, date):
+        """
+        :param owner: str
+            Name of worker
+        :param account: str
+            Account of job
+        :param date: str
+            Day of job
+        :return: bool
+            Extends lease of job, False if it is no longer owner's (lease
+            expired and job was claimed by another worker)
+        """
+
+        return self._update_leased(owner, account, date, LEASED)
+
+    def complete(self, owner, account, date):
+        """
+        :param owner: str
+            Name of worker
+        :param account: str
+            Account of job
+        :param date: str
+            Day of job
+        :return: bool
+            Marks job as done, False if lease was lost (the other worker
+            writes the same output: days are saved idempotently)
+        """
+
+        return self._update_leased(owner, account, date, DONE)
+
+    def fail(self, owner, account, date, error):
+        """
+        :param owner: str
+            Name of worker
+        :param account: str
+            Account of job
+        :param date: str
+            Day of job
+        :param error: str
+            Why job failed
+        :return: bool
+            Puts job back in queue (or marks it as failed after too many
+            attempts), False if lease was lost
+        """
+
+        now = time.time()
+        self._transaction()
+        try:
+            updated = self._db.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? "
+                "END, owner = NULL, lease_expires = NULL, updated = ?, "
+                "error = ? WHERE account = ? AND date = ? AND state = ? AND "
+                "owner = ?",
+                (self.max_attempts, FAILED, PENDING, now, str(error), account,
+                 str(date), LEASED, owner)
+            ).rowcount
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+        return updated > 0
+
+    def release_accounts(self, owner, keep=None):
+        """
+        :param owner: str
+            Name of worker
+        :param keep: str
+            Account to keep holding, None to release all of them
+        :return: void
+            Lets other workers claim jobs of accounts held by owner (call it
+            once the browsers of the accounts are closed)
+        """
+
+        self._transaction()
+        try:
+            self._db.execute(
+                "DELETE FROM accounts WHERE owner = ? AND account IS NOT ?",
+                (owner, keep)
+            )
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def release(self, owner):
+        """
+        :param owner: str
+            Name of worker
+        :return: int
+            Puts back in queue all jobs leased to owner and releases its
+            accounts (e.g worker stops), returns number of jobs
+        """
+
+        self._transaction()
+        try:
+            count = self._db.execute(
+                "UPDATE jobs SET state = ?, owner = NULL, lease_expires = "
+                "NULL, attempts = MAX(attempts - 1, 0), updated = ? WHERE "
+                "state = ? AND owner = ?",
+                (PENDING, time.time(), LEASED, owner)
+            ).rowcount
+            self._db.execute("DELETE FROM accounts WHERE owner = ?", (owner,))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+        return count
+
+    def retry_failed(self, account=None):
+        """
+        :param account: str
+            Account of jobs, None for all accounts
+        :return: int
+            Puts back in queue failed jobs (with no attempts), returns
+            their number
+        """
+
+        query = "UPDATE jobs SET state = ?, attempts = 0, error = NULL, " \
+                "updated = ? WHERE state = ?"
+        params = [PENDING, time.time(), FAILED]
+        if account is not None:
+            query += " AND account = ?"
+            params.append(account)
+
+        self._transaction()
+        try:
+            count = self._db.execute(query, params).rowcount
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+        return count
+
+    def get_counts(self):
+        """
+        :return: {} str -> {} str -> int
+            Account -> state -> number of jobs
+        """
+
+        counts = {}
+        for account, state, count in self._db.execute(
+                "SELECT account, state, COUNT(*) FROM jobs "
+                "GROUP BY account, state ORDER BY account"):
+            counts.setdefault(account, {s: 0 for s in STATES})[state] = count
+
+        return counts
+
+    def get_errors(self, limit=20):
+        """
+        :param limit: int
+            Max jobs to return
+        :return: [] of (str, str, str, int, str)
+            Account, day, state, attempts and error of last jobs that failed
+            at least once
+        """
+
+        return self._db.execute(
+            "SELECT account, date, state, attempts, error FROM jobs WHERE "
+            "error IS NOT NULL ORDER BY updated DESC LIMIT ?", (int(limit),)
+        ).fetchall()
+
+    def has_work(self):
+        """
+        :return: bool
+            True iff some jobs are pending or leased
+        """
+
+        return self._db.execute(
+            "SELECT 1 FROM jobs WHERE state IN (?, ?) LIMIT 1",
+            (PENDING, LEASED)
+        ).fetchone() is not None
+
+    def close(self):
+        self._db.close()
+
+
+def get_day_file(output_folder, account, date):
+    """
+    :param output_folder: str
+        Folder of outputs of queue
+    :param account: str
+        Name of account
+    :param date: str
+        Day (yyyy-mm-dd)
+    :return: str
+        Path of file of day of account
+    """
+
+    return os.path.join(output_folder, account, str(date) + DAY_EXTENSION)
+
+
+def save_day_file(timeline, output_file):
+    """
+    :param timeline: GCDayTimeline
+        Parsed day
+    :param output_file: str
+        Path of file of day
+    :return: void
+        Saves day as one json line (like .ndjson outputs), replacing the
+        file at once: running a job again just rewrites the same file
+    """
+
+    writer = NDJSONDaysWriter(output_file)
+    text = writer.format_record(writer.serialize(timeline))
+    tmp_file = output_file + "." + get_owner().replace(":", "_") + ".tmp"
+    with open(tmp_file, "w") as o:
+        o.write(text)
+    os.replace(tmp_file, output_file)
+
+
+def merge_days(output_folder, account, output_file):
+    """
+    :param output_folder: str
+        Folder of outputs of queue
+    :param account: str
+        Name of account
+    :param output_file: str
+        Path of output file (.ndjson)
+    :return: int
+        Joins files of days of account (sorted by date) into one .ndjson
+        output, returns number of days
+    """
+
+    folder = os.path.join(output_folder, account)
+    names = sorted(f for f in os.listdir(folder) if f.endswith(DAY_EXTENSION))
+    with open(output_file, "w") as o:
+        for name in names:
+            with open(os.path.join(folder, name)) as i:
+                o.write(i.read())
+
+    return len(names)
+
+
+class QueueWorker(object):
+    """
+    Claims jobs of a WorkQueue and fetches them with a bot per account
+    (restarted with the profile of the account when it changes), saving each
+    day in its own file. Jobs of the account of the open browser are claimed
+    first, and an account is released only once its browser is closed.
+    """
+
+    def __init__(self, queue, accounts, chromedriver, output_folder,
+                 owner=None, batch_jobs=1,
+                 profiles_folder=DEFAULT_PROFILES_FOLDER, bot_factory=None):
+        """
+        :param queue: WorkQueue
+            Queue of jobs
+        :param accounts: [] of Account
+            Accounts (with credentials) the worker can fetch
+        :param chromedriver: str
+            Path to chromedriver to use
+        :param output_folder: str
+            Folder where to save a file per day of each account
+        :param owner: str
+            Name of worker (None: host and process)
+        :param batch_jobs: int
+            Jobs to claim at a time
+        :param profiles_folder: str
+            Folder with a browser profile per account
+        :param bot_factory: callable
+            (account, chromedriver, profile folder) -> bot. None to use
+            GarminConnectBot
+        """
+
+        object.__init__(self)
+
+        self.queue = queue
+        self.accounts = {a.name: a for a in accounts}
+        self.chromedriver = chromedriver
+        self.output_folder = output_folder
+        self.owner = owner or get_owner()
+        self.batch_jobs = max(1, int(batch_jobs))
+        self.profiles_folder = profiles_folder
+        self.bot_factory = bot_factory or create_account_bot
+        self.done = 0
+        self.failed = 0
+        self._bot = None
+        self._account = None
+
+    def _get_bot(self, account):
+        if self._account is not account:
+            self.close()
+            self.queue.release_accounts(self.owner, account.name)
+            with get_metrics().timer("browser_start", account=account.name):
+                self._bot = self.bot_factory(
+                    account, self.chromedriver,
+                    os.path.join(self.profiles_folder, account.name))
+            self._account = account
+
+        return self._bot
+
+    def run_job(self, account_name, date):
+        """
+        :param account_name: str
+            Account of job
+        :param date: str
+            Day of job
+        :return: bool
+            Fetches day and saves it, then marks job as done (or failed);
+            True iff it was done
+        """
+
+        metrics = get_metrics()
+        if not self.queue.renew(self.owner, account_name, date):
+            metrics.incr("queue_lost_leases")
+            return False  # expired while doing previous jobs
+
+        try:
+            account = self.accounts[account_name]
+            bot = self._get_bot(account)
+            day = datetime.strptime(date, "%Y-%m-%d")
+            output_file = get_day_file(self.output_folder, account.name, date)
+            folder = os.path.dirname(output_file)
+            if not os.path.exists(folder):
+                os.makedirs(folder, exist_ok=True)
+
+            with metrics.tagged(account=account.name), \
+                    metrics.timer("queue_job"):
+                for d in bot.iter_parsed_days(day, day):
+                    save_day_file(d, output_file)
+                    bot.save_json_steps_details([d], folder)
+                    bot.save_gpx([d])
+
+                if bot.missing_days:  # bot gave up: let the queue retry
+                    raise ValueError(date + " could not be fetched")
+        except Exception as e:
+            traceback.print_exc()
+            log_error(e, account=account_name, date=date)
+            if not isinstance(e, KeyError):  # unknown account: keep bot
+                self.close()  # browser may be broken: start a new one
+
+            self.queue.fail(self.owner, account_name, date,
+                            e.__class__.__name__ + ": " + str(e))
+            metrics.incr("queue_failed_jobs")
+            self.failed += 1
+            return False
+
+        self.queue.complete(self.owner, account_name, date)
+        metrics.incr("queue_done_jobs")
+        self.done += 1
+        return True
+
+    def run(self, max_jobs=None, wait=False, poll_seconds=DEFAULT_POLL_SECONDS):
+        """
+        :param max_jobs: int
+            Jobs to run, None for all of them
+        :param wait: bool
+            When there are no jobs to claim, wait for new ones (or for
+            leases of crashed workers to expire) instead of stopping
+        :param poll_seconds: float
+            Seconds between claims when there are no jobs
+        :return: int
+            Runs jobs, returns number of jobs done
+        """
+
+        try:
+            while max_jobs is None or self.done + self.failed < max_jobs:
+                limit = self.batch_jobs if max_jobs is None else \
+                    min(self.batch_jobs, max_jobs - self.done - self.failed)
+                jobs = self.queue.claim(
+                    self.owner, limit, sorted(self.accounts),
+                    self._account.name if self._account else None)
+                if not jobs:
+                    self.close()  # let other workers take its account
+                    self.queue.release_accounts(self.owner)
+                    if not wait and not self.queue.has_work():
+                        break
+
+                    time.sleep(poll_seconds)  # leased jobs may expire
+                    continue
+
+                for account_name, date in jobs:
+                    self.run_job(account_name, date)
+        finally:
+            self.close()  # before releasing its account
+            self.queue.release(self.owner)
+
+        return self.done
+
+    def close(self):
+        """
+        :return: void
+            Closes browser (if any)
+        """
+
+        if self._bot is not None:
+            try:
+                self._bot.close()
+            finally:
+                self._bot, self._account = None, None
+
@@ -0,0 +1,175 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Keeps an output file in sync with the latest days, with one bot """
+
+import os
+import time
+from datetime import datetime, timedelta
+
+from pygce.models.garmin.query import DateIndex
+from pygce.models.garmin.writers import CSVDaysWriter, NDJSONDaysWriter
+from pygce.models.logger import log_error, log_message
+from pygce.models.metrics import get_metrics, get_resource_usage
+
+DEFAULT_DAYS_BACK = 1  # today and yesterday
+DEFAULT_INTERVAL_SECONDS = 3600
+WRITERS = {
+    "csv": CSVDaysWriter,
+    "ndjson": NDJSONDaysWriter
+}  # format of output file -> writer that can append to it
+
+
+class DaysSync(object):
+    """
+    Fetches the latest days again and again with the same (logged in) bot,
+    appending to the output file only the days that changed since they were
+    last written. Readers of the output (e.g pygce query) keep the last
+    record of each day.
+    """
+
+    def __init__(self, bot, output_file, days_back=DEFAULT_DAYS_BACK,
+                 path_metrics=None):
+        """
+        :param bot: GarminConnectBot
+            Bot to fetch days with (kept alive between cycles)
+        :param output_file: str
+            Path of output file to append days to (.csv or .ndjson)
+        :param days_back: int
+            Days before today to fetch again at each cycle
+        :param path_metrics: str
+            Path where to save metrics after each cycle, None to not save
+            them
+        """
+
+        object.__init__(self)
+
+        format_out = output_file.split(".")[-1]
+        if format_out not in WRITERS:
+            raise ValueError("Can only sync to .csv or .ndjson files")
+
+        self.bot = bot
+        self.output_file = output_file
+        self.output_folder = os.path.dirname(output_file)
+        self.format = format_out
+        self.days_back = days_back
+        self.path_metrics = path_metrics
+        self.cycles = 0
+
+    def get_written_records(self, min_date, max_date):
+        """
+        :param min_date: str
+            First date (yyyy-mm-dd)
+        :param max_date: str
+            Last date (yyyy-mm-dd)
+        :return: {} str -> str
+            Date -> text of last record of day in output file
+        """
+
+        if not os.path.exists(self.output_file):
+            return {}
+
+        index = DateIndex(self.output_file).update()
+        records = {}
+        with open(self.output_file, "rb") as stream:
+            for date, start, end in index.find_latest(min_date, max_date):
+                stream.seek(start)
+                records[date] = stream.read(end - start).decode("utf-8")
+
+        return records
+
+    def save_steps_details(self, timeline):
+        """
+        :param timeline: GCDayTimeline
+            Parsed day
+        :return: void
+            Saves (overwriting) steps details of day, like exports do
+        """
+
+        if self.format == "csv":
+            self.bot.save_csv_steps_details([timeline], self.output_folder)
+        else:
+            self.bot.save_json_steps_details([timeline], self.output_folder)
+
+    def run_cycle(self, now=None):
+        """
+        :param now: datetime
+            Time of cycle (None: now)
+        :return: int
+            Fetches latest days, appends the ones that changed, returns their
+            number
+        """
+
+        now = now or datetime.now()
+        last = datetime(now.year, now.month, now.day)
+        first = last - timedelta(days=self.days_back)
+        written = self.get_written_records(str(first.date()),
+                                           str(last.date()))
+
+        metrics = get_metrics()
+        changed = 0
+        with metrics.timer("sync_cycle"), \
+                WRITERS[self.format](self.output_file, append=True) as writer:
+            for d in self.bot.iter_parsed_days(first, last):
+                record = writer.serialize(d)
+                if written.get(str(d.date)) == writer.format_record(record):
+                    metrics.incr("sync_unchanged_days")
+                    continue
+
+                with metrics.tagged(date=d.date), metrics.timer("write"):
+                    writer.write_record(record)
+                self.save_steps_details(d)
+                self.bot.save_gpx([d])
+                metrics.incr("sync_changed_days")
+                changed += 1
+
+        self.cycles += 1
+        return changed
+
+    def record_resources(self, cycle_seconds):
+        """
+        :param cycle_seconds: float
+            Time taken by last cycle
+        :return: void
+            Sets gauges of last cycle (latency, memory and cpu in use), and
+            saves metrics
+        """
+
+        metrics = get_metrics()
+        metrics.gauge("sync_cycles", self.cycles)
+        metrics.gauge("sync_last_cycle_seconds", cycle_seconds)
+        for name, value in get_resource_usage().items():
+            if value is not None:
+                metrics.gauge(name, value)
+
+        if self.path_metrics:
+            metrics.save(self.path_metrics)
+
+    def watch(self, interval_seconds=DEFAULT_INTERVAL_SECONDS,
+              max_cycles=None):
+        """
+        :param interval_seconds: float
+            Seconds between starts of cycles
+        :param max_cycles: int
+            Cycles to run, None to run until interrupted
+        :return: void
+            Runs cycles on schedule. A failed cycle is logged and retried at
+            the next one (the bot logs in again when its session expires)
+        """
+
+        cycle = 0
+        while max_cycles is None or cycle < max_cycles:
+            start = time.perf_counter()
+            try:
+                changed = self.run_cycle()
+                log_message("Synced", changed, "changed days",
+                            cycle=self.cycles)
+            except Exception as e:  # keep the daemon alive
+                log_error(e)
+                get_metrics().incr("sync_errors")
+
+            elapsed = time.perf_counter() - start
+            self.record_resources(elapsed)
+            cycle += 1
+            if max_cycles is None or cycle < max_cycles:
+                time.sleep(max(interval_seconds - elapsed, 0))
@@ -39,5 +39,8 @@ setup(
         'numpy',
         'sklearn',
         'selenium'
-    ]
+    ],
+    extras_require={
+        'archive': ['zstandard']  # else raw pages are compressed with zlib
+    }
 )